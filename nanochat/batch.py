@@ -0,0 +1,200 @@
+"""
+Offline batch inference: a JSONL file of conversations in, a JSONL file of responses out.
+
+Each input line is a JSON object with the conversation and optional sampling parameters:
+
+{"id": "q1", "messages": [{"role": "user", "content": "Why is the sky blue?"}], "temperature": 0.0, "max_tokens": 256}
+
+Each output line holds the response of one input line, keyed by its line index (and id, if given):
+
+{"index": 0, "id": "q1", "response": "...", "num_tokens": 42, "finish_reason": "stop"}
+
+The output file doubles as the checkpoint: results are appended (and flushed) as soon as a batch
+finishes, in whatever order batches finish, and a restarted job skips every line that already has
+a result. Conversations with the same sampling parameters and similar lengths are grouped into
+batches that are generated together with Engine.generate_multi.
+
+The driver is either scripts/batch_infer.py (standalone, all GPUs) or the /batch/jobs API of
+scripts/chat_web.py (in the background, at low priority next to the interactive traffic).
+"""
+
+import os
+import json
+import time
+import uuid
+import threading
+
+DEFAULT_SAMPLING = {"temperature": 0.0, "top_k": 50, "max_tokens": 512}
+MAX_PROMPT_TOKENS = 2048 # longer prompts are rejected rather than silently truncated
+
+def validate_sampling(sampling, limits=None):
+    """Check the sampling parameters against limits, {name: (min, max)}, raise ValueError if they are off."""
+    for name, value in sampling.items():
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            raise ValueError(f"{name} must be a number, got {value!r}")
+        if name in ("top_k", "max_tokens") and value != int(value):
+            raise ValueError(f"{name} must be an integer, got {value!r}")
+        low, high = (limits or {}).get(name, (0, float("inf")))
+        if not (low <= value <= high):
+            raise ValueError(f"{name} must be between {low} and {high}, got {value!r}")
+
+def validate_messages(messages):
+    """Check that the messages render as a prompt: an optional system message, then user and assistant turns, ending with the user."""
+    if not isinstance(messages, list) or not messages:
+        raise ValueError("messages must be a non-empty list")
+    if not all(isinstance(message, dict) and "role" in message and "content" in message for message in messages):
+        raise ValueError("every message must have a role and a content")
+    if messages[0]["role"] == "system":
+        messages = messages[1:]
+    for i, message in enumerate(messages):
+        role = "user" if i % 2 == 0 else "assistant"
+        if message["role"] != role:
+            raise ValueError(f"message {i} is from {message['role']} but should be from {role} (a system message can only come first)")
+        if role == "user" and not isinstance(message["content"], str):
+            raise ValueError(f"the content of user message {i} must be a string")
+    if not messages or messages[-1]["role"] != "user":
+        raise ValueError("the last message must be from the user")
+
+def render_prompt(tokenizer, messages, max_tokens=MAX_PROMPT_TOKENS):
+    """
+    Render a conversation priming the Assistant for its reply. Raises ValueError if it is longer than
+    max_tokens (None = no limit, e.g. to render the prompts exactly as the web server does).
+    """
+    limit = float("inf") if max_tokens is None else max_tokens
+    ids, _, _ = tokenizer.render_conversations([{"messages": list(messages)}], max_tokens=limit)
+    if len(ids) >= limit: # no room left for <|assistant_start|>, or truncated
+        raise ValueError(f"the prompt is longer than {max_tokens} tokens")
+    return ids.tolist() + [tokenizer.encode_special("<|assistant_start|>")]
+
+def read_completed(output_path):
+    """
+    Indices of the input lines that already have a result. A partially written last line
+    (e.g. the process died mid-write) is cut off, so that appending can resume cleanly.
+    """
+    completed = set()
+    if not os.path.exists(output_path):
+        return completed
+    valid_bytes = 0
+    with open(output_path, "rb") as f:
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            try:
+                completed.add(json.loads(line)["index"])
+            except (ValueError, KeyError):
+                break
+            valid_bytes += len(line)
+    if valid_bytes < os.path.getsize(output_path):
+        with open(output_path, "r+b") as f:
+            f.truncate(valid_bytes)
+    return completed
+
+class BatchJob:
+    """One JSONL job: the pending records grouped into batches, and the bookkeeping of the results."""
+
+    def __init__(self, input_path, output_path, tokenizer, batch_size=16, sampling=None, job_id=None, sampling_limits=None):
+        self.id = job_id or uuid.uuid4().hex[:12]
+        self.input_path = input_path
+        self.output_path = output_path
+        self.batch_size = batch_size
+        self.sampling = {**DEFAULT_SAMPLING, **(sampling or {})}
+        validate_sampling(self.sampling, sampling_limits)
+        self.lock = threading.Lock() # results are written from several worker threads
+        self.status = "pending" # pending|running|done|failed
+        self.error = None
+        self.created_at = time.time()
+        self.finished_at = None
+
+        # Read the input and skip what a previous run already finished
+        completed = read_completed(output_path)
+        records = []
+        with open(input_path, "r", encoding="utf-8") as f:
+            for index, line in enumerate(f):
+                if line.strip() and index not in completed:
+                    try:
+                        records.append((index, json.loads(line)))
+                    except json.JSONDecodeError as e:
+                        raise ValueError(f"line {index + 1}: invalid JSON: {e}") from e
+        self.num_total = len(completed) + len(records)
+        self.num_done = len(completed)
+        self.num_tokens = 0
+
+        # Batches: same sampling parameters within a batch, and similar lengths to waste little on padding.
+        # Every line is checked here, so that a bad one fails the job up front rather than a worker mid-job.
+        groups = {}
+        for index, record in records:
+            try:
+                if not isinstance(record, dict) or "messages" not in record:
+                    raise ValueError("expected an object with messages")
+                params = tuple(record.get(k, v) for k, v in self.sampling.items())
+                validate_sampling(dict(zip(self.sampling.keys(), params)), sampling_limits)
+                validate_messages(record["messages"])
+                tokens = render_prompt(tokenizer, record["messages"])
+            except ValueError as e:
+                raise ValueError(f"line {index + 1}: {e}") from e
+            groups.setdefault(params, []).append((index, record, tokens))
+        self.batches = []
+        for params, items in groups.items():
+            items.sort(key=lambda item: len(item[2]))
+            sampling = dict(zip(self.sampling.keys(), params))
+            for i in range(0, len(items), batch_size):
+                self.batches.append((sampling, items[i:i + batch_size]))
+
+    def write_results(self, results):
+        """Append the results of a batch to the output file, durably, so a crash loses at most the batches in flight."""
+        lines = "".join(json.dumps(result, ensure_ascii=False) + "\n" for result in results)
+        with self.lock:
+            with open(self.output_path, "a", encoding="utf-8") as f:
+                f.write(lines)
+                f.flush()
+                os.fsync(f.fileno())
+            self.num_done += len(results)
+            self.num_tokens += sum(result["num_tokens"] for result in results)
+
+    def state(self):
+        return {
+            "id": self.id,
+            "status": self.status,
+            "error": self.error,
+            "input_path": self.input_path,
+            "output_path": self.output_path,
+            "num_total": self.num_total,
+            "num_done": self.num_done,
+            "num_generated_tokens": self.num_tokens,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+        }
+
+def generate_batch_results(engine, tokenizer, sampling, items, seed=42):
+    """Generate the responses of one batch of (index, record, prompt tokens) items, one row each."""
+    assistant_end = tokenizer.encode_special("<|assistant_end|>")
+    bos = tokenizer.get_bos_token_id()
+    responses = [[] for _ in items]
+    finished = [False] * len(items)
+    stream = engine.generate_multi(
+        [tokens for _, _, tokens in items],
+        max_tokens=sampling["max_tokens"],
+        temperature=sampling["temperature"],
+        top_k=sampling["top_k"],
+        seed=seed,
+    )
+    for token_column, _ in stream:
+        for i, token in enumerate(token_column):
+            if finished[i]:
+                continue
+            if token == assistant_end or token == bos:
+                finished[i] = True
+            else:
+                responses[i].append(token)
+        if all(finished):
+            break
+    results = []
+    for (index, record, _), response, done in zip(items, responses, finished):
+        results.append({
+            "index": index,
+            "id": record.get("id"),
+            "response": tokenizer.decode(response),
+            "num_tokens": len(response),
+            "finish_reason": "stop" if done else "length",
+        })
+    return results
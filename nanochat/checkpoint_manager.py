@@ -117,15 +117,15 @@ def find_largest_model(checkpoints_dir):
 def find_last_step(checkpoint_dir):
     # Look into checkpoint_dir and find model_<step>.pt with the highest step
     checkpoint_files = glob.glob(os.path.join(checkpoint_dir, "model_*.pt"))
-    if not checkpoint_files:
+    steps = [int(match.group(1)) for f in checkpoint_files if (match := re.fullmatch(r"model_(\d+)\.pt", os.path.basename(f)))]
+    if not steps:
         raise FileNotFoundError(f"No checkpoints found in {checkpoint_dir}")
-    last_step = int(max(os.path.basename(f).split("_")[-1].split(".")[0] for f in checkpoint_files))
-    return last_step
+    return max(steps)
 
 # -----------------------------------------------------------------------------
 # convenience functions that take into account nanochat's directory structure
 
-def load_model_from_dir(checkpoints_dir, device, phase, model_tag=None, step=None):
+def resolve_checkpoint(checkpoints_dir, model_tag=None, step=None):
     if model_tag is None:
         # guess the model tag by defaulting to the largest model
         model_tag = find_largest_model(checkpoints_dir)
@@ -135,18 +135,69 @@ def load_model_from_dir(checkpoints_dir, device, phase, model_tag=None, step=Non
         # guess the step by defaulting to the last step
         step = find_last_step(checkpoint_dir)
     assert step is not None, f"No checkpoints found in {checkpoint_dir}"
+    return checkpoint_dir, step
+
+def load_model_from_dir(checkpoints_dir, device, phase, model_tag=None, step=None):
+    checkpoint_dir, step = resolve_checkpoint(checkpoints_dir, model_tag, step)
     # build the model
     log0(f"Loading model from {checkpoint_dir} with step {step}")
     model, tokenizer, meta_data = build_model(checkpoint_dir, step, device, phase)
     return model, tokenizer, meta_data
 
+CHECKPOINT_DIRS = {
+    "base": "base_checkpoints",
+    "mid": "mid_checkpoints",
+    "sft": "chatsft_checkpoints",
+    "rl": "chatrl_checkpoints",
+    "exit": "chatexit_checkpoints",
+}
+
 def load_model(source, *args, **kwargs):
-    model_dir = {
-        "base": "base_checkpoints",
-        "mid": "mid_checkpoints",
-        "sft": "chatsft_checkpoints",
-        "rl": "chatrl_checkpoints",
-    }[source]
     base_dir = get_base_dir()
-    checkpoints_dir = os.path.join(base_dir, model_dir)
+    checkpoints_dir = os.path.join(base_dir, CHECKPOINT_DIRS[source])
     return load_model_from_dir(checkpoints_dir, *args, **kwargs)
+
+def checkpoint_bytes(source, model_tag=None, step=None):
+    """Size of the model weights of a checkpoint on disk, a cheap estimate of its memory once loaded."""
+    checkpoints_dir = os.path.join(get_base_dir(), CHECKPOINT_DIRS[source])
+    checkpoint_dir, step = resolve_checkpoint(checkpoints_dir, model_tag, step)
+    return os.path.getsize(os.path.join(checkpoint_dir, f"model_{step:06d}.pt"))
+
+# -----------------------------------------------------------------------------
+# memory-mapped float32 weights, so that several CPU processes can share one copy
+
+def export_fp32_weights(source, model_tag=None, step=None):
+    """
+    Write (once) a float32 copy of a checkpoint into its fp32/ subdirectory, in a form torch.load can
+    memory-map. Returns (weights_path, meta_data).
+    """
+    checkpoints_dir = os.path.join(get_base_dir(), CHECKPOINT_DIRS[source])
+    checkpoint_dir, step = resolve_checkpoint(checkpoints_dir, model_tag, step)
+    weights_path = os.path.join(checkpoint_dir, "fp32", f"model_{step:06d}.pt") # out of the way of find_last_step
+    if not os.path.exists(weights_path):
+        os.makedirs(os.path.dirname(weights_path), exist_ok=True)
+        model_data, _, _ = load_checkpoint(checkpoint_dir, step, torch.device("cpu"))
+        model_data = {k.removeprefix("_orig_mod."): v.float() if v.dtype == torch.bfloat16 else v for k, v in model_data.items()}
+        tmp_path = f"{weights_path}.tmp{os.getpid()}"
+        torch.save(model_data, tmp_path)
+        os.replace(tmp_path, weights_path)
+        log0(f"Exported float32 weights to {weights_path}")
+    meta_path = os.path.join(checkpoint_dir, f"meta_{step:06d}.json")
+    with open(meta_path, "r", encoding="utf-8") as f:
+        meta_data = json.load(f)
+    return weights_path, meta_data
+
+def load_model_mmap(weights_path, meta_data):
+    """
+    Build an eval CPU model whose weights are memory-mapped (copy-on-write) from weights_path:
+    processes that load the same file share its pages instead of each holding a copy.
+    """
+    model_data = torch.load(weights_path, map_location="cpu", mmap=True, weights_only=True)
+    model_config = GPTConfig(**meta_data["model_config"])
+    with torch.device("meta"):
+        model = GPT(model_config)
+    model.to_empty(device="cpu")
+    model.init_weights() # the rotary embeddings, the parameters get replaced right after
+    model.load_state_dict(model_data, strict=True, assign=True)
+    model.eval()
+    return model
@@ -0,0 +1,137 @@
+"""
+Multi-process CPU serving: N model replicas in N processes, each pinned to its own set of cores.
+
+One PyTorch process rarely scales across all the cores of a big box, while several replicas with
+a few cores each do, as long as they don't fight over the same cores and don't each need a copy
+of the weights. So:
+- the cores are split into disjoint sets, following the NUMA nodes when the kernel reports them,
+  and each process pins itself to its set with a matching number of intra-op threads;
+- the weights are exported once as a float32 checkpoint that every process memory-maps, so they
+  share the same physical pages (see checkpoint_manager.export_fp32_weights);
+- requests and tokens travel over a pipe per process. ProcessEngine is the server-side handle of a
+  process and has the same generate/generate_multi interface as Engine, so the server can use it
+  in place of an in-process Engine.
+"""
+
+import os
+import glob
+import threading
+import multiprocessing as mp
+
+# -----------------------------------------------------------------------------
+# Core sets
+
+def parse_cpulist(cpulist):
+    # e.g. "0-3,8-11" -> [0, 1, 2, 3, 8, 9, 10, 11]
+    cores = []
+    for part in cpulist.strip().split(","):
+        if not part:
+            continue
+        lo, _, hi = part.partition("-")
+        cores.extend(range(int(lo), int(hi or lo) + 1))
+    return cores
+
+def numa_nodes():
+    """The cores of each NUMA node, or None if the kernel does not say."""
+    nodes = []
+    for path in sorted(glob.glob("/sys/devices/system/node/node[0-9]*/cpulist"), key=lambda p: int(p.split("node")[-1].split("/")[0])):
+        with open(path) as f:
+            nodes.append(parse_cpulist(f.read()))
+    return nodes or None
+
+def cpu_core_sets(num_workers):
+    """
+    Split the cores this process may run on into num_workers disjoint, equally sized sets.
+    The cores are ordered node by node before splitting, so with a number of workers that is a
+    multiple of the number of NUMA nodes, no worker straddles two nodes.
+    """
+    available = sorted(os.sched_getaffinity(0))
+    nodes = numa_nodes() or [available]
+    available_set = set(available)
+    ordered = [core for node in nodes for core in node if core in available_set]
+    ordered += [core for core in available if core not in set(ordered)] # cores the nodes did not list
+    per_worker = len(ordered) // num_workers
+    assert per_worker >= 1, f"Cannot run {num_workers} CPU workers on {len(ordered)} cores"
+    return [ordered[i * per_worker:(i + 1) * per_worker] for i in range(num_workers)]
+
+# -----------------------------------------------------------------------------
+# The worker process
+
+def worker_main(conn, cores, weights_path, meta_data):
+    """Entry point of a worker process: pin, load the shared weights, then serve requests off the pipe."""
+    os.sched_setaffinity(0, cores)
+    import torch
+    torch.set_num_threads(len(cores))
+    torch.set_num_interop_threads(1)
+    from nanochat.checkpoint_manager import load_model_mmap
+    from nanochat.tokenizer import get_tokenizer
+    from nanochat.engine import Engine
+    engine = Engine(load_model_mmap(weights_path, meta_data), get_tokenizer())
+    conn.send(("ready", None))
+    while True:
+        method, arg, kwargs = conn.recv()
+        if method == "shutdown":
+            break
+        if method == "cancel":
+            continue # the request it meant to cancel already finished
+        try:
+            for token_column, token_masks in getattr(engine, method)(arg, **kwargs):
+                conn.send(("tokens", (token_column, token_masks)))
+                if conn.poll(): # the only message that can arrive mid-request is a cancel
+                    conn.recv()
+                    break
+            conn.send(("end", None))
+        except Exception as e:
+            conn.send(("error", f"{type(e).__name__}: {e}"))
+
+class ProcessEngine:
+    """Server-side handle of a worker process, with the generation interface of Engine."""
+
+    def __init__(self, cores, weights_path, meta_data):
+        ctx = mp.get_context("spawn") # no fork: the parent has torch threads and an event loop running
+        self.conn, child_conn = ctx.Pipe()
+        self.cores = cores
+        self.process = ctx.Process(target=worker_main, args=(child_conn, cores, weights_path, meta_data), daemon=True)
+        self.process.start()
+        self.lock = threading.Lock() # one request at a time per process
+
+    def wait_ready(self):
+        kind, _ = self.conn.recv()
+        assert kind == "ready", f"Unexpected message from worker process: {kind}"
+
+    def generate(self, tokens, **kwargs):
+        yield from self._request("generate", tokens, kwargs)
+
+    def generate_multi(self, prompts, **kwargs):
+        yield from self._request("generate_multi", prompts, kwargs)
+
+    def _request(self, method, arg, kwargs):
+        with self.lock:
+            self.conn.send((method, arg, kwargs))
+            finished = False
+            try:
+                while True:
+                    kind, payload = self.conn.recv()
+                    if kind == "tokens":
+                        yield payload
+                    elif kind == "end":
+                        finished = True
+                        return
+                    else:
+                        finished = True
+                        raise RuntimeError(f"Worker process failed: {payload}")
+            finally:
+                if not finished:
+                    # the consumer stopped early: cancel, and drain the pipe up to the end of this request
+                    self.conn.send(("cancel", None, None))
+                    while self.conn.recv()[0] not in ("end", "error"):
+                        pass
+
+    def close(self):
+        try:
+            self.conn.send(("shutdown", None, None))
+        except (BrokenPipeError, OSError):
+            pass
+        self.process.join(timeout=5)
+        if self.process.is_alive():
+            self.process.terminate()
@@ -1,93 +1,309 @@
+import time
+import queue
+import threading
 from collections import deque
-
+import numpy as np
 import torch
 import pyarrow.parquet as pq
 
 from nanochat.common import get_dist_info
-from nanochat.dataset import list_parquet_files
+from nanochat.dataset import ParquetShards
 from nanochat.tokenizer import get_tokenizer
+from nanochat.token_shards import TokenShards
 
-def tokenizing_distributed_data_loader_with_state(B, T, split, tokenizer_threads=4, tokenizer_batch_size=128, device="cuda", resume_state_dict=None):
+def tokenizing_distributed_data_loader_with_state(B, T, split, tokenizer_threads=4, tokenizer_batch_size=128, device="cuda", resume_state_dict=None, prefetch=0):
     """
     Stream pretraining text from parquet files, tokenize, yield training batches.
 
-    This implementation became a bit more complex because we wish to support approximate resume training.
+    This implementation became a bit more complex because we wish to support exact resume training.
     Instead of turning this into a Class, we opt to return the state_dict with every batch,
     and then the caller can pass in a state_dict to resume training from a desired point.
-    Note that this resumption is atm only *approximate* for simplicity.
-    We won't repeat the same documents but we might skip a few.
-    The state_dict that is returned can be later passed into this function via `resume_state_dict` to approximately resume.
+    The row groups of the split are divided between the ranks by the manifest of the parquet files
+    (see ParquetShards in dataset.py), evenly by (uncompressed) bytes, a proxy for the tokens.
+    The state_dict is the position of the first token of the batch in this rank's stream of documents:
+    the epoch, the global index of the document in the split and the token in the document. Resuming
+    from it yields the same batch again and goes on with the same data. The seek is cheap: the manifest
+    locates the document, its row group is read, and only its documents from the resume point on are
+    tokenized. Each rank has its own position (the ranks read different row groups), so resuming
+    exactly needs the state_dict of every rank, and the same number of ranks.
 
-    Perfect state resumption is possible but would be a lot more bloated, probably not worth it atm.
+    With prefetch > 0, the reading, tokenizing and batching run in a background thread, up to
+    prefetch batches ahead (see BackgroundLoader).
     """
     assert split in ["train", "val"], "split must be 'train' or 'val'"
+    scratch = ScratchBuffers(B, T, device, num_buffers=prefetch + 3)
+    batches = _tokenized_batches(B, T, split, tokenizer_threads, tokenizer_batch_size, scratch, resume_state_dict)
+    return _to_device(batches, scratch, prefetch)
 
-    # infinite iterator over document batches (list of text strings)
+def _tokenized_batches(B, T, split, tokenizer_threads, tokenizer_batch_size, scratch, resume_state_dict):
+    # the CPU side of tokenizing_distributed_data_loader_with_state: yields (tokens, state_dict), tokens in a scratch buffer
     ddp, ddp_rank, ddp_local_rank, ddp_world_size = get_dist_info()
-    def document_batches():
-        parquet_paths = list_parquet_files()
-        parquet_paths = parquet_paths[:-1] if split == "train" else parquet_paths[-1:]
-        resume_pq_idx = resume_state_dict["pq_idx"] if resume_state_dict is not None else 0
-        resume_rg_idx = resume_state_dict["rg_idx"] if resume_state_dict is not None else None
-        first_pass = True
-        pq_idx = resume_pq_idx # we kick off parquet files at the resume index (or by default just 0)
+    shards = ParquetShards(split)
+    row_groups = shards.assign(ddp_rank, ddp_world_size) # the (pq_idx, rg_idx) this rank reads, in order
+    assert row_groups, f"The {split} split has fewer row groups than ranks"
+    epoch, start, doc_idx = 0, 0, 0 # start reading at document doc_idx of row_groups[start]
+    skip_tokens = 0 # tokens of the first document to skip
+    if resume_state_dict is not None:
+        assert "doc_index" in resume_state_dict, "The resume state is not from the tokenizing data loader"
+        epoch, skip_tokens = resume_state_dict["epoch"], resume_state_dict["token_idx"]
+        pq_idx, rg_idx, doc_idx = shards.locate(resume_state_dict["doc_index"])
+        assert (pq_idx, rg_idx) in row_groups, "The resume state is from another rank or another number of ranks"
+        start = row_groups.index((pq_idx, rg_idx))
+
+    # infinite iterator over document batches (list of text strings), with the position of their first document
+    def document_batches(epoch, start, doc_idx):
+        pf, pf_idx = None, None
         while True: # iterate infinitely (multi-epoch)
-            pq_idx = resume_pq_idx if first_pass else 0
-            while pq_idx < len(parquet_paths): # iterate over all parquet files
-                filepath = parquet_paths[pq_idx]
-                pf = pq.ParquetFile(filepath)
-                # Start from resume point if resuming on same file, otherwise from DDP rank
-                # I know this state resumption is a little bit tricky and a little bit hacky... sigh.
-                if first_pass and (resume_rg_idx is not None) and (pq_idx == resume_pq_idx):
-                    base_idx = resume_rg_idx // ddp_world_size # in units of ddp_world_size
-                    base_idx += 1 # advance by 1 so that we definitely don't repeat data after resuming
-                    rg_idx = base_idx * ddp_world_size + ddp_rank
-                    if rg_idx >= pf.num_row_groups:
-                        pq_idx += 1
-                        continue
-                    resume_rg_idx = None # set to None as we only want to do this a single time
-                else:
-                    rg_idx = ddp_rank
-                while rg_idx < pf.num_row_groups:
-                    rg = pf.read_row_group(rg_idx)
-                    batch = rg.column('text').to_pylist() # each batch is a parquet group, e.g. 1024 rows
-                    # the tokenizer encode might want to go in even smaller batches, e.g. 128 rows
-                    for i in range(0, len(batch), tokenizer_batch_size):
-                        yield batch[i:i+tokenizer_batch_size], (pq_idx, rg_idx)
-                    rg_idx += ddp_world_size # advance to the next row group (in DDP)
-                pq_idx += 1 # advance to the next parquet file
-            first_pass = False
-    batches = document_batches()
+            for pq_idx, rg_idx in row_groups[start:]:
+                if pq_idx != pf_idx:
+                    pf, pf_idx = pq.ParquetFile(shards.paths[pq_idx]), pq_idx
+                rg = pf.read_row_group(rg_idx, columns=['text'])
+                batch = rg.column('text').to_pylist() # each batch is a parquet group, e.g. 1024 rows
+                first_doc = shards.doc_index(pq_idx, rg_idx)
+                # the tokenizer encode might want to go in even smaller batches, e.g. 128 rows
+                for i in range(doc_idx, len(batch), tokenizer_batch_size):
+                    yield batch[i:i+tokenizer_batch_size], (epoch, first_doc + i)
+                doc_idx = 0
+            epoch, start = epoch + 1, 0
+    batches = document_batches(epoch, start, doc_idx)
 
     # Now emit batches of tokens.
     needed_tokens = B * T + 1 # +1 is because we also need the target at the last token
     # get the tokenizer and the bos token
     tokenizer = get_tokenizer()
     bos_token = tokenizer.get_bos_token_id()
-    # scratch buffer holds the tokens for one iteration
-    token_buffer = deque() # we stream tokens on the right and pop from the left
+    token_buffer = TokenBuffer() # the tokens not consumed yet, they never exist as Python ints
+    # the document batches in the token buffer, oldest first: (position of the first document, document offsets),
+    # and the number of tokens of the oldest one already consumed; together they give the position of the next token
+    pending = deque()
+    consumed = 0
     while True:
         # Accumulate enough tokens for one iteration before yielding.
         while len(token_buffer) < needed_tokens:
-            doc_batch, (pq_idx, rg_idx) = next(batches)
-            token_lists = tokenizer.encode(doc_batch, prepend=bos_token, num_threads=tokenizer_threads)
-            for tokens in token_lists:
-                token_buffer.extend(tokens)
-        # Move tokens from the deque into the scratch buffer
-        tokens = [token_buffer.popleft() for _ in range(needed_tokens)]
-        # CUDA supports memory pinning for asynchronous transfers between CPU and GPU
-        use_cuda_optimizations = device == "cuda"
-        scratch = torch.tensor(tokens, dtype=torch.long, pin_memory=use_cuda_optimizations) # in PyTorch, long=int64
-        # Create the inputs/targets as 1D tensors
-        inputs_cpu = scratch[:-1]
-        targets_cpu = scratch[1:]
-        # Reshape to 2D and move to GPU async
-        inputs = inputs_cpu.view(B, T).to(device=device, non_blocking=use_cuda_optimizations)
-        targets = targets_cpu.view(B, T).to(device=device, non_blocking=use_cuda_optimizations)
-        state_dict = {"pq_idx": pq_idx, "rg_idx": rg_idx} # we need this in case we wish to approximately resume training
-        yield inputs, targets, state_dict
+            doc_batch, position = next(batches)
+            doc_tokens, doc_offsets = tokenizer.encode_batch_to_array(doc_batch, prepend=bos_token, num_threads=tokenizer_threads)
+            token_buffer.append(doc_tokens)
+            pending.append((position, doc_offsets))
+            if skip_tokens: # resuming inside a document, drop its tokens before the resume point
+                token_buffer.take(skip_tokens)
+                consumed, skip_tokens = skip_tokens, 0
+        # The position of the first token of this batch
+        (epoch, doc_index), doc_offsets = pending[0]
+        d = int(np.searchsorted(doc_offsets, consumed, side="right")) - 1
+        state_dict = {"epoch": epoch, "doc_index": doc_index + d, "token_idx": consumed - int(doc_offsets[d])}
+        # Take the tokens of this iteration off the front, straight into the (pinned) scratch buffer
+        tokens = scratch.next()
+        token_buffer.take(needed_tokens, out=tokens.numpy())
+        consumed += needed_tokens
+        while pending and consumed >= pending[0][1][-1]: # drop the document batches consumed entirely
+            consumed -= int(pending.popleft()[1][-1])
+        yield tokens, state_dict
 
 def tokenizing_distributed_data_loader(*args, **kwargs):
     # helper function that only emits the inputs/targets and not the state_dict
     for inputs, targets, state_dict in tokenizing_distributed_data_loader_with_state(*args, **kwargs):
         yield inputs, targets
+
+def pretokenized_distributed_data_loader_with_state(B, T, split, tokens_dir, device="cuda", resume_state_dict=None, prefetch=0):
+    """
+    Yield training batches from the pre-tokenized shards of tokens_dir (see nanochat/token_shards.py,
+    written by scripts/tok_data.py). Nothing is tokenized here, every batch is a slice of the
+    memory-mapped token files.
+
+    At every step the ranks together take the next world_size * B * T tokens of the split, rank r the
+    r-th B * T of them (plus the token after them, for the last target). An epoch ends when less than
+    one step of tokens is left. The state_dict yielded with a batch is the token offset of that batch
+    and the epoch, so resuming from it is exact: the loader yields the same batch again, and goes on
+    with the same data, even with another number of ranks.
+    With prefetch > 0, the batches are read in a background thread (see BackgroundLoader).
+    """
+    assert split in ["train", "val"], "split must be 'train' or 'val'"
+    scratch = ScratchBuffers(B, T, device, num_buffers=prefetch + 3)
+    batches = _pretokenized_batches(B, T, split, tokens_dir, scratch, resume_state_dict)
+    return _to_device(batches, scratch, prefetch)
+
+def _pretokenized_batches(B, T, split, tokens_dir, scratch, resume_state_dict):
+    # the CPU side of pretokenized_distributed_data_loader_with_state
+    ddp, ddp_rank, ddp_local_rank, ddp_world_size = get_dist_info()
+    shards = TokenShards(tokens_dir, split)
+    tokens_per_rank = B * T
+    tokens_per_step = tokens_per_rank * ddp_world_size
+    assert shards.num_tokens > tokens_per_step, f"The {split} split of {tokens_dir} has fewer tokens than one step ({tokens_per_step:,})"
+    token_offset, epoch = 0, 0
+    if resume_state_dict is not None:
+        assert "token_offset" in resume_state_dict, "The resume state is not from the pre-tokenized data loader"
+        token_offset, epoch = resume_state_dict["token_offset"], resume_state_dict["epoch"]
+    while True:
+        if token_offset + tokens_per_step + 1 > shards.num_tokens:
+            token_offset, epoch = 0, epoch + 1 # drop the tail, start the next epoch
+        tokens = scratch.next()
+        tokens.numpy()[:] = shards.read(token_offset + ddp_rank * tokens_per_rank, tokens_per_rank + 1)
+        state_dict = {"token_offset": token_offset, "epoch": epoch}
+        token_offset += tokens_per_step
+        yield tokens, state_dict
+
+def pretokenized_distributed_data_loader(*args, **kwargs):
+    # helper function that only emits the inputs/targets and not the state_dict
+    for inputs, targets, state_dict in pretokenized_distributed_data_loader_with_state(*args, **kwargs):
+        yield inputs, targets
+
+# -----------------------------------------------------------------------------
+# Packing the tokens into batches and moving them to the device, optionally with a background thread preparing them
+
+class TokenBuffer:
+    """
+    A ring buffer of tokens for packing documents into batches: the documents go in as token arrays
+    (append), the batches come out as runs of tokens copied straight into a scratch buffer (take), so
+    the tokens never exist as Python ints. It grows when needed.
+    """
+
+    def __init__(self, capacity=1 << 16, dtype=np.uint32):
+        self.buffer = np.empty(capacity, dtype=dtype)
+        self.start = 0 # index of the first token
+        self.size = 0 # number of tokens
+
+    def __len__(self):
+        return self.size
+
+    def append(self, tokens):
+        n = len(tokens)
+        if self.size + n > len(self.buffer):
+            size = self.size
+            buffer = np.empty(max(size + n, 2 * len(self.buffer)), dtype=self.buffer.dtype)
+            self.take(size, out=buffer[:size]) # unwrap into the new buffer
+            self.buffer, self.start, self.size = buffer, 0, size
+        end = (self.start + self.size) % len(self.buffer)
+        first = min(n, len(self.buffer) - end) # up to the end of the buffer, then wrap around
+        self.buffer[end:end + first] = tokens[:first]
+        self.buffer[:n - first] = tokens[first:]
+        self.size += n
+
+    def take(self, n, out=None):
+        """Remove the first n tokens, into out (any dtype, e.g. the numpy view of a scratch tensor)."""
+        assert n <= self.size, "not enough tokens in the buffer"
+        if out is None:
+            out = np.empty(n, dtype=self.buffer.dtype)
+        first = min(n, len(self.buffer) - self.start)
+        out[:first] = self.buffer[self.start:self.start + first]
+        out[first:n] = self.buffer[:n - first]
+        self.start = (self.start + n) % len(self.buffer)
+        self.size -= n
+        return out
+
+class ScratchBuffers:
+    """
+    Preallocated int64 buffers for the B * T + 1 tokens of the batches of a loader, pinned on CUDA
+    for asynchronous copies to the GPU, and reused round robin across steps instead of allocating
+    (and pinning) a new tensor every step. A buffer is only handed out again once the copy of its previous batch to the
+    device has completed, so a loader running ahead never overwrites a batch still in flight.
+    """
+
+    def __init__(self, B, T, device, num_buffers=2):
+        self.B, self.T = B, T
+        self.device = device
+        self.cuda = torch.device(device).type == "cuda" # device can also be e.g. torch.device("cuda", 1)
+        self.buffers = [torch.empty(B * T + 1, dtype=torch.int64, pin_memory=self.cuda) for _ in range(num_buffers)]
+        self.index = {buffer.data_ptr(): i for i, buffer in enumerate(self.buffers)}
+        self.copied = [None] * num_buffers # CUDA event of the last copy out of every buffer
+        self.next_index = 0
+
+    def next(self):
+        i = self.next_index
+        self.next_index = (i + 1) % len(self.buffers)
+        if self.copied[i] is not None:
+            self.copied[i].synchronize()
+            self.copied[i] = None
+        return self.buffers[i]
+
+    def to_device(self, tokens):
+        """The inputs and targets of the tokens of a buffer, on the device."""
+        if torch.device(self.device).type == "cpu":
+            tokens = tokens.clone() # the buffer will be overwritten, the batch must not change
+        inputs = tokens[:-1].view(self.B, self.T).to(device=self.device, non_blocking=self.cuda)
+        targets = tokens[1:].view(self.B, self.T).to(device=self.device, non_blocking=self.cuda)
+        if self.cuda:
+            event = torch.cuda.Event()
+            event.record()
+            self.copied[self.index[tokens.data_ptr()]] = event
+        return inputs, targets
+
+def _to_device(batches, scratch, prefetch):
+    if prefetch > 0:
+        return BackgroundLoader(batches, scratch, depth=prefetch)
+    return _move_to_device(batches, scratch)
+
+def _move_to_device(batches, scratch):
+    for tokens, state_dict in batches:
+        inputs, targets = scratch.to_device(tokens)
+        yield inputs, targets, state_dict
+
+class BackgroundLoader:
+    """
+    Runs a generator of CPU batches (tokens, state_dict), the tokens in the buffers of `scratch`, in a
+    background thread that keeps a bounded queue of up to `depth` ready (pinned) batches, so that reading and tokenizing overlap
+    the forward/backward of the training loop (tokenizers and pyarrow release the GIL). Iterating
+    yields the batches moved to the device. Every batch travels through the queue together with its
+    state_dict, so the state that comes out with a batch is exactly the state of that batch, however
+    far ahead the thread is.
+
+    stats() tells whether the loader keeps up: when the queue is often empty and the training loop
+    waits on it, the loader is the bottleneck.
+    """
+
+    def __init__(self, batches, scratch, depth=4):
+        # the queue holds depth buffers, the thread writes one and the training loop copies one out, plus one
+        # so that the buffer the thread takes next is never one the training loop is still copying out
+        assert len(scratch.buffers) >= depth + 3, "not enough scratch buffers for the queue depth"
+        self.scratch = scratch
+        self.queue = queue.Queue(maxsize=depth)
+        self.stop = threading.Event()
+        self.num_batches = 0 # batches handed out
+        self.num_waits = 0 # of which the queue was empty, the training loop had to wait
+        self.wait_time = 0.0 # seconds spent waiting
+        self.thread = threading.Thread(target=self._produce, args=(batches,), name="dataloader", daemon=True)
+        self.thread.start()
+
+    def _produce(self, batches):
+        try:
+            for batch in batches:
+                while not self.stop.is_set():
+                    try:
+                        self.queue.put(batch, timeout=0.1)
+                        break
+                    except queue.Full:
+                        pass
+                if self.stop.is_set():
+                    return
+            self.queue.put(StopIteration())
+        except BaseException as e: # re-raised in the training loop
+            self.queue.put(e)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.queue.empty():
+            self.num_waits += 1
+        t0 = time.perf_counter()
+        batch = self.queue.get()
+        self.wait_time += time.perf_counter() - t0
+        if isinstance(batch, BaseException):
+            self.queue.put(batch) # raise it again on the next call
+            raise batch
+        self.num_batches += 1
+        tokens, state_dict = batch
+        inputs, targets = self.scratch.to_device(tokens)
+        return inputs, targets, state_dict
+
+    def stats(self):
+        """Queue occupancy now, and how often and how long the training loop waited for a batch."""
+        return {
+            "queue_size": self.queue.qsize(),
+            "queue_depth": self.queue.maxsize,
+            "wait_fraction": self.num_waits / max(self.num_batches, 1),
+            "wait_time": self.wait_time,
+        }
+
+    def close(self):
+        self.stop.set()
+        self.thread.join()
@@ -2,15 +2,19 @@
 The base/pretraining dataset is a set of parquet files.
 This file contains utilities for:
 - iterating over the parquet files and yielding documents from it
+- a manifest of the parquet files, to split them between ranks and to seek in them
 - download the files on demand if they are not on disk
 
 For details of how the dataset was prepared, see `repackage_data_reference.py`.
 """
 
 import os
+import json
+import heapq
 import argparse
 import time
 import requests
+import numpy as np
 import pyarrow.parquet as pq
 from multiprocessing import Pool
 
@@ -26,6 +30,7 @@ index_to_filename = lambda index: f"shard_{index:05d}.parquet" # format of the f
 base_dir = get_base_dir()
 DATA_DIR = os.path.join(base_dir, "base_data")
 os.makedirs(DATA_DIR, exist_ok=True)
+MANIFEST_FILE = "manifest.json" # in the data dir, see load_manifest
 
 # -----------------------------------------------------------------------------
 # These functions are useful utilities to other modules, can/should be imported
@@ -56,6 +61,114 @@ def parquets_iter_batched(split, start=0, step=1):
             texts = rg.column('text').to_pylist()
             yield texts
 
+# -----------------------------------------------------------------------------
+# The manifest: what is in every parquet file, so that the loaders don't have to open them to find out
+
+def manifest_entry(filepath):
+    """The row groups, documents and bytes of a parquet file, from its footer."""
+    metadata = pq.read_metadata(filepath)
+    row_groups = [metadata.row_group(i) for i in range(metadata.num_row_groups)]
+    return {
+        "num_bytes": os.path.getsize(filepath), # also tells when the file has changed
+        "num_docs": metadata.num_rows,
+        "num_tokens": None, # known once the file is tokenized, see record_manifest_tokens
+        "row_group_docs": [rg.num_rows for rg in row_groups],
+        "row_group_bytes": [rg.total_byte_size for rg in row_groups], # uncompressed, a proxy for the tokens
+    }
+
+def write_manifest(shards, data_dir=None):
+    data_dir = DATA_DIR if data_dir is None else data_dir
+    manifest_path = os.path.join(data_dir, MANIFEST_FILE)
+    temp_path = manifest_path + f".{os.getpid()}.tmp" # the ranks may all write it at once
+    with open(temp_path, "w", encoding="utf-8") as f:
+        json.dump({"shards": dict(sorted(shards.items()))}, f, indent=2)
+    os.replace(temp_path, manifest_path)
+
+def load_manifest(data_dir=None):
+    """
+    The manifest of the parquet files of a data dir: {filename: manifest_entry}. It is built once, and
+    then only the files that are new or have changed since are read again.
+    """
+    data_dir = DATA_DIR if data_dir is None else data_dir
+    manifest_path = os.path.join(data_dir, MANIFEST_FILE)
+    shards = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            shards = json.load(f)["shards"]
+    updated = {}
+    for filepath in list_parquet_files(data_dir):
+        filename = os.path.basename(filepath)
+        entry = shards.get(filename)
+        if entry is None or entry["num_bytes"] != os.path.getsize(filepath):
+            entry = manifest_entry(filepath)
+        updated[filename] = entry
+    if updated != shards:
+        write_manifest(updated, data_dir)
+    return updated
+
+def record_manifest_tokens(num_tokens, data_dir=None):
+    """Record the token counts of tokenized files, {filename: num_tokens}."""
+    shards = load_manifest(data_dir)
+    for filename, count in num_tokens.items():
+        if filename in shards:
+            shards[filename]["num_tokens"] = count
+    write_manifest(shards, data_dir)
+
+class ParquetShards:
+    """
+    The row groups of a split, in order, as listed by the manifest. As for list_parquet_files, the last
+    file is the val split and all the others are the train split. The documents of the split are
+    numbered globally, in order, so that a document index can be located without opening any file.
+    """
+
+    def __init__(self, split, data_dir=None):
+        assert split in ["train", "val"], "split must be 'train' or 'val'"
+        data_dir = DATA_DIR if data_dir is None else data_dir
+        shards = load_manifest(data_dir)
+        filenames = list(shards)
+        filenames = filenames[:-1] if split == "train" else filenames[-1:]
+        self.paths = [os.path.join(data_dir, filename) for filename in filenames]
+        self.row_groups = [] # (pq_idx, rg_idx) of every row group of the split
+        docs, weights = [], []
+        for pq_idx, filename in enumerate(filenames):
+            entry = shards[filename]
+            for rg_idx, (num_docs, num_bytes) in enumerate(zip(entry["row_group_docs"], entry["row_group_bytes"])):
+                self.row_groups.append((pq_idx, rg_idx))
+                docs.append(num_docs)
+                # always the bytes, not the token counts: those get recorded (by tok_data) at any time,
+                # and the assignment of the row groups to the ranks must not change in the middle of a run
+                weights.append(num_bytes)
+        self.index = {row_group: k for k, row_group in enumerate(self.row_groups)}
+        self.weights = weights
+        self.doc_starts = np.zeros(len(docs) + 1, dtype=np.int64) # global index of the first document of every row group
+        np.cumsum(docs, out=self.doc_starts[1:])
+        self.num_docs = int(self.doc_starts[-1])
+
+    def assign(self, rank, world_size):
+        """
+        The row groups of a rank: in order, every row group goes to the rank with the fewest bytes (a
+        proxy for the tokens) so far, so that the ranks get the same amount of data even when the files differ.
+        """
+        loads = [(0, r) for r in range(world_size)]
+        assigned = []
+        for row_group, weight in zip(self.row_groups, self.weights):
+            load, r = heapq.heappop(loads)
+            if r == rank:
+                assigned.append(row_group)
+            heapq.heappush(loads, (load + weight, r))
+        return assigned
+
+    def doc_index(self, pq_idx, rg_idx, doc_idx=0):
+        """The global index of document doc_idx of a row group."""
+        return int(self.doc_starts[self.index[(pq_idx, rg_idx)]]) + doc_idx
+
+    def locate(self, doc_index):
+        """(pq_idx, rg_idx, doc_idx) of the document with a global index."""
+        assert 0 <= doc_index < self.num_docs, "document index out of range"
+        k = int(np.searchsorted(self.doc_starts, doc_index, side="right")) - 1
+        pq_idx, rg_idx = self.row_groups[k]
+        return pq_idx, rg_idx, doc_index - int(self.doc_starts[k])
+
 # -----------------------------------------------------------------------------
 def download_single_file(index):
     """ Downloads a single file index, with some backoff """
@@ -84,20 +84,50 @@ class KVCache:
     """
     Works hand-in-hand with the GPT model to maintain the KV cache.
     Note that the .pos advances automatically after the last layer of the Transformer inserts.
+    Full attention layers share one big cache that grows as needed. Sliding window layers
+    (window_sizes[layer_idx] > 0) instead each keep only the most recent keys/values that their window can see.
+    For a batch of different prompts, pad_lens holds the number of left padding positions of each row,
+    which the attention masks out.
     """
 
-    def __init__(self, batch_size, num_heads, seq_len, head_dim, num_layers):
-        # Each of K/V is of shape (B, H, T, D) and we have one per layer of the Transformer.
-        self.kv_shape = (num_layers, 2, batch_size, num_heads, seq_len, head_dim)
+    # sliding window layers keep this many positions beyond the window, so that short rewinds
+    # with set_pos (e.g. over rejected speculative tokens) still find the keys/values they need
+    WINDOW_SLACK = 64
+
+    def __init__(self, batch_size, num_heads, seq_len, head_dim, num_layers, window_sizes=None, pad_lens=None):
+        self.num_layers = num_layers
+        self.window_sizes = list(window_sizes) if window_sizes is not None else [0] * num_layers
+        assert len(self.window_sizes) == num_layers, f"Expected {num_layers} window sizes, got {len(self.window_sizes)}"
+        # full attention layers are stored in slots of the big cache
+        global_layers = [i for i, w in enumerate(self.window_sizes) if w == 0]
+        self.global_slot = {layer_idx: slot for slot, layer_idx in enumerate(global_layers)}
+        # Each of K/V is of shape (B, H, T, D) and we have one per full attention layer of the Transformer.
+        self.kv_shape = (len(global_layers), 2, batch_size, num_heads, seq_len, head_dim)
         self.kv_cache = None
+        # sliding window layers: layer_idx -> (2, B, H, capacity, D) tensor holding positions local_start[layer_idx] onwards
+        self.local_cache = {}
+        self.local_start = {}
         self.pos = 0 # current position in time in the cache
+        self.pad_lens = pad_lens # (B,) long tensor of left padding per row, or None
+        self.key_start = 0 # absolute position of the first key handed back by the latest insert_kv
 
     def reset(self):
         self.pos = 0
+        self.local_cache.clear()
+        self.local_start.clear()
 
     def get_pos(self):
         return self.pos
 
+    def set_pos(self, pos):
+        # Move the current position, e.g. to rewind over rejected speculative tokens.
+        # Entries past pos are left in place and simply get overwritten by later inserts.
+        assert 0 <= pos, f"Invalid KV cache position: {pos}"
+        for layer_idx, start in self.local_start.items():
+            needed = max(0, pos - self.window_sizes[layer_idx] + 1)
+            assert start <= needed, f"Layer {layer_idx} already dropped position {needed}, cannot rewind to {pos}"
+        self.pos = pos
+
     def prefill(self, other):
         """
         Prefill given another KV cache. Optionally expand along batch dim.
@@ -114,6 +144,7 @@ class KVCache:
         
         # Validate dimensions
         assert self_layers == other_layers, f"Layer count mismatch: {self_layers} != {other_layers}"
+        assert self.window_sizes == other.window_sizes, f"Window sizes mismatch: {self.window_sizes} != {other.window_sizes}"
         assert self_kv == other_kv, f"K/V dimension mismatch: {self_kv} != {other_kv}"
         assert self_heads == other_heads, f"Head count mismatch: {self_heads} != {other_heads}"
         assert self_head_dim == other_head_dim, f"Head dim mismatch: {self_head_dim} != {other_head_dim}"
@@ -129,8 +160,35 @@ class KVCache:
         self.kv_cache = torch.empty(self.kv_shape, dtype=dtype, device=device)
         # 3) copy the data over
         self.kv_cache[:, :, :, :, :other.pos, :] = other.kv_cache
-        # 4) update the pos
+        for layer_idx, cache in other.local_cache.items():
+            self.local_cache[layer_idx] = cache.expand(-1, self_batch, -1, -1, -1).clone()
+            self.local_start[layer_idx] = other.local_start[layer_idx]
+        # 4) update the pos and the padding
         self.pos = other.pos
+        if other.pad_lens is not None:
+            self.pad_lens = other.pad_lens.expand(self_batch).clone()
+
+    def _insert_local(self, layer_idx, k, v, t0, t1):
+        # Sliding window layer: keep only recent positions, compacting the cache when it runs out of room
+        window = self.window_sizes[layer_idx]
+        cache = self.local_cache.get(layer_idx)
+        start = self.local_start.get(layer_idx, 0)
+        if cache is None or t1 - start > cache.size(3):
+            # the oldest position worth keeping (the queries at t0 see back to t0 - window + 1, plus some slack)
+            keep_from = max(start, t0 - window - self.WINDOW_SLACK, 0)
+            B, H, T_add, D = k.size()
+            capacity = (t1 - keep_from) + window + self.WINDOW_SLACK # room to grow before the next compaction
+            new_cache = torch.empty((2, B, H, capacity, D), dtype=k.dtype, device=k.device)
+            if cache is not None and t0 > keep_from:
+                new_cache[:, :, :, :t0 - keep_from] = cache[:, :, :, keep_from - start:t0 - start]
+            cache, start = new_cache, keep_from
+            self.local_cache[layer_idx], self.local_start[layer_idx] = cache, start
+        # Insert k, v into the cache
+        cache[0, :, :, t0 - start:t1 - start] = k
+        cache[1, :, :, t0 - start:t1 - start] = v
+        # Return only the keys/values that the queries of this chunk can see
+        view_start = max(start, t0 - window + 1)
+        return cache[0, :, :, view_start - start:t1 - start], cache[1, :, :, view_start - start:t1 - start]
 
     def insert_kv(self, layer_idx, k, v):
         # Lazy initialize the cache here because we need to know the dtype/device
@@ -139,23 +197,28 @@ class KVCache:
         # Insert new keys/values to the cache and return the full cache so far
         B, H, T_add, D = k.size()
         t0, t1 = self.pos, self.pos + T_add
-        # Dynamically grow the cache if needed
-        if t1 > self.kv_cache.size(4):
-            t_needed = t1 + 1024 # as much as we need plus buffer of 1024
-            t_needed = (t_needed + 1023) & ~1023 # then round up to the nearest multiple of 1024
-            additional_shape = list(self.kv_cache.shape)
-            additional_shape[4] = t_needed - self.kv_cache.size(4)
-            additional_cache = torch.empty(additional_shape, dtype=k.dtype, device=k.device)
-            self.kv_cache = torch.cat([self.kv_cache, additional_cache], dim=4).contiguous()
-            self.kv_shape = self.kv_cache.shape
-        # Insert k, v into the cache
-        self.kv_cache[layer_idx, 0, :, :, t0:t1, :] = k
-        self.kv_cache[layer_idx, 1, :, :, t0:t1, :] = v
-        # Return the full cached keys/values up to current position (as a view)
-        key_view = self.kv_cache[layer_idx, 0, :, :, :t1, :]
-        value_view = self.kv_cache[layer_idx, 1, :, :, :t1, :]
+        if self.window_sizes[layer_idx] > 0:
+            key_view, value_view = self._insert_local(layer_idx, k, v, t0, t1)
+        else:
+            # Dynamically grow the cache if needed
+            if t1 > self.kv_cache.size(4):
+                t_needed = t1 + 1024 # as much as we need plus buffer of 1024
+                t_needed = (t_needed + 1023) & ~1023 # then round up to the nearest multiple of 1024
+                additional_shape = list(self.kv_cache.shape)
+                additional_shape[4] = t_needed - self.kv_cache.size(4)
+                additional_cache = torch.empty(additional_shape, dtype=k.dtype, device=k.device)
+                self.kv_cache = torch.cat([self.kv_cache, additional_cache], dim=4).contiguous()
+                self.kv_shape = self.kv_cache.shape
+            # Insert k, v into the cache
+            slot = self.global_slot[layer_idx]
+            self.kv_cache[slot, 0, :, :, t0:t1, :] = k
+            self.kv_cache[slot, 1, :, :, t0:t1, :] = v
+            # Return the full cached keys/values up to current position (as a view)
+            key_view = self.kv_cache[slot, 0, :, :, :t1, :]
+            value_view = self.kv_cache[slot, 1, :, :, :t1, :]
+        self.key_start = t1 - key_view.size(2)
         # Increment pos after the last layer of the Transformer processes
-        if layer_idx == self.kv_cache.size(0) - 1:
+        if layer_idx == self.num_layers - 1:
             self.pos = t1
         return key_view, value_view
 
@@ -179,6 +242,20 @@ def sample_next_token(logits, rng, temperature=1.0, top_k=None):
         probs = F.softmax(logits, dim=-1)
         return torch.multinomial(probs, num_samples=1, generator=rng)
 
+@torch.inference_mode()
+def logits_to_probs(logits, temperature=1.0, top_k=None):
+    """Turn logits of shape (B, vocab_size) into the distribution sample_next_token samples from."""
+    assert temperature >= 0.0, "temperature must be non-negative"
+    if temperature == 0.0:
+        # greedy decoding is a one-hot distribution on the argmax
+        probs = torch.zeros_like(logits)
+        return probs.scatter_(-1, torch.argmax(logits, dim=-1, keepdim=True), 1.0)
+    if top_k is not None:
+        k = min(top_k, logits.size(-1))
+        vals, _ = torch.topk(logits, k, dim=-1)
+        logits = logits.masked_fill(logits < vals[:, [-1]], -float('Inf'))
+    return F.softmax(logits / temperature, dim=-1)
+
 # -----------------------------------------------------------------------------
 
 class RowState:
@@ -196,26 +273,51 @@ class Engine:
         self.model = model
         self.tokenizer = tokenizer # needed for tool use
 
+    def _kv_model_kwargs(self):
+        m = self.model.config
+        return {"num_heads": m.n_kv_head, "head_dim": m.n_embd // m.n_head, "num_layers": m.n_layer, "window_sizes": m.get_window_sizes()}
+
+    def _update_state(self, state, next_token):
+        """Append next_token to a row and advance its tool use state machine."""
+        state.current_tokens.append(next_token)
+        # On <|assistant_end|> or <|bos|>, mark the row as completed
+        if next_token == self.tokenizer.encode_special("<|assistant_end|>") or next_token == self.tokenizer.get_bos_token_id():
+            state.completed = True
+        # Handle tool logic
+        if next_token == self.tokenizer.encode_special("<|python_start|>"):
+            state.in_python_block = True
+            state.python_expr_tokens = []
+        elif next_token == self.tokenizer.encode_special("<|python_end|>") and state.in_python_block:
+            state.in_python_block = False
+            if state.python_expr_tokens:
+                expr = self.tokenizer.decode(state.python_expr_tokens)
+                result = use_calculator(expr)
+                if result is not None:
+                    result_tokens = self.tokenizer.encode(str(result))
+                    state.forced_tokens.append(self.tokenizer.encode_special("<|output_start|>"))
+                    state.forced_tokens.extend(result_tokens)
+                    state.forced_tokens.append(self.tokenizer.encode_special("<|output_end|>"))
+            state.python_expr_tokens = []
+        elif state.in_python_block:
+            state.python_expr_tokens.append(next_token)
+
     @torch.inference_mode()
-    def generate(self, tokens, num_samples=1, max_tokens=None, temperature=1.0, top_k=None, seed=42):
-        """Same as generate, but does single prefill and then clones the KV cache."""
+    def generate(self, tokens, num_samples=1, max_tokens=None, temperature=1.0, top_k=None, seed=42, draft_layers=None, num_draft=4):
+        """
+        Same as generate, but does single prefill and then clones the KV cache.
+        If draft_layers is given, decoding is self-speculative (see generate_speculative).
+        """
         assert isinstance(tokens, list) and isinstance(tokens[0], int), "expecting list of ints"
+        if draft_layers is not None:
+            assert num_samples == 1, "self-speculative decoding only supports num_samples=1"
+            yield from self.generate_speculative(tokens, max_tokens=max_tokens, temperature=temperature, top_k=top_k, seed=seed, draft_layers=draft_layers, num_draft=num_draft)
+            return
         device = self.model.get_device()
         rng = torch.Generator(device=device)
         rng.manual_seed(seed)
 
-        # Get the special tokens we need to coordinate the tool use state machine
-        get_special = lambda s: self.tokenizer.encode_special(s)
-        python_start = get_special("<|python_start|>")
-        python_end = get_special("<|python_end|>")
-        output_start = get_special("<|output_start|>")
-        output_end = get_special("<|output_end|>")
-        assistant_end = get_special("<|assistant_end|>") # if sampled, ends row
-        bos = self.tokenizer.get_bos_token_id() # if sampled, ends row
-
         # 1) Run a batch 1 prefill of the prompt tokens
-        m = self.model.config
-        kv_model_kwargs = {"num_heads": m.n_kv_head, "head_dim": m.n_embd // m.n_head, "num_layers": m.n_layer}
+        kv_model_kwargs = self._kv_model_kwargs()
         kv_cache_prefill = KVCache(
             batch_size=1,
             seq_len=len(tokens),
@@ -273,28 +375,7 @@ class Engine:
                 token_masks.append(0 if is_forced else 1) # mask is 0 if forced, 1 if sampled
                 next_token = state.forced_tokens.popleft() if is_forced else sampled_tokens[i]
                 token_column.append(next_token)
-                # Update the state of this row to include the next token
-                state.current_tokens.append(next_token)
-                # On <|assistant_end|> or <|bos|>, mark the row as completed
-                if next_token == assistant_end or next_token == bos:
-                    state.completed = True
-                # Handle tool logic
-                if next_token == python_start:
-                    state.in_python_block = True
-                    state.python_expr_tokens = []
-                elif next_token == python_end and state.in_python_block:
-                    state.in_python_block = False
-                    if state.python_expr_tokens:
-                        expr = self.tokenizer.decode(state.python_expr_tokens)
-                        result = use_calculator(expr)
-                        if result is not None:
-                            result_tokens = self.tokenizer.encode(str(result))
-                            state.forced_tokens.append(output_start)
-                            state.forced_tokens.extend(result_tokens)
-                            state.forced_tokens.append(output_end)
-                    state.python_expr_tokens = []
-                elif state.in_python_block:
-                    state.python_expr_tokens.append(next_token)
+                self._update_state(state, next_token)
 
             # Yield the token column
             yield token_column, token_masks
@@ -302,6 +383,155 @@ class Engine:
             # Prepare ids for next iteration
             ids = torch.tensor(token_column, dtype=torch.long, device=device).unsqueeze(1)
 
+    @torch.inference_mode()
+    def generate_multi(self, prompts, max_tokens=None, temperature=1.0, top_k=None, seed=42):
+        """
+        Generate from several different prompts at once, one row per prompt. The prompts are left
+        padded to the same length and the padding is masked out of attention; since the rotary
+        embeddings are relative, each row comes out the same as if it was generated on its own.
+        Yields the same (token_column, token_masks) pairs as generate, until every row is completed.
+        """
+        assert isinstance(prompts, list) and all(isinstance(p, list) and p for p in prompts), "expecting a list of lists of ints"
+        device = self.model.get_device()
+        rng = torch.Generator(device=device)
+        rng.manual_seed(seed)
+
+        # 1) Prefill all the prompts at once, left padded (with bos, any token would do) to the longest one
+        num_rows = len(prompts)
+        prompt_len = max(len(p) for p in prompts)
+        pad_lens = [prompt_len - len(p) for p in prompts]
+        pad = self.tokenizer.get_bos_token_id()
+        kv_length_hint = (prompt_len + max_tokens) if max_tokens is not None else self.model.config.sequence_len
+        kv_cache = KVCache(
+            batch_size=num_rows,
+            seq_len=kv_length_hint,
+            pad_lens=torch.tensor(pad_lens, dtype=torch.long, device=device),
+            **self._kv_model_kwargs(),
+        )
+        ids = torch.tensor([[pad] * n + p for n, p in zip(pad_lens, prompts)], dtype=torch.long, device=device)
+        row_states = [RowState(p.copy()) for p in prompts]
+
+        # 2) Main generation loop, the same as in generate
+        num_generated = 0
+        while True:
+            if max_tokens is not None and num_generated >= max_tokens:
+                break
+            if all(state.completed for state in row_states):
+                break
+            logits = self.model.forward(ids, kv_cache=kv_cache)[:, -1, :] # (B, vocab_size)
+            sampled_tokens = sample_next_token(logits, rng, temperature, top_k)[:, 0].tolist()
+            token_column, token_masks = [], []
+            for i, state in enumerate(row_states):
+                is_forced = len(state.forced_tokens) > 0
+                token_masks.append(0 if is_forced else 1)
+                next_token = state.forced_tokens.popleft() if is_forced else sampled_tokens[i]
+                token_column.append(next_token)
+                self._update_state(state, next_token)
+            yield token_column, token_masks
+            num_generated += 1
+            ids = torch.tensor(token_column, dtype=torch.long, device=device).unsqueeze(1)
+
+    @torch.inference_mode()
+    def generate_speculative(self, tokens, max_tokens=None, temperature=1.0, top_k=None, seed=42, draft_layers=2, num_draft=4):
+        """
+        Self-speculative decoding with a single row. The first draft_layers blocks of the model
+        (plus the final norm/lm_head) act as a cheap draft model that proposes num_draft tokens,
+        then the remaining blocks verify them all in one chunk, resuming from the hidden states
+        of the draft and reusing the KV entries the shallow layers wrote while drafting.
+        Tokens are accepted with the usual speculative sampling rule, so the output follows the
+        same distribution as generate (and is identical at temperature=0).
+        Yields the same (token_column, token_masks) pairs as generate, one token at a time.
+        """
+        assert isinstance(tokens, list) and isinstance(tokens[0], int), "expecting list of ints"
+        assert num_draft >= 1, "num_draft must be at least 1"
+        # rewinding over rejected drafts needs the sliding window layers to still hold those positions
+        assert num_draft <= KVCache.WINDOW_SLACK, f"num_draft must be at most {KVCache.WINDOW_SLACK} (KVCache.WINDOW_SLACK)"
+        model = self.model
+        device = model.get_device()
+        rng = torch.Generator(device=device)
+        rng.manual_seed(seed)
+        probs_kwargs = dict(temperature=temperature, top_k=top_k)
+
+        # 1) Run a full prefill of the prompt tokens and sample the first token
+        kv_length_hint = (len(tokens) + max_tokens + num_draft) if max_tokens is not None else model.config.sequence_len
+        kv_cache = KVCache(batch_size=1, seq_len=kv_length_hint, **self._kv_model_kwargs())
+        ids = torch.tensor([tokens], dtype=torch.long, device=device)
+        logits = model.forward(ids, kv_cache=kv_cache)
+        first_token = sample_next_token(logits[:, -1, :], rng, temperature, top_k)[0, 0].item()
+        if max_tokens is not None and max_tokens <= 0:
+            return
+        state = RowState(tokens.copy())
+        self._update_state(state, first_token)
+        yield [first_token], [1]
+        num_generated = 1
+
+        # pending holds the tokens that were emitted already but are not yet in the KV cache.
+        # The most recently emitted token is always re-fed, which keeps the cache bookkeeping simple.
+        pending = [first_token]
+        while True:
+            # 2) Emit forced tool output tokens, they need no model call
+            while state.forced_tokens and not state.completed:
+                if max_tokens is not None and num_generated >= max_tokens:
+                    return
+                next_token = state.forced_tokens.popleft()
+                self._update_state(state, next_token)
+                pending.append(next_token)
+                yield [next_token], [0]
+                num_generated += 1
+            if state.completed or (max_tokens is not None and num_generated >= max_tokens):
+                return
+
+            # 3) Draft num_draft tokens with the shallow layers, keeping their hidden states
+            pos = kv_cache.get_pos()
+            ids = torch.tensor([pending], dtype=torch.long, device=device)
+            draft_tokens, draft_probs, hiddens = [], [], []
+            for i in range(num_draft):
+                logits, hidden = model.forward_draft(ids, kv_cache, draft_layers)
+                hiddens.append(hidden)
+                probs = logits_to_probs(logits[:, -1, :], **probs_kwargs) # (1, vocab_size)
+                next_ids = torch.multinomial(probs, num_samples=1, generator=rng) # (1, 1)
+                draft_tokens.append(next_ids[0, 0].item())
+                draft_probs.append(probs)
+                ids = next_ids
+            # the last draft token never went through the model: it is verified by the logits before it
+
+            # 4) Verify all drafts at once with the deep layers, resuming from the drafted hidden states
+            kv_cache.set_pos(pos)
+            logits = model.forward_verify(torch.cat(hiddens, dim=1), kv_cache, draft_layers)
+            target_probs = logits_to_probs(logits[0, len(pending) - 1:, :], **probs_kwargs) # (num_draft, vocab_size)
+            draft_probs = torch.cat(draft_probs, dim=0) # (num_draft, vocab_size)
+            draft_ids = torch.tensor(draft_tokens, dtype=torch.long, device=device).unsqueeze(1)
+            p = target_probs.gather(1, draft_ids).squeeze(1)
+            q = draft_probs.gather(1, draft_ids).squeeze(1)
+            u = torch.rand(num_draft, generator=rng, device=device)
+            rejected = (u * q >= p).tolist() # accept with probability min(1, p/q)
+            num_accepted = rejected.index(True) if True in rejected else num_draft
+            accepted = draft_tokens[:num_accepted]
+            if num_accepted < num_draft:
+                # on rejection, resample from the residual distribution max(0, p - q)
+                residual = (target_probs[num_accepted] - draft_probs[num_accepted]).clamp(min=0)
+                if residual.sum() <= 0: # numerically p == q, fall back to p itself
+                    residual = target_probs[num_accepted]
+                correction = torch.multinomial(residual.unsqueeze(0), num_samples=1, generator=rng)
+                accepted.append(correction[0, 0].item())
+
+            # 5) Emit the accepted tokens, stopping early on completion or tool use
+            num_emitted = 0
+            for next_token in accepted:
+                if max_tokens is not None and num_generated >= max_tokens:
+                    break
+                self._update_state(state, next_token)
+                yield [next_token], [1]
+                num_generated += 1
+                num_emitted += 1
+                if state.completed or state.forced_tokens:
+                    break
+            if num_emitted == 0:
+                return
+            # every emitted token but the last one is already in the KV cache
+            kv_cache.set_pos(pos + len(pending) + num_emitted - 1)
+            pending = [accepted[num_emitted - 1]]
+
     def generate_batch(self, tokens, num_samples=1, **kwargs):
         """
         Non-streaming batch generation that just returns the final token sequences.
@@ -382,3 +612,19 @@ if __name__ == "__main__":
             print(f"Mismatch at {i}: {reference_ids[i]} != {generated_tokens[i]}")
             break
     print(f"Match: {reference_ids == generated_tokens}")
+    # generate tokens with self-speculative decoding, drafting with the first half of the layers
+    generated_tokens = []
+    stream = engine.generate(prompt_tokens, num_samples=1, draft_layers=model.config.n_layer // 2, **kwargs)
+    torch.cuda.synchronize()
+    t0 = time.time()
+    with autocast_ctx:
+        for token_column, token_masks in stream:
+            token = token_column[0]
+            generated_tokens.append(token)
+            chunk = tokenizer.decode([token])
+            print(chunk, end="", flush=True)
+    print()
+    torch.cuda.synchronize()
+    t1 = time.time()
+    print(f"Speculative time: {t1 - t0:.2f}s")
+    print(f"Match: {reference_ids == generated_tokens}")
@@ -9,6 +9,7 @@ Notable features:
 - no learnable params in rmsnorm
 - no bias in linear layers
 - Group-Query Attention (GQA) support for more efficient inference
+- optional sliding window (local) attention on a subset of the layers
 """
 
 import math
@@ -32,6 +33,18 @@ class GPTConfig:
     n_head: int = 6 # number of query heads
     n_kv_head: int = 6 # number of key/value heads (GQA)
     n_embd: int = 768
+    sliding_window: int = 0 # attention window (in tokens) of the local layers (0 = every layer attends to the full context)
+    window_pattern: str = "LLLG" # tiled across the layers: L = local (sliding window) layer, G = global (full causal) layer
+
+    def __post_init__(self):
+        assert self.window_pattern and set(self.window_pattern) <= {"L", "G"}, f"Invalid window_pattern: {self.window_pattern}"
+
+    def get_window_sizes(self):
+        # the attention window of each layer, 0 means full causal attention
+        if self.sliding_window <= 0:
+            return [0] * self.n_layer
+        pattern = self.window_pattern
+        return [self.sliding_window if pattern[i % len(pattern)] == "L" else 0 for i in range(self.n_layer)]
 
 
 # @def:rms_norm
@@ -51,11 +64,35 @@ def apply_rotary_emb(x, cos, sin):
     out = out.to(x.dtype) # ensure input/output dtypes match
     return out
 
+# @learn:attention.sliding_window
+def sliding_window_mask(Tq, Tk, window, device):
+    # The queries are the last Tq of the Tk positions (the keys before them come from the KV cache).
+    # Query i sits at position Tk - Tq + i and attends to key j iff 0 <= (Tk - Tq + i) - j < window.
+    q_pos = torch.arange(Tk - Tq, Tk, device=device)
+    k_pos = torch.arange(Tk, device=device)
+    diff = q_pos[:, None] - k_pos[None, :]
+    return (diff >= 0) & (diff < window) # True = keep, False = mask
+
+def padded_attention_mask(Tq, Tk, key_start, pad_lens, window, device):
+    # Attention mask of a batch of left padded rows (row b starts with pad_lens[b] padding positions).
+    # The keys sit at absolute positions key_start.. and the queries are the last Tq of them.
+    # Padding keys are masked, except for the padding query at the same position, so that no query
+    # ends up with nothing to attend to (which would turn its output, and later its keys/values, into NaNs).
+    k_pos = torch.arange(key_start, key_start + Tk, device=device)
+    diff = k_pos[Tk - Tq:, None] - k_pos[None, :] # (Tq, Tk) query position - key position
+    keep = diff >= 0
+    if window > 0:
+        keep = keep & (diff < window)
+    not_pad = k_pos[None, :] >= pad_lens[:, None] # (B, Tk)
+    keep = keep[None] & (not_pad[:, None, :] | (diff == 0)[None]) # (B, Tq, Tk)
+    return keep.unsqueeze(1) # (B, 1, Tq, Tk) broadcasts over the heads
+
 # @learn:attention.self_attention
 class CausalSelfAttention(nn.Module):
     def __init__(self, config, layer_idx):
         super().__init__()
         self.layer_idx = layer_idx
+        self.window = config.get_window_sizes()[layer_idx] # 0 = full causal attention
         self.n_head = config.n_head
         self.n_kv_head = config.n_kv_head
         self.n_embd = config.n_embd
@@ -90,7 +127,16 @@ class CausalSelfAttention(nn.Module):
         # Attention: queries attend to keys/values autoregressively. A few cases to handle:
         # @learn:attention.gqa
         enable_gqa = self.n_head != self.n_kv_head # Group Query Attention (GQA): duplicate key/value heads to match query heads if desired
-        if kv_cache is None or Tq == Tk:
+        if kv_cache is not None and kv_cache.pad_lens is not None:
+            # Batch of different prompts, left padded to the same length: mask the padding per row
+            attn_mask = padded_attention_mask(Tq, Tk, kv_cache.key_start, kv_cache.pad_lens, self.window, q.device)
+            y = F.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask, enable_gqa=enable_gqa)
+        elif self.window > 0 and Tk > self.window:
+            # Sliding window layer and some query could see further back than the window: use a banded causal mask.
+            # (the KV cache only hands back the keys the window needs, so single token decoding never lands here)
+            attn_mask = sliding_window_mask(Tq, Tk, self.window, q.device)
+            y = F.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask, enable_gqa=enable_gqa)
+        elif kv_cache is None or Tq == Tk:
             # During training (no KV cache), attend as usual with causal attention
             # And even if there is KV cache, we can still use this simple version when Tq == Tk
             y = F.scaled_dot_product_attention(q, k, v, is_causal=True, enable_gqa=enable_gqa)
@@ -214,8 +260,10 @@ class GPT(nn.Module):
         """ Return the estimated FLOPs per token for the model. Ref: https://arxiv.org/abs/2204.02311 """
         nparams = sum(p.numel() for p in self.parameters())
         nparams_embedding = self.transformer.wte.weight.numel()
-        l, h, q, t = self.config.n_layer, self.config.n_head, self.config.n_embd // self.config.n_head, self.config.sequence_len
-        num_flops_per_token = 6 * (nparams - nparams_embedding) + 12 * l * h * q * t
+        h, q, t = self.config.n_head, self.config.n_embd // self.config.n_head, self.config.sequence_len
+        # sliding window layers only attend to (at most) window keys per query
+        attn_t = sum(min(w, t) if w > 0 else t for w in self.config.get_window_sizes())
+        num_flops_per_token = 6 * (nparams - nparams_embedding) + 12 * h * q * attn_t
         return num_flops_per_token
 
     # @learn:optimization.setup
@@ -250,30 +298,36 @@ class GPT(nn.Module):
                 group["initial_lr"] = group["lr"]
         return optimizers
 
-    def forward(self, idx, targets=None, kv_cache=None, loss_reduction='mean'):
-        B, T = idx.size()
-
+    def _rotary_slice(self, T, kv_cache, device):
         # Grab the rotary embeddings for the current sequence length (they are of shape (1, seq_len, 1, head_dim/2))
-        assert T <= self.cos.size(1), f"Sequence length grew beyond the rotary embeddings cache: {T} > {self.cos.size(1)}"
-        assert idx.device == self.cos.device, f"Rotary embeddings and idx are on different devices: {idx.device} != {self.cos.device}"
-        assert self.cos.dtype == torch.bfloat16, "Rotary embeddings must be in bfloat16"
         # if kv cache exists, we need to offset the rotary embeddings to the current position in the cache
         T0 = 0 if kv_cache is None else kv_cache.get_pos()
-        cos_sin = self.cos[:, T0:T0+T], self.sin[:, T0:T0+T] # truncate cache to current sequence length
-
-        # Forward the trunk of the Transformer
-        x = self.transformer.wte(idx)
-        x = norm(x)
-        for block in self.transformer.h:
-            x = block(x, cos_sin, kv_cache)
-        x = norm(x)
+        assert T0 + T <= self.cos.size(1), f"Sequence length grew beyond the rotary embeddings cache: {T0 + T} > {self.cos.size(1)}"
+        assert device == self.cos.device, f"Rotary embeddings and idx are on different devices: {device} != {self.cos.device}"
+        assert self.cos.dtype == torch.bfloat16, "Rotary embeddings must be in bfloat16"
+        return self.cos[:, T0:T0+T], self.sin[:, T0:T0+T] # truncate cache to current sequence length
 
+    def _lm_head(self, x):
         # Forward the lm_head (compute logits)
+        x = norm(x)
         # @learn:optimization.logit_softcapping
         softcap = 15 # smoothly cap the logits to the range [-softcap, softcap]
         logits = self.lm_head(x) # (B, T, vocab_size) <- very big tensor, large amount of memory
         logits = logits.float() # switch to fp32 for logit softcap and loss computation
         logits = softcap * torch.tanh(logits / softcap) # squash the logits
+        return logits
+
+    def forward(self, idx, targets=None, kv_cache=None, loss_reduction='mean', exit_layer=None):
+        B, T = idx.size()
+        cos_sin = self._rotary_slice(T, kv_cache, idx.device)
+
+        # Forward the trunk of the Transformer
+        # If exit_layer is given, only the first exit_layer blocks are used (early exit, see forward_draft)
+        x = self.transformer.wte(idx)
+        x = norm(x)
+        for block in self.transformer.h[:exit_layer]:
+            x = block(x, cos_sin, kv_cache)
+        logits = self._lm_head(x)
 
         if targets is not None:
             # training: given the targets, compute and return the loss
@@ -284,6 +338,39 @@ class GPT(nn.Module):
             # inference: just return the logits directly
             return logits
 
+    # @learn:inference.speculative
+    def forward_draft(self, idx, kv_cache, exit_layer):
+        """
+        Early-exit forward used as the draft model of self-speculative decoding:
+        only the first exit_layer blocks run, followed by the usual final norm and lm_head.
+        The KV cache position advances past idx even though the deeper layers were skipped,
+        so that consecutive draft calls chain up. Returns (logits, hidden) where hidden is the
+        residual stream after block exit_layer-1, which forward_verify later resumes from.
+        """
+        assert 0 < exit_layer < self.config.n_layer, f"exit_layer must be in (0, {self.config.n_layer}), got {exit_layer}"
+        B, T = idx.size()
+        T0 = kv_cache.get_pos()
+        cos_sin = self._rotary_slice(T, kv_cache, idx.device)
+        x = self.transformer.wte(idx)
+        x = norm(x)
+        for block in self.transformer.h[:exit_layer]:
+            x = block(x, cos_sin, kv_cache)
+        kv_cache.set_pos(T0 + T) # the last layer didn't run, so we advance the position ourselves
+        return self._lm_head(x), x
+
+    def forward_verify(self, hidden, kv_cache, exit_layer):
+        """
+        Complete a forward pass from the hidden states cached by forward_draft, running only
+        blocks exit_layer and up. The shallow layers' KV entries written while drafting are reused,
+        so the caller must first rewind the KV cache to the position of hidden[:, 0].
+        """
+        B, T, C = hidden.size()
+        cos_sin = self._rotary_slice(T, kv_cache, hidden.device)
+        x = hidden
+        for block in self.transformer.h[exit_layer:]:
+            x = block(x, cos_sin, kv_cache)
+        return self._lm_head(x)
+
     @torch.inference_mode()
     def generate(self, tokens, max_tokens, temperature=1.0, top_k=None, seed=42):
         """
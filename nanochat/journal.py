@@ -0,0 +1,70 @@
+"""
+Request journal of the chat server: one JSON line per request, for offline analysis and replay.
+
+Each record holds the arrival time, the token counts, the sampling parameters, the outcome and the
+timing breakdown of a request (queue wait, time to first token, duration), and optionally its content.
+See scripts/replay.py, which re-issues a recorded journal against a server or an Engine.
+
+{"arrival": 1718000000.123, "model": "sft", "status": "ok", "prompt_tokens": 52, "completion_tokens": 117,
+ "temperature": 0.8, "top_k": 50, "max_tokens": 512, "priority": "default", "queue_wait": 0.002, "ttft": 0.031, "duration": 1.204}
+
+Recording is cheap on the request path: record() appends to an in-memory buffer, and a background
+thread writes the buffer out in batches, every flush_interval seconds or max_batch records.
+"""
+
+import json
+import threading
+
+class RequestJournal:
+
+    def __init__(self, path, include_content=False, flush_interval=1.0, max_batch=256):
+        self.path = path
+        self.include_content = include_content # also record the messages and responses
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.buffer = []
+        self.lock = threading.Lock()
+        self.wakeup = threading.Condition(self.lock)
+        self.closed = False
+        self.num_written = 0
+        self.thread = threading.Thread(target=self._writer, name="request-journal", daemon=True)
+        self.thread.start()
+
+    def record(self, record):
+        """Add a record, it is written in the background."""
+        with self.lock:
+            self.buffer.append(record)
+            if len(self.buffer) >= self.max_batch:
+                self.wakeup.notify()
+
+    def close(self):
+        """Write out what is buffered and stop the writer thread."""
+        with self.lock:
+            self.closed = True
+            self.wakeup.notify()
+        self.thread.join()
+
+    def _writer(self):
+        with open(self.path, "a", encoding="utf-8") as f:
+            while True:
+                with self.lock:
+                    if not self.closed and len(self.buffer) < self.max_batch:
+                        self.wakeup.wait(self.flush_interval)
+                    batch, self.buffer = self.buffer, []
+                    closed = self.closed
+                if batch:
+                    f.write("".join(json.dumps(record, ensure_ascii=False) + "\n" for record in batch))
+                    f.flush()
+                    self.num_written += len(batch)
+                if closed:
+                    return
+
+def read_journal(path):
+    """The records of a journal, in arrival order."""
+    records = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.endswith("\n") and line.strip(): # skip a partially written last line
+                records.append(json.loads(line))
+    records.sort(key=lambda record: record["arrival"])
+    return records
@@ -0,0 +1,126 @@
+"""
+Measuring the chat API from the client side: streaming requests, and their latency statistics.
+Shared by scripts/replay.py (replaying a request journal) and scripts/loadgen.py (synthetic load).
+
+A request is timed from the moment it is sent: time to first token (TTFT), the gaps between
+consecutive token events (inter-token latency, ITL) and the total duration. Note that under load
+the server coalesces several tokens into one event, the ITL is then the time between events.
+"""
+
+import json
+import math
+import time
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+PERCENTILES = (50, 90, 95, 99)
+
+@dataclass
+class RequestResult:
+    ok: bool
+    status: int = 200 # HTTP status
+    ttft: Optional[float] = None # seconds
+    itls: List[float] = field(default_factory=list) # seconds between token events
+    duration: Optional[float] = None # seconds
+    num_tokens: int = 0 # generated tokens (token events, when measured over HTTP)
+    num_chars: int = 0 # generated characters
+    error: Optional[str] = None
+
+class RequestTimer:
+    """Times the tokens of one streaming request, as they arrive."""
+
+    def __init__(self, t0=None):
+        self.t0 = time.perf_counter() if t0 is None else t0 # e.g. the scheduled arrival, to count queueing in
+        self.last = None
+        self.result = RequestResult(ok=True)
+
+    def token(self, text="", num_tokens=1):
+        now = time.perf_counter()
+        if self.last is None:
+            self.result.ttft = now - self.t0
+        else:
+            self.result.itls.append(now - self.last)
+        self.last = now
+        self.result.num_tokens += num_tokens
+        self.result.num_chars += len(text)
+
+    def finish(self, ok=True, status=200, error=None):
+        self.result.duration = time.perf_counter() - self.t0
+        self.result.ok, self.result.status, self.result.error = ok, status, error
+        return self.result
+
+async def stream_chat(session, url, payload):
+    """POST a chat request to a chat_web server (an aiohttp session) and time its SSE response."""
+    timer = RequestTimer()
+    try:
+        async with session.post(f"{url.rstrip('/')}/chat/completions", json=payload) as resp:
+            if resp.status != 200:
+                return timer.finish(ok=False, status=resp.status, error=(await resp.text())[:200])
+            buffer = b""
+            async for chunk in resp.content.iter_any():
+                buffer += chunk
+                while b"\n\n" in buffer:
+                    event, buffer = buffer.split(b"\n\n", 1)
+                    if not event.startswith(b"data: "):
+                        continue
+                    data = json.loads(event[len(b"data: "):])
+                    if "token" in data:
+                        timer.token(data["token"])
+                    elif data.get("done"):
+                        return timer.finish()
+            return timer.finish(ok=False, error="Stream ended without a done event")
+    except Exception as e:
+        return timer.finish(ok=False, status=0, error=f"{type(e).__name__}: {e}")
+
+def percentiles(values, ps=PERCENTILES):
+    """Percentiles by the nearest rank method, None if there are no values."""
+    values = sorted(values)
+    summary = {}
+    for p in ps:
+        # the smallest value with at least p% of the values at or below it
+        summary[f"p{p}"] = values[max(math.ceil(len(values) * p / 100) - 1, 0)] if values else None
+    summary["mean"] = sum(values) / len(values) if values else None
+    return summary
+
+def summarize(results, wall_time):
+    """Latency percentiles, throughput and errors of a run."""
+    ok = [r for r in results if r.ok]
+    errors = {}
+    for r in results:
+        if not r.ok:
+            errors[str(r.status)] = errors.get(str(r.status), 0) + 1
+    num_tokens = sum(r.num_tokens for r in ok)
+    return {
+        "num_requests": len(results),
+        "num_ok": len(ok),
+        "error_rate": (len(results) - len(ok)) / len(results) if results else 0.0,
+        "errors": errors,
+        "wall_time": wall_time,
+        "requests_per_second": len(ok) / wall_time if wall_time > 0 else None,
+        "tokens_per_second": num_tokens / wall_time if wall_time > 0 else None,
+        "ttft": percentiles([r.ttft for r in ok if r.ttft is not None]),
+        "itl": percentiles([itl for r in ok for itl in r.itls]),
+        "duration": percentiles([r.duration for r in ok]),
+        "tokens_per_request": percentiles([r.num_tokens for r in ok]),
+    }
+
+def format_markdown(summary, title="Load test"):
+    """The summary of a run as a markdown report."""
+    def ms(value):
+        return "-" if value is None else f"{value * 1000:.1f}"
+    def num(value, fmt=".2f"):
+        return "-" if value is None else format(value, fmt)
+    lines = [
+        f"## {title}",
+        "",
+        f"- requests: {summary['num_requests']} ({summary['num_ok']} ok, error rate {summary['error_rate']:.2%})",
+        f"- wall time: {summary['wall_time']:.2f}s",
+        f"- throughput: {num(summary['requests_per_second'])} requests/s, {num(summary['tokens_per_second'], '.1f')} tokens/s",
+    ]
+    if summary["errors"]:
+        lines.append("- errors by status: " + ", ".join(f"{status}: {count}" for status, count in sorted(summary["errors"].items())))
+    keys = [f"p{p}" for p in PERCENTILES] + ["mean"]
+    lines += ["", "| metric (ms) | " + " | ".join(keys) + " |", "|---" * (len(keys) + 1) + "|"]
+    for name in ["ttft", "itl", "duration"]:
+        lines.append(f"| {name} | " + " | ".join(ms(summary[name][k]) for k in keys) + " |")
+    return "\n".join(lines) + "\n"
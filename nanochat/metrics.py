@@ -0,0 +1,244 @@
+"""
+Minimal Prometheus metrics for serving, rendered in the Prometheus text exposition format.
+No dependency on prometheus_client: the server only needs counters, gauges and histograms,
+and recording a sample is a couple of list operations, cheap enough to do for every token.
+
+Everything is updated from the event loop thread, so there is no locking.
+"""
+
+import bisect
+import time
+
+# Default histogram buckets in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+TOKEN_LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.02, 0.03, 0.05, 0.075, 0.1, 0.25, 0.5, 1.0)
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escape = lambda v: str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+    return "{" + ",".join(f'{k}="{escape(v)}"' for k, v in pairs) + "}"
+
+class Metric:
+    """A metric family: one child per combination of label values."""
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.children = {}
+        # an unlabeled metric is its own single child, used directly by inc/set/observe
+        self.default = None if self.labelnames else self.labels()
+
+    def labels(self, *values):
+        values = tuple(str(v) for v in values)
+        assert len(values) == len(self.labelnames), f"{self.name} expects labels {self.labelnames}"
+        child = self.children.get(values)
+        if child is None:
+            child = self.children[values] = self.new_child()
+        return child
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for values, child in self.children.items():
+            for suffix, extra, value in child.samples():
+                lines.append(f"{self.name}{suffix}{_format_labels(self.labelnames, values, extra)} {_format_value(value)}")
+        return lines
+
+class _Value:
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def set(self, value):
+        self.value = value
+
+    def samples(self):
+        return [("", (), self.value)]
+
+class Counter(Metric):
+    kind = "counter"
+    new_child = _Value
+
+    def inc(self, amount=1):
+        self.default.value += amount
+
+class Gauge(Metric):
+    kind = "gauge"
+    new_child = _Value
+
+    def set(self, value):
+        self.default.value = value
+
+class _HistogramValue:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # the last one is the +Inf bucket
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def samples(self):
+        samples, cumulative = [], 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            cumulative += count
+            samples.append(("_bucket", (("le", _format_value(bound)),), cumulative))
+        samples.append(("_sum", (), self.sum))
+        samples.append(("_count", (), cumulative))
+        return samples
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames)
+
+    def new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value):
+        self.default.observe(value)
+
+class Registry:
+    """A set of metrics, plus callbacks that refresh gauges right before rendering."""
+
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def register(self, metric):
+        assert all(m.name != metric.name for m in self.metrics), f"Duplicate metric {metric.name}"
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, *args, **kwargs):
+        return self.register(Counter(*args, **kwargs))
+
+    def gauge(self, *args, **kwargs):
+        return self.register(Gauge(*args, **kwargs))
+
+    def histogram(self, *args, **kwargs):
+        return self.register(Histogram(*args, **kwargs))
+
+    def render(self):
+        for collect in self.collectors:
+            collect()
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+# -----------------------------------------------------------------------------
+# The metrics of the chat server
+
+class WorkerMeter:
+    """Busy time of a worker, it is busy whenever at least one request runs on it."""
+
+    def __init__(self):
+        self.active = 0
+        self.busy_seconds = 0.0
+        self.busy_since = None
+
+    def start(self):
+        if self.active == 0:
+            self.busy_since = time.monotonic()
+        self.active += 1
+
+    def stop(self):
+        self.active -= 1
+        if self.active == 0:
+            self.busy_seconds += time.monotonic() - self.busy_since
+            self.busy_since = None
+
+    def total_busy_seconds(self):
+        ongoing = 0.0 if self.busy_since is None else time.monotonic() - self.busy_since
+        return self.busy_seconds + ongoing
+
+class ServingMetrics:
+    """
+    Latency histograms and token counters of the chat server. The per-worker tokens/s and
+    utilization gauges are averaged since the previous scrape, the matching counters
+    (nanochat_worker_*_total) are there for rate() over any other window.
+    """
+
+    def __init__(self, num_workers=0):
+        self.registry = r = Registry()
+        self.queue_wait = r.histogram("nanochat_queue_wait_seconds", "Time requests wait for a worker.")
+        self.ttft = r.histogram("nanochat_time_to_first_token_seconds", "Time from request arrival to its first generated token.")
+        self.itl = r.histogram("nanochat_inter_token_latency_seconds", "Time between consecutive generated tokens of a request.", buckets=TOKEN_LATENCY_BUCKETS)
+        self.e2e = r.histogram("nanochat_request_duration_seconds", "Time from request arrival to the end of its response.")
+        self.requests = r.counter("nanochat_requests_total", "Requests by outcome.", labelnames=("status",))
+        self.prompt_tokens = r.counter("nanochat_prompt_tokens_total", "Prompt tokens of the requests that got a worker.")
+        self.generated_tokens = r.counter("nanochat_generation_tokens_total", "Generated tokens.")
+        self.worker_tokens = r.counter("nanochat_worker_generation_tokens_total", "Generated tokens per worker.", labelnames=("worker",))
+        self.worker_busy = r.counter("nanochat_worker_busy_seconds_total", "Time each worker had at least one request running.", labelnames=("worker",))
+        self.worker_tps = r.gauge("nanochat_worker_tokens_per_second", "Generated tokens per second of each worker since the previous scrape.", labelnames=("worker",))
+        self.worker_util = r.gauge("nanochat_worker_utilization", "Fraction of time each worker was busy since the previous scrape.", labelnames=("worker",))
+        # per worker, keyed by its worker label (e.g. its index, or model/index when serving several models)
+        self.meters = {}
+        self.worker_token_counters = {} # hot path handles, so that recording a token is a couple of lookups
+        self.last_scrape = (time.monotonic(), {}, {}) # time, tokens, busy seconds
+        for i in range(num_workers):
+            self.add_worker(i)
+        r.collectors.append(self.collect)
+
+    def add_worker(self, key):
+        self.meters[key] = WorkerMeter()
+        self.worker_token_counters[key] = self.worker_tokens.labels(key)
+
+    def remove_worker(self, key):
+        """Forget a worker (e.g. its model was unloaded), its series disappear from the output."""
+        del self.meters[key]
+        del self.worker_token_counters[key]
+        for metric in (self.worker_tokens, self.worker_busy, self.worker_tps, self.worker_util):
+            metric.children.pop((str(key),), None)
+
+    def request_started(self, worker_key, queue_wait, prompt_tokens):
+        self.queue_wait.observe(queue_wait)
+        self.prompt_tokens.inc(prompt_tokens)
+        self.meters[worker_key].start()
+
+    def token(self, worker_key, num_tokens=1):
+        self.generated_tokens.default.value += num_tokens
+        self.worker_token_counters[worker_key].value += num_tokens
+
+    def first_token(self, arrived, now=None):
+        """Record the first token of a request that arrived at time.monotonic() arrived, return its time to first token."""
+        ttft = (time.monotonic() if now is None else now) - arrived
+        self.ttft.observe(ttft)
+        return ttft
+
+    def request_finished(self, worker_key, arrived, status="ok"):
+        """Record the end of a request, its duration counts from its time.monotonic() arrival like the time to first token."""
+        self.e2e.observe(time.monotonic() - arrived)
+        self.requests.labels(status).inc()
+        self.meters[worker_key].stop()
+
+    def collect(self):
+        now = time.monotonic()
+        last_time, last_tokens, last_busy = self.last_scrape
+        elapsed = max(now - last_time, 1e-9)
+        tokens = {key: c.value for key, c in self.worker_token_counters.items()}
+        busy = {key: m.total_busy_seconds() for key, m in self.meters.items()}
+        for key in self.meters:
+            self.worker_busy.labels(key).set(busy[key])
+            self.worker_tps.labels(key).set((tokens[key] - last_tokens.get(key, 0.0)) / elapsed)
+            self.worker_util.labels(key).set(min((busy[key] - last_busy.get(key, 0.0)) / elapsed, 1.0))
+        self.last_scrape = (now, tokens, busy)
+
+    def render(self):
+        return self.registry.render()
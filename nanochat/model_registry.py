@@ -0,0 +1,163 @@
+"""
+Registry of the models a server can serve, loaded on demand and evicted under a memory budget.
+
+Each model is a named checkpoint (source, model tag, step). A request names the model it wants:
+- a loaded model is handed out right away (and becomes the most recently used one);
+- a model that is not loaded starts loading in the background, requests for it wait for the load
+  to finish while the requests of the other models keep being served;
+- before loading, the least recently used idle models are evicted until the estimated memory of
+  the new one fits in the budget. A model with requests in flight (acquired, not yet released) is
+  never evicted, if the budget cannot be met without evicting one, ModelBudgetError is raised.
+
+The registry does not know what a loaded model is: load_fn(spec) loads one (async, it is expected
+to do the heavy lifting off the event loop) and returns an object with a memory_bytes attribute
+and a close() method. Everything here runs on the event loop thread, so there is no locking.
+"""
+
+import asyncio
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Optional
+
+class UnknownModelError(Exception):
+    """The request names a model the registry does not have."""
+
+class ModelBudgetError(Exception):
+    """The model does not fit in the memory budget without evicting a model that is in use."""
+
+@dataclass(frozen=True)
+class ModelSpec:
+    name: str
+    source: str
+    model_tag: Optional[str] = None
+    step: Optional[int] = None
+
+def parse_model_spec(spec):
+    """
+    Parse name=source[:model_tag[:step]], e.g. "rl=rl", "big=sft:d32:800" or "sft::650" (the name
+    defaults to the source, the model tag and step to the largest model and its last step).
+    """
+    name, _, checkpoint = spec.rpartition("=")
+    source, model_tag, step = (checkpoint.split(":") + [None, None])[:3]
+    return ModelSpec(name or source, source, model_tag or None, int(step) if step else None)
+
+class _Entry:
+    def __init__(self, model):
+        self.model = model
+        self.refs = 0 # requests in flight
+
+class ModelRegistry:
+
+    def __init__(self, specs, load_fn, estimate_fn, memory_budget=0):
+        assert specs, "At least one model is required"
+        self.specs = {spec.name: spec for spec in specs}
+        assert len(self.specs) == len(specs), "Model names must be unique"
+        self.default = specs[0].name
+        self.load_fn = load_fn # async spec -> model
+        self.estimate_fn = estimate_fn # spec -> estimated memory_bytes, before loading
+        self.memory_budget = memory_budget # bytes, 0 = unlimited
+        self.loaded = OrderedDict() # name -> _Entry, least recently used first
+        self.loading = {} # name -> (task, estimated bytes)
+        self.num_loads = 0
+        self.num_evictions = 0
+        # name -> response cache of the model, set by the server once the model is loaded. It is kept
+        # when the model is evicted, so that its cached responses are served without reloading it
+        self.response_caches = {}
+
+    def resolve(self, name):
+        name = name or self.default
+        if name not in self.specs:
+            raise UnknownModelError(f"Unknown model: {name}. Available: {', '.join(self.specs)}")
+        return name
+
+    async def acquire(self, name=None):
+        """The loaded model of the given name (or the default one), loading it first if need be. Pair with release()."""
+        name = self.resolve(name)
+        # (a loop: a freshly loaded model is idle, another load may evict it before its waiters wake up)
+        while name not in self.loaded:
+            if name not in self.loading:
+                self._start_loading(name)
+            task, _ = self.loading[name]
+            await asyncio.shield(task) # a waiter that goes away does not cancel the load for the others
+        entry = self.loaded[name]
+        entry.refs += 1
+        self.loaded.move_to_end(name)
+        return entry.model
+
+    def release(self, model):
+        for entry in self.loaded.values():
+            if entry.model is model:
+                entry.refs -= 1
+                return
+
+    def used_bytes(self):
+        return sum(entry.model.memory_bytes for entry in self.loaded.values()) + sum(estimate for _, estimate in self.loading.values())
+
+    def state(self):
+        models = []
+        for name, spec in self.specs.items():
+            entry = self.loaded.get(name)
+            models.append({
+                "name": name,
+                "source": spec.source,
+                "model_tag": spec.model_tag,
+                "step": spec.step,
+                "status": "loaded" if entry else "loading" if name in self.loading else "unloaded",
+                "memory_bytes": entry.model.memory_bytes if entry else None,
+                "active_requests": entry.refs if entry else 0,
+            })
+        return {
+            "default": self.default,
+            "memory_budget": self.memory_budget,
+            "memory_used": self.used_bytes(),
+            "num_loads": self.num_loads,
+            "num_evictions": self.num_evictions,
+            "models": models,
+        }
+
+    def close(self):
+        for task, _ in self.loading.values():
+            task.cancel()
+        for entry in self.loaded.values():
+            entry.model.close()
+        self.loaded.clear()
+
+    # -------------------------------------------------------------------------
+    # internals
+
+    def _start_loading(self, name):
+        spec = self.specs[name]
+        estimate = self.estimate_fn(spec)
+        self._make_room(estimate, keep=name)
+        task = asyncio.ensure_future(self._load(name, spec))
+        self.loading[name] = (task, estimate)
+
+    async def _load(self, name, spec):
+        try:
+            model = await self.load_fn(spec)
+        finally:
+            del self.loading[name]
+        self.loaded[name] = _Entry(model)
+        self.num_loads += 1
+        # the estimate may have been off, catch up on eviction (best effort, the model is loaded by now)
+        try:
+            self._make_room(0, keep=name)
+        except ModelBudgetError:
+            pass
+
+    def _make_room(self, num_bytes, keep):
+        if self.memory_budget <= 0:
+            return
+        for name in list(self.loaded):
+            if self.used_bytes() + num_bytes <= self.memory_budget:
+                return
+            entry = self.loaded[name]
+            if name != keep and entry.refs == 0:
+                self._evict(name)
+        if self.used_bytes() + num_bytes > self.memory_budget:
+            raise ModelBudgetError(f"Model memory budget exceeded ({self.used_bytes()} + {num_bytes} > {self.memory_budget} bytes), all loaded models are in use")
+
+    def _evict(self, name):
+        entry = self.loaded.pop(name)
+        entry.model.close()
+        self.num_evictions += 1
@@ -0,0 +1,153 @@
+"""
+Response cache for deterministic (temperature=0) requests, e.g. canned questions, eval harnesses and retries.
+
+Greedy decoding always produces the same response for the same prompt tokens, sampling parameters
+and model, so the response tokens can be served again without touching a model replica.
+- Entries are keyed on a hash of the model namespace, the prompt token ids and the sampling parameters.
+- The in-memory tier is an LRU that evicts the least recently used entries beyond a byte budget.
+- The optional disk tier keeps every entry as a small file under its own byte budget, it survives
+  restarts and is shared by all the servers pointed at the same directory (and the same model).
+
+The cache is thread safe, but the disk tier does file I/O: call get/put off the event loop when it is enabled.
+"""
+
+import os
+import array
+import hashlib
+import threading
+from collections import OrderedDict
+
+ENTRY_OVERHEAD = 128 # rough bytes of bookkeeping per in-memory entry (key, OrderedDict node, array header)
+
+def cacheable(temperature):
+    return temperature == 0.0
+
+class ResponseCache:
+
+    def __init__(self, max_bytes, namespace="", disk_dir=None, max_disk_bytes=0):
+        self.max_bytes = max_bytes
+        self.namespace = namespace # identifies the model, responses of different models never mix
+        self.entries = OrderedDict() # key -> array('I') of response token ids, least recently used first
+        self.num_bytes = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.disk_dir = disk_dir
+        self.max_disk_bytes = max_disk_bytes
+        self.disk_bytes = 0
+        if disk_dir is not None:
+            os.makedirs(disk_dir, exist_ok=True)
+            self.disk_bytes = sum(entry.stat().st_size for entry in os.scandir(disk_dir) if entry.name.endswith(".tokens"))
+
+    def key(self, tokens, temperature, top_k, max_tokens):
+        # top_k has no effect at temperature=0, leave it out so that it does not split the cache
+        h = hashlib.sha256(self.namespace.encode("utf-8"))
+        h.update(array.array("I", tokens).tobytes())
+        h.update(repr((temperature, None if temperature == 0.0 else top_k, max_tokens)).encode("utf-8"))
+        return h.hexdigest()
+
+    def get(self, key):
+        """The cached response tokens, or None."""
+        with self.lock:
+            response = self.entries.get(key)
+            if response is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return response.tolist()
+        response = self._disk_get(key)
+        with self.lock:
+            if response is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            self._insert(key, response) # promote to memory
+        return response.tolist()
+
+    def put(self, key, response_tokens):
+        response = array.array("I", response_tokens)
+        with self.lock:
+            self._insert(key, response)
+        self._disk_put(key, response)
+
+    def stats(self):
+        return {
+            "entries": len(self.entries),
+            "bytes": self.num_bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "disk_bytes": self.disk_bytes,
+        }
+
+    # -------------------------------------------------------------------------
+    # internals
+
+    def _entry_bytes(self, response):
+        return response.itemsize * len(response) + ENTRY_OVERHEAD
+
+    def _insert(self, key, response):
+        size = self._entry_bytes(response)
+        if size > self.max_bytes:
+            return # would not fit even in an empty cache
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.num_bytes -= self._entry_bytes(old)
+        self.entries[key] = response
+        self.num_bytes += size
+        while self.num_bytes > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.num_bytes -= self._entry_bytes(evicted)
+            self.evictions += 1
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, f"{key}.tokens")
+
+    def _disk_get(self, key):
+        if self.disk_dir is None:
+            return None
+        path = self._disk_path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path) # the disk tier evicts by modification time, so this makes it an LRU too
+        except FileNotFoundError:
+            return None
+        response = array.array("I")
+        response.frombytes(data)
+        return response
+
+    def _disk_put(self, key, response):
+        if self.disk_dir is None:
+            return
+        path = self._disk_path(key)
+        if os.path.exists(path):
+            return
+        tmp_path = f"{path}.tmp{threading.get_ident()}"
+        with open(tmp_path, "wb") as f:
+            f.write(response.tobytes())
+        os.replace(tmp_path, path) # atomic, readers never see a partial entry
+        with self.lock:
+            self.disk_bytes += response.itemsize * len(response)
+            over_budget = self.disk_bytes > self.max_disk_bytes
+        if over_budget:
+            self._disk_evict()
+
+    def _disk_evict(self):
+        # drop the least recently used files until the disk tier is back at 90% of its budget
+        files = [entry for entry in os.scandir(self.disk_dir) if entry.name.endswith(".tokens")]
+        files.sort(key=lambda entry: entry.stat().st_mtime)
+        total = sum(entry.stat().st_size for entry in files)
+        for entry in files:
+            if total <= 0.9 * self.max_disk_bytes:
+                break
+            total -= entry.stat().st_size
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                pass # another server sharing the directory got there first
+        with self.lock:
+            self.disk_bytes = total
@@ -0,0 +1,120 @@
+"""
+Routing logic of the chat router (scripts/chat_router.py), which load balances several chat_web backends.
+
+- Least outstanding tokens: every backend reports its outstanding tokens and free capacity on /stats.
+  Between two polls, the router adds the estimated cost of the requests it sent there since the last one.
+- Conversation affinity: the next turn of a conversation goes back to the backend that served its
+  previous turn (which e.g. has its response cache warm), as long as that backend has capacity.
+  A request with messages M is remembered under M; its next turn has messages M + [reply, question],
+  so it is looked up under its messages minus the last two.
+- Health: a backend whose /stats poll fails is taken out of rotation until a poll succeeds again.
+
+Kept free of any networking so that it can be tested on its own.
+"""
+
+import json
+import time
+import hashlib
+from collections import OrderedDict
+
+def conversation_key(messages):
+    data = json.dumps([[m.get("role"), m.get("content")] for m in messages], ensure_ascii=False)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+def estimate_cost(messages, max_tokens):
+    # the router does not tokenize: ~4 characters per prompt token, plus the generation budget
+    return sum(len(m.get("content", "")) for m in messages) // 4 + max_tokens
+
+class Backend:
+
+    def __init__(self, url):
+        self.url = url.rstrip("/")
+        self.healthy = False # until the first successful poll
+        self.reported_outstanding = 0 # outstanding tokens at the last poll
+        self.recent_cost = 0 # estimated tokens sent since the last poll
+        self.free_slots = 0
+        self.queue_depth = 0
+        self.max_queue_depth = 0
+        self.in_flight = 0 # requests proxied by this router that are still streaming
+        self.failures = 0
+        self.last_poll = None
+
+    def outstanding(self):
+        return self.reported_outstanding + self.recent_cost
+
+    def has_capacity(self):
+        # a free slot, or at least no queue worth mentioning beyond what we sent since the last poll
+        return self.healthy and (self.free_slots > 0 or self.queue_depth < max(self.max_queue_depth // 4, 1))
+
+    def update(self, stats):
+        """Take in the /stats of the backend (see chat_web.py)."""
+        scheduler = stats["scheduler"]
+        self.healthy = True
+        self.failures = 0
+        self.reported_outstanding = scheduler["outstanding_tokens"]
+        self.free_slots = scheduler["free_slots"]
+        self.queue_depth = scheduler["queue_depth"]
+        self.max_queue_depth = scheduler["max_queue_depth"]
+        self.recent_cost = 0
+        self.last_poll = time.monotonic()
+
+    def mark_failed(self):
+        self.healthy = False
+        self.failures += 1
+
+    def state(self):
+        return {
+            "url": self.url,
+            "healthy": self.healthy,
+            "outstanding_tokens": self.outstanding(),
+            "free_slots": self.free_slots,
+            "queue_depth": self.queue_depth,
+            "in_flight": self.in_flight,
+            "failures": self.failures,
+        }
+
+class Router:
+
+    def __init__(self, backend_urls, max_affinity_entries=100_000, affinity_ttl=600.0):
+        assert backend_urls, "At least one backend is required"
+        self.backends = [Backend(url) for url in backend_urls]
+        self.affinity = OrderedDict() # conversation key -> (backend, time), least recently used first
+        self.max_affinity_entries = max_affinity_entries
+        self.affinity_ttl = affinity_ttl
+        self.num_affinity_hits = 0
+
+    def choose(self, messages, exclude=()):
+        """The backend for a request, or None if no backend is healthy."""
+        candidates = [b for b in self.backends if b.healthy and b not in exclude]
+        if not candidates:
+            return None
+        # the backend of the previous turn, if it can take the request
+        if len(messages) >= 3:
+            entry = self.affinity.get(conversation_key(messages[:-2]))
+            if entry is not None:
+                backend, t = entry
+                if backend in candidates and backend.has_capacity() and time.monotonic() - t < self.affinity_ttl:
+                    self.num_affinity_hits += 1
+                    return backend
+        # otherwise least outstanding tokens, preferring backends with capacity
+        return min(candidates, key=lambda b: (not b.has_capacity(), b.outstanding(), b.in_flight))
+
+    def dispatched(self, backend, messages, cost):
+        """A request was sent to backend: account for its cost and remember the conversation."""
+        backend.recent_cost += cost
+        backend.in_flight += 1
+        key = conversation_key(messages)
+        self.affinity[key] = (backend, time.monotonic())
+        self.affinity.move_to_end(key)
+        while len(self.affinity) > self.max_affinity_entries:
+            self.affinity.popitem(last=False)
+
+    def finished(self, backend):
+        backend.in_flight -= 1
+
+    def state(self):
+        return {
+            "backends": [b.state() for b in self.backends],
+            "affinity_entries": len(self.affinity),
+            "affinity_hits": self.num_affinity_hits,
+        }
@@ -0,0 +1,193 @@
+"""
+Request scheduler for serving: decides which request gets which model replica, and when.
+
+- Admission control: at most max_queue_depth requests wait at any time, the rest are shed
+  right away (the server turns QueueFullError into a 429) instead of piling up unboundedly.
+- Priority classes: waiting requests are served in priority order, FIFO within a class. When the
+  queue is full, a new request may evict the newest waiting request of a strictly lower class.
+- Deadlines: a request that is still waiting when its deadline passes fails with DeadlineExceededError.
+- Cancellation: a waiting request can be withdrawn at any time (e.g. the client disconnected).
+- Replica choice: each replica runs up to slots_per_worker requests, and a request goes to the
+  replica with the least outstanding tokens (prompt + remaining generation budget of its requests).
+
+Everything here runs on the event loop thread, so there is no locking.
+"""
+
+import heapq
+import itertools
+import time
+import asyncio
+
+# Priority classes, lower value is served first
+PRIORITY_CLASSES = {
+    "interactive": 0,
+    "default": 1,
+    "batch": 2,
+}
+
+class QueueFullError(Exception):
+    """The scheduler queue is full, the request should be retried later."""
+
+class DeadlineExceededError(Exception):
+    """The request deadline passed before a replica became available."""
+
+class Ticket:
+    """A request in the scheduler: waiting for a replica, then running on it."""
+
+    def __init__(self, seq, priority, cost, deadline, future):
+        self.seq = seq # arrival order, FIFO tie-breaker within a priority class
+        self.priority = priority
+        self.cost = cost # outstanding tokens this request adds to its replica
+        self.deadline = deadline # absolute time.monotonic() deadline, or None
+        self.future = future # resolves to the worker index once scheduled
+        self.state = "waiting" # waiting|running|done
+        self.worker_idx = None
+        self.enqueued_at = time.monotonic()
+        self.timer = None # deadline timer while waiting
+
+    def time_left(self):
+        return None if self.deadline is None else self.deadline - time.monotonic()
+
+class RequestScheduler:
+
+    def __init__(self, workers, slots_per_worker=1, max_queue_depth=64):
+        assert slots_per_worker >= 1 and max_queue_depth >= 0
+        self.workers = workers
+        self.slots_per_worker = slots_per_worker
+        self.max_queue_depth = max_queue_depth
+        self.active = [0] * len(workers) # running requests per worker
+        self.outstanding = [0] * len(workers) # outstanding tokens per worker
+        self.heap = [] # (priority, seq, ticket) of waiting tickets, cancelled ones are skipped lazily
+        self.num_waiting = 0
+        self.counter = itertools.count()
+        self.num_shed = 0 # requests rejected or evicted because the queue was full
+        self.num_expired = 0 # requests whose deadline passed while waiting
+
+    def submit(self, cost, priority="default", deadline=None):
+        """
+        Enqueue a request of the given cost (in tokens). deadline is in seconds from now.
+        Raises QueueFullError if the request cannot even wait for a replica.
+        """
+        assert priority in PRIORITY_CLASSES, f"Unknown priority class: {priority}"
+        loop = asyncio.get_running_loop()
+        abs_deadline = None if deadline is None else time.monotonic() + deadline
+        ticket = Ticket(next(self.counter), PRIORITY_CLASSES[priority], cost, abs_deadline, loop.create_future())
+        # the fast path: a replica is free and nobody is waiting ahead of us
+        if self.num_waiting == 0 and self._pick_worker() is not None:
+            self._start(ticket, self._pick_worker())
+            return ticket
+        if self.num_waiting >= self.max_queue_depth:
+            victim = self._lowest_priority_waiting()
+            if victim is None or victim.priority <= ticket.priority:
+                self.num_shed += 1
+                raise QueueFullError(f"Server is at capacity ({self.max_queue_depth} requests waiting)")
+            self._finish_waiting(victim)
+            victim.future.set_exception(QueueFullError("Evicted by a higher priority request"))
+            self.num_shed += 1
+        heapq.heappush(self.heap, (ticket.priority, ticket.seq, ticket))
+        self.num_waiting += 1
+        if abs_deadline is not None:
+            ticket.timer = loop.call_later(deadline, self._expire, ticket)
+        return ticket
+
+    async def wait(self, ticket):
+        """Wait until the ticket is scheduled, returns its worker."""
+        try:
+            worker_idx = await asyncio.shield(ticket.future)
+        except asyncio.CancelledError:
+            self.cancel(ticket)
+            raise
+        return self.workers[worker_idx]
+
+    def cancel(self, ticket):
+        """Withdraw a request: dequeue it if it is waiting, free its slot if it is running."""
+        if ticket.state == "waiting":
+            self._finish_waiting(ticket)
+            if not ticket.future.done():
+                ticket.future.cancel()
+        elif ticket.state == "running":
+            self.release(ticket)
+
+    def release(self, ticket):
+        """A running request finished, hand its slot to the next waiting request."""
+        if ticket.state != "running":
+            return
+        ticket.state = "done"
+        self.active[ticket.worker_idx] -= 1
+        self.outstanding[ticket.worker_idx] -= ticket.cost
+        ticket.cost = 0
+        self._dispatch()
+
+    def consume(self, ticket, num_tokens=1):
+        """Account for generated tokens, they no longer count as outstanding."""
+        num_tokens = min(num_tokens, ticket.cost)
+        ticket.cost -= num_tokens
+        if ticket.state == "running":
+            self.outstanding[ticket.worker_idx] -= num_tokens
+
+    def num_requests(self):
+        """Requests in the system, running or waiting."""
+        return sum(self.active) + self.num_waiting
+
+    def stats(self):
+        return {
+            "queue_depth": self.num_waiting,
+            "max_queue_depth": self.max_queue_depth,
+            "slots_per_worker": self.slots_per_worker,
+            "active_requests": sum(self.active),
+            "free_slots": sum(self.slots_per_worker - a for a in self.active),
+            "outstanding_tokens": sum(self.outstanding),
+            "num_shed": self.num_shed,
+            "num_expired": self.num_expired,
+        }
+
+    def worker_stats(self, worker_idx):
+        return {"active_requests": self.active[worker_idx], "outstanding_tokens": self.outstanding[worker_idx]}
+
+    # -------------------------------------------------------------------------
+    # internals
+
+    def _pick_worker(self):
+        # least outstanding tokens among the workers with a free slot (ties: fewest requests, lowest index)
+        free = [i for i in range(len(self.workers)) if self.active[i] < self.slots_per_worker]
+        if not free:
+            return None
+        return min(free, key=lambda i: (self.outstanding[i], self.active[i], i))
+
+    def _start(self, ticket, worker_idx):
+        ticket.state = "running"
+        ticket.worker_idx = worker_idx
+        self.active[worker_idx] += 1
+        self.outstanding[worker_idx] += ticket.cost
+        ticket.future.set_result(worker_idx)
+
+    def _finish_waiting(self, ticket):
+        # the ticket leaves the queue (its heap entry gets skipped lazily)
+        ticket.state = "done"
+        self.num_waiting -= 1
+        if ticket.timer is not None:
+            ticket.timer.cancel()
+            ticket.timer = None
+
+    def _lowest_priority_waiting(self):
+        waiting = [t for _, _, t in self.heap if t.state == "waiting"]
+        return max(waiting, key=lambda t: (t.priority, t.seq), default=None)
+
+    def _expire(self, ticket):
+        ticket.timer = None
+        if ticket.state != "waiting":
+            return
+        self._finish_waiting(ticket)
+        self.num_expired += 1
+        ticket.future.set_exception(DeadlineExceededError("Deadline exceeded while waiting for a replica"))
+
+    def _dispatch(self):
+        while self.heap:
+            worker_idx = self._pick_worker()
+            if worker_idx is None:
+                return
+            _, _, ticket = heapq.heappop(self.heap)
+            if ticket.state != "waiting":
+                continue # cancelled, expired or evicted
+            self._finish_waiting(ticket)
+            self._start(ticket, worker_idx)
@@ -0,0 +1,114 @@
+"""
+Pre-tokenized pretraining data: the parquet shards tokenized once (by scripts/tok_data.py) into flat
+binary token files that the dataloader memory-maps, instead of tokenizing the text again in every
+epoch of every run.
+
+For each parquet shard shard_XXXXX.parquet, the tokens directory has:
+- shard_XXXXX.bin: the tokens of all its documents back to back, each document starting with BOS,
+  as uint16 (uint32 when the vocab does not fit in 16 bits)
+- shard_XXXXX.idx.npy: the document offsets (int64, num_docs + 1): document i is tokens[idx[i]:idx[i+1]]
+and meta.json has the vocab size, the token dtype, the fingerprint of the tokenizer (see
+get_tokenizer_fingerprint) and the token and document counts of every shard.
+"""
+
+import os
+import json
+import numpy as np
+
+from nanochat.tokenizer import token_dtype
+
+META_FILE = "meta.json"
+TOKENIZER_FILE = "tokenizer.txt" # the fingerprint of the tokenizer the shards are tokenized with
+
+def shard_name(parquet_path):
+    # e.g. .../shard_00042.parquet -> shard_00042
+    return os.path.splitext(os.path.basename(parquet_path))[0]
+
+def shard_paths(tokens_dir, name):
+    return os.path.join(tokens_dir, f"{name}.bin"), os.path.join(tokens_dir, f"{name}.idx.npy")
+
+def write_shard(tokens_dir, name, tokens, offsets):
+    """Write the tokens and document offsets of one shard. The .bin goes last, it marks the shard as complete."""
+    bin_path, idx_path = shard_paths(tokens_dir, name)
+    with open(idx_path + ".tmp", "wb") as f:
+        np.save(f, offsets.astype(np.int64))
+    with open(bin_path + ".tmp", "wb") as f:
+        tokens.tofile(f)
+    os.replace(idx_path + ".tmp", idx_path)
+    os.replace(bin_path + ".tmp", bin_path)
+
+def read_offsets(tokens_dir, name):
+    return np.load(shard_paths(tokens_dir, name)[1])
+
+def write_meta(tokens_dir, vocab_size, bos_token_id, shards, tokenizer_fingerprint=None):
+    """shards: {name: {"num_tokens": ..., "num_docs": ...}}"""
+    meta = {
+        "tokenizer": tokenizer_fingerprint,
+        "vocab_size": vocab_size,
+        "dtype": np.dtype(token_dtype(vocab_size)).name,
+        "bos_token_id": bos_token_id,
+        "shards": dict(sorted(shards.items())),
+    }
+    with open(os.path.join(tokens_dir, META_FILE + ".tmp"), "w", encoding="utf-8") as f:
+        json.dump(meta, f, indent=2)
+    os.replace(os.path.join(tokens_dir, META_FILE + ".tmp"), os.path.join(tokens_dir, META_FILE))
+
+def read_meta(tokens_dir):
+    with open(os.path.join(tokens_dir, META_FILE), "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def prepare_tokens_dir(tokens_dir, tokenizer_fingerprint):
+    """
+    Make tokens_dir ready to (re)tokenize into with the given tokenizer: if its shards were tokenized with
+    another tokenizer, they are all deleted, as is the meta. Returns True if it did delete them.
+    """
+    os.makedirs(tokens_dir, exist_ok=True)
+    marker_path = os.path.join(tokens_dir, TOKENIZER_FILE)
+    previous = None
+    if os.path.exists(marker_path):
+        with open(marker_path, "r", encoding="utf-8") as f:
+            previous = f.read().strip()
+    if previous == tokenizer_fingerprint:
+        return False
+    stale = [f for f in os.listdir(tokens_dir) if f == META_FILE or f.endswith((".bin", ".idx.npy"))]
+    for f in sorted(stale, key=lambda f: f != META_FILE): # the meta first, so nothing reads a half-deleted dir
+        os.remove(os.path.join(tokens_dir, f))
+    with open(marker_path, "w", encoding="utf-8") as f:
+        f.write(tokenizer_fingerprint)
+    return bool(stale)
+
+def has_token_shards(tokens_dir):
+    return os.path.exists(os.path.join(tokens_dir, META_FILE))
+
+class TokenShards:
+    """
+    The tokens of a split as one virtual array over the memory-mapped shards. As for the parquet
+    files (see dataset.py), the last shard is the val split and all the others are the train split.
+    """
+
+    def __init__(self, tokens_dir, split):
+        assert split in ["train", "val"], "split must be 'train' or 'val'"
+        meta = read_meta(tokens_dir)
+        names = list(meta["shards"])
+        names = names[:-1] if split == "train" else names[-1:]
+        self.names = [name for name in names if meta["shards"][name]["num_tokens"] > 0] # empty files can't be mapped
+        self.vocab_size = meta["vocab_size"]
+        self.dtype = np.dtype(meta["dtype"])
+        self.shards = [np.memmap(shard_paths(tokens_dir, name)[0], dtype=self.dtype, mode="r") for name in self.names]
+        self.starts = np.zeros(len(self.shards) + 1, dtype=np.int64) # token index of the start of every shard
+        np.cumsum([len(shard) for shard in self.shards], out=self.starts[1:])
+        self.num_tokens = int(self.starts[-1])
+
+    def read(self, start, length):
+        """tokens[start:start+length], a view of the memory map unless it spans shards."""
+        assert 0 <= start and start + length <= self.num_tokens, "read out of bounds"
+        end = start + length
+        i = int(np.searchsorted(self.starts, start, side="right")) - 1
+        pieces = []
+        while start < end:
+            shard_start = start - int(self.starts[i])
+            take = min(end, int(self.starts[i + 1])) - start
+            pieces.append(self.shards[i][shard_start:shard_start + take])
+            start += take
+            i += 1
+        return pieces[0] if len(pieces) == 1 else np.concatenate(pieces)
@@ -7,7 +7,7 @@ Two implementations are available:
 """
 
 import os
-import copy
+import codecs
 from functools import lru_cache
 
 # @learn:tokenizer.special_tokens
@@ -30,6 +30,71 @@ SPECIAL_TOKENS = [
 # I haven't validated that this is actually a good idea, TODO.
 SPLIT_PATTERN = r"""'(?i:[sdmt]|ll|ve|re)|[^\r\n\p{L}\p{N}]?+\p{L}+|\p{N}{1,2}| ?[^\s\p{L}\p{N}]++[\r\n]*|\s*[\r\n]|\s+(?!\S)|\s+"""
 
+# -----------------------------------------------------------------------------
+# Batches of token ids as flat arrays
+
+def token_dtype(vocab_size):
+    import numpy as np
+    return np.uint16 if vocab_size <= 2**16 else np.uint32
+
+def pack_token_lists(token_lists, vocab_size, prepend_id=None, append_id=None):
+    """
+    Pack lists of token ids into one flat array plus offsets: row i is tokens[offsets[i]:offsets[i+1]].
+    The tokens are uint16 when the vocab fits (uint32 otherwise), which halves the memory of the usual
+    int64 tensors, and torch.from_numpy wraps the array without a copy. prepend_id/append_id (e.g. BOS)
+    are written straight into their slots instead of being inserted into every list.
+    """
+    import numpy as np
+    extra = (prepend_id is not None) + (append_id is not None)
+    lengths = np.fromiter((len(ids) + extra for ids in token_lists), dtype=np.int64, count=len(token_lists))
+    offsets = np.zeros(len(token_lists) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    tokens = np.empty(offsets[-1], dtype=token_dtype(vocab_size))
+    start = 1 if prepend_id is not None else 0
+    for ids, offset in zip(token_lists, offsets[:-1].tolist()):
+        tokens[offset + start:offset + start + len(ids)] = ids
+    if prepend_id is not None:
+        tokens[offsets[:-1]] = prepend_id
+    if append_id is not None:
+        tokens[offsets[1:] - 1] = append_id
+    return tokens, offsets
+
+# -----------------------------------------------------------------------------
+# Incremental detokenization for streaming
+
+class StreamDecoder:
+    """
+    Turns a stream of token ids into text, one token at a time. Decoding the whole response
+    again for every new token is quadratic in its length, so instead the bytes of each token
+    go through an incremental UTF-8 decoder, which holds back an incomplete trailing character
+    (e.g. the first bytes of an emoji) until the token that completes it arrives. Each step
+    returns exactly the new text, and the concatenation of all steps plus flush() equals decode().
+    """
+
+    def __init__(self, id_to_bytes):
+        self.id_to_bytes = id_to_bytes
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+
+    def step(self, token_id):
+        return self.decoder.decode(self.id_to_bytes(token_id))
+
+    def flush(self):
+        # the end of the stream: an incomplete trailing character becomes U+FFFD, like in decode()
+        return self.decoder.decode(b"", final=True)
+
+@lru_cache(maxsize=1)
+def byte_level_decoder():
+    # inverse of the GPT-2 byte-to-unicode table used by the ByteLevel pre-tokenizer of HuggingFace
+    bs = list(range(ord("!"), ord("~")+1)) + list(range(ord("¡"), ord("¬")+1)) + list(range(ord("®"), ord("ÿ")+1))
+    cs = bs[:]
+    n = 0
+    for b in range(256):
+        if b not in bs:
+            bs.append(b)
+            cs.append(256 + n)
+            n += 1
+    return {chr(c): b for b, c in zip(bs, cs)}
+
 # -----------------------------------------------------------------------------
 # Generic GPT-4-style tokenizer based on HuggingFace Tokenizer
 from tokenizers import Tokenizer as HFTokenizer
@@ -42,6 +107,7 @@ class HuggingFaceTokenizer:
 
     def __init__(self, tokenizer):
         self.tokenizer = tokenizer
+        self.token_bytes = {} # id -> raw bytes, filled by id_to_bytes as tokens come up
 
     @classmethod
     def from_pretrained(cls, hf_path):
@@ -137,9 +203,32 @@ class HuggingFaceTokenizer:
     def __call__(self, *args, **kwargs):
         return self.encode(*args, **kwargs)
 
+    def encode_batch_to_array(self, texts, prepend=None, append=None):
+        # see pack_token_lists, returns (tokens, offsets)
+        prepend_id = prepend if prepend is None or isinstance(prepend, int) else self.encode_special(prepend)
+        append_id = append if append is None or isinstance(append, int) else self.encode_special(append)
+        token_lists = [encoding.ids for encoding in self.tokenizer.encode_batch(texts, add_special_tokens=False)]
+        return pack_token_lists(token_lists, self.get_vocab_size(), prepend_id, append_id)
+
     def decode(self, ids):
         return self.tokenizer.decode(ids, skip_special_tokens=False)
 
+    def id_to_bytes(self, id):
+        # the raw bytes of a token: special tokens are stored as is, the rest in the ByteLevel alphabet
+        token_bytes = self.token_bytes.get(id)
+        if token_bytes is None:
+            added_token = self.tokenizer.get_added_tokens_decoder().get(id)
+            if added_token is not None:
+                token_bytes = added_token.content.encode("utf-8")
+            else:
+                table = byte_level_decoder()
+                token_bytes = bytes(table[c] for c in self.tokenizer.id_to_token(id))
+            self.token_bytes[id] = token_bytes
+        return token_bytes
+
+    def decode_stream(self):
+        return StreamDecoder(self.id_to_bytes)
+
     def save(self, tokenizer_dir):
         # save the tokenizer to disk
         os.makedirs(tokenizer_dir, exist_ok=True)
@@ -162,13 +251,16 @@ class RustBPETokenizer:
         self.bos_token_id = self.encode_special(bos_token)
 
     @classmethod
-    def train_from_iterator(cls, text_iterator, vocab_size):
+    def train_from_iterator(cls, text_iterator, vocab_size, doc_cap=None, max_chars=None, max_unique_chunks=None):
+        # text_iterator yields texts or lists of texts (e.g. parquet row groups), which rustbpe crops to
+        # doc_cap characters, stopping after max_chars; max_unique_chunks bounds the memory of the counts
         # 1) train using rustbpe
         tokenizer = rustbpe.Tokenizer()
         # the special tokens are inserted later in __init__, we don't train them here
         vocab_size_no_special = vocab_size - len(SPECIAL_TOKENS)
         assert vocab_size_no_special >= 256, f"vocab_size_no_special must be at least 256, got {vocab_size_no_special}"
-        tokenizer.train_from_iterator(text_iterator, vocab_size_no_special, pattern=SPLIT_PATTERN)
+        tokenizer.train_from_iterator(text_iterator, vocab_size_no_special, pattern=SPLIT_PATTERN,
+                                      doc_cap=doc_cap, max_chars=max_chars, max_unique_chunks=max_unique_chunks)
         # 2) construct the associated tiktoken encoding for inference
         pattern = tokenizer.get_pattern()
         mergeable_ranks_list = tokenizer.get_mergeable_ranks()
@@ -247,9 +339,25 @@ class RustBPETokenizer:
     def __call__(self, *args, **kwargs):
         return self.encode(*args, **kwargs)
 
+    def encode_batch_to_array(self, texts, prepend=None, append=None, num_threads=8):
+        """
+        Encode a list of strings into one flat token array plus offsets (see pack_token_lists),
+        e.g. for the dataloader, which then never holds the tokens as Python ints.
+        """
+        prepend_id = prepend if prepend is None or isinstance(prepend, int) else self.encode_special(prepend)
+        append_id = append if append is None or isinstance(append, int) else self.encode_special(append)
+        token_lists = self.enc.encode_ordinary_batch(texts, num_threads=num_threads)
+        return pack_token_lists(token_lists, self.get_vocab_size(), prepend_id, append_id)
+
     def decode(self, ids):
         return self.enc.decode(ids)
 
+    def id_to_bytes(self, id):
+        return self.enc.decode_single_token_bytes(id)
+
+    def decode_stream(self):
+        return StreamDecoder(self.id_to_bytes)
+
     def save(self, tokenizer_dir):
         # save the encoding object to disk
         os.makedirs(tokenizer_dir, exist_ok=True)
@@ -266,36 +374,32 @@ class RustBPETokenizer:
         - ids: list[int] is a list of token ids of this rendered conversation
         - mask: list[int] of same length, mask = 1 for tokens that the Assistant is expected to train on.
         """
-        # ids, masks that we will return and a helper function to help build them up.
-        ids, mask = [], []
-        def add_tokens(token_ids, mask_val):
-            if isinstance(token_ids, int):
-                token_ids = [token_ids]
-            ids.extend(token_ids)
-            mask.extend([mask_val] * len(token_ids))
+        ids, mask, _ = self.render_conversations([conversation], max_tokens=max_tokens)
+        return ids.tolist(), mask.tolist()
+
+    @lru_cache(maxsize=1)
+    def chat_special_ids(self):
+        # the special tokens of the chat format, by name without the <| |>
+        names = ["user_start", "user_end", "assistant_start", "assistant_end", "python_start", "python_end", "output_start", "output_end"]
+        return {name: self.encode_special(f"<|{name}|>") for name in names}
 
+    def conversation_parts(self, conversation):
+        """
+        The parts of a rendered conversation, in order, as (part, mask) pairs: a part is either a
+        special token id (int) or a text to tokenize (str). mask = 1 for the parts the Assistant
+        is expected to train on.
+        """
+        special = self.chat_special_ids()
+        messages = conversation["messages"]
         # sometimes the first message is a system message...
         # => just merge it with the second (user) message
-        if conversation["messages"][0]["role"] == "system":
-            # some conversation surgery is necessary here for now...
-            conversation = copy.deepcopy(conversation) # avoid mutating the original
-            messages = conversation["messages"]
+        if messages[0]["role"] == "system":
             assert messages[1]["role"] == "user", "System message must be followed by a user message"
-            messages[1]["content"] = messages[0]["content"] + "\n\n" + messages[1]["content"]
-            messages = messages[1:]
-        else:
-            messages = conversation["messages"]
+            merged = {"role": "user", "content": messages[0]["content"] + "\n\n" + messages[1]["content"]}
+            messages = [merged] + messages[2:]
         assert len(messages) >= 1, f"Conversation has less than 1 message: {messages}"
 
-        # fetch all the special tokens we need
-        bos = self.get_bos_token_id()
-        user_start, user_end = self.encode_special("<|user_start|>"), self.encode_special("<|user_end|>")
-        assistant_start, assistant_end = self.encode_special("<|assistant_start|>"), self.encode_special("<|assistant_end|>")
-        python_start, python_end = self.encode_special("<|python_start|>"), self.encode_special("<|python_end|>")
-        output_start, output_end = self.encode_special("<|output_start|>"), self.encode_special("<|output_end|>")
-
-        # now we can tokenize the conversation
-        add_tokens(bos, 0)
+        parts = [(self.get_bos_token_id(), 0)]
         for i, message in enumerate(messages):
 
             # some sanity checking here around assumptions, to prevent footguns
@@ -307,43 +411,64 @@ class RustBPETokenizer:
 
             if message["role"] == "user":
                 assert isinstance(content, str), "User messages are simply expected to be strings"
-                value_ids = self.encode(content)
-                add_tokens(user_start, 0)
-                add_tokens(value_ids, 0)
-                add_tokens(user_end, 0)
+                parts += [(special["user_start"], 0), (content, 0), (special["user_end"], 0)]
             elif message["role"] == "assistant":
-                add_tokens(assistant_start, 0)
+                parts.append((special["assistant_start"], 0))
                 if isinstance(content, str):
                     # simple string => simply add the tokens
-                    value_ids = self.encode(content)
-                    add_tokens(value_ids, 1)
+                    parts.append((content, 1))
                 elif isinstance(content, list):
                     for part in content:
-                        value_ids = self.encode(part["text"])
                         if part["type"] == "text":
                             # string part => simply add the tokens
-                            add_tokens(value_ids, 1)
+                            parts.append((part["text"], 1))
                         elif part["type"] == "python":
                             # python tool call => add the tokens inside <|python_start|> and <|python_end|>
-                            add_tokens(python_start, 1)
-                            add_tokens(value_ids, 1)
-                            add_tokens(python_end, 1)
+                            parts += [(special["python_start"], 1), (part["text"], 1), (special["python_end"], 1)]
                         elif part["type"] == "python_output":
                             # python output => add the tokens inside <|output_start|> and <|output_end|>
                             # none of these tokens are supervised because the tokens come from Python at test time
-                            add_tokens(output_start, 0)
-                            add_tokens(value_ids, 0)
-                            add_tokens(output_end, 0)
+                            parts += [(special["output_start"], 0), (part["text"], 0), (special["output_end"], 0)]
                         else:
                             raise ValueError(f"Unknown part type: {part['type']}")
                 else:
                     raise ValueError(f"Unknown content type: {type(content)}")
-                add_tokens(assistant_end, 1)
+                parts.append((special["assistant_end"], 1))
+        return parts
 
-        # truncate to max_tokens tokens MAX (helps prevent OOMs)
-        ids = ids[:max_tokens]
-        mask = mask[:max_tokens]
-        return ids, mask
+    def render_conversations(self, conversations, max_tokens=2048, num_threads=8):
+        """
+        Tokenize many Chat conversations at once: all their texts go through a single
+        encode_ordinary_batch call, and the ids and masks are assembled in NumPy arrays.
+        Returns (ids, mask, offsets): conversation i is ids[offsets[i]:offsets[i+1]] with its mask
+        (uint8) at the same positions, truncated to max_tokens tokens MAX (helps prevent OOMs).
+        """
+        import numpy as np
+        from itertools import chain
+        parts, parts_per_conversation = [], []
+        for conversation in conversations:
+            conversation_parts = self.conversation_parts(conversation)
+            parts += conversation_parts
+            parts_per_conversation.append(len(conversation_parts))
+        # tokenize all the texts at once, the special tokens are parts of one token
+        encoded = iter(self.enc.encode_ordinary_batch([part for part, _ in parts if isinstance(part, str)], num_threads=num_threads))
+        token_lists = [next(encoded) if isinstance(part, str) else (part,) for part, _ in parts]
+        lengths = np.fromiter(map(len, token_lists), dtype=np.int64, count=len(token_lists))
+        ids = np.fromiter(chain.from_iterable(token_lists), dtype=token_dtype(self.get_vocab_size()), count=int(lengths.sum()))
+        mask = np.repeat(np.fromiter((m for _, m in parts), dtype=np.uint8, count=len(parts)), lengths)
+        # the lengths of the conversations, and their truncation to max_tokens
+        offsets = np.zeros(len(conversations) + 1, dtype=np.int64)
+        if conversations:
+            first_parts = np.zeros(len(conversations), dtype=np.int64)
+            np.cumsum(parts_per_conversation[:-1], out=first_parts[1:])
+            conversation_lengths = np.add.reduceat(lengths, first_parts)
+            if conversation_lengths.max() > max_tokens:
+                starts = np.cumsum(conversation_lengths) - conversation_lengths
+                keep = np.arange(len(ids)) - np.repeat(starts, conversation_lengths) < max_tokens
+                ids, mask = ids[keep], mask[keep]
+                conversation_lengths = np.minimum(conversation_lengths, max_tokens)
+            np.cumsum(conversation_lengths, out=offsets[1:])
+        return ids, mask, offsets
 
     def visualize_tokenization(self, ids, mask, with_token_id=False):
         """Small helper function useful in debugging: visualize the tokenization of render_conversation"""
@@ -366,11 +491,10 @@ class RustBPETokenizer:
         render the conversation priming the Assistant for a completion.
         Unlike the Chat SFT case, we don't need to return the mask.
         """
-        # We have some surgery to do: we need to pop the last message (of the Assistant)
-        conversation = copy.deepcopy(conversation) # avoid mutating the original
+        # We have some surgery to do: we need to drop the last message (of the Assistant)
         messages = conversation["messages"]
         assert messages[-1]["role"] == "assistant", "Last message must be from the Assistant"
-        messages.pop() # remove the last message (of the Assistant) inplace
+        conversation = {**conversation, "messages": messages[:-1]} # avoid mutating the original
 
         # Now tokenize the conversation
         ids, mask = self.render_conversation(conversation)
@@ -390,6 +514,14 @@ def get_tokenizer():
     # return HuggingFaceTokenizer.from_directory(tokenizer_dir)
     return RustBPETokenizer.from_directory(tokenizer_dir)
 
+def get_tokenizer_fingerprint():
+    """A hash of the tokenizer files, to tell whether data was tokenized with the current tokenizer."""
+    import hashlib
+    from nanochat.common import get_base_dir
+    pickle_path = os.path.join(get_base_dir(), "tokenizer", "tokenizer.pkl")
+    with open(pickle_path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()[:16]
+
 def get_token_bytes(device="cpu"):
     import torch
     from nanochat.common import get_base_dir
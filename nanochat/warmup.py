@@ -0,0 +1,68 @@
+"""
+Warmup of an inference engine, so that its first real requests already run at steady-state latency.
+
+A fresh replica is slow on its first requests: the allocator grows its pools, the weights and the
+KV cache get touched for the first time (page faults, on CPU especially), cuBLAS/cuDNN pick their
+kernels, and a compiled model traces and compiles a graph for every new shape. warmup() gets all of
+that out of the way by running synthetic prefills and decodes over a few prompt length buckets,
+with the same generation settings as the real traffic.
+
+Compilation is by far the slowest of these, so compiled graphs are also kept on disk: enable_compile_cache()
+points the inductor and triton caches at a directory keyed by the model config, the torch version and
+the device, and a restarted replica loads its graphs from there instead of compiling them again.
+"""
+
+import os
+import json
+import time
+import hashlib
+import torch
+from nanochat.common import get_base_dir
+
+DEFAULT_BUCKETS = (16, 128, 512) # prompt lengths, in tokens
+WARMUP_TEXT = "The quick brown fox jumps over the lazy dog. "
+
+def compile_cache_dir(model_config, device_type):
+    """The compile cache directory of a model config on this torch version and device."""
+    key = {
+        "model_config": model_config,
+        "torch": torch.__version__,
+        "device": torch.cuda.get_device_name() if device_type == "cuda" else device_type,
+    }
+    digest = hashlib.sha256(json.dumps(key, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+    return os.path.join(get_base_dir(), "compile_cache", digest)
+
+def enable_compile_cache(model_config, device_type):
+    """Keep the artifacts of torch.compile on disk, must be called before the first compilation."""
+    import torch._inductor.config
+    cache_dir = compile_cache_dir(model_config, device_type)
+    os.makedirs(cache_dir, exist_ok=True)
+    os.environ["TORCHINDUCTOR_CACHE_DIR"] = os.path.join(cache_dir, "inductor")
+    os.environ["TRITON_CACHE_DIR"] = os.path.join(cache_dir, "triton")
+    torch._inductor.config.fx_graph_cache = True # compiled graphs, keyed by graph and inputs
+    if hasattr(torch._inductor.config, "autotune_local_cache"):
+        torch._inductor.config.autotune_local_cache = True # autotuning results
+    return cache_dir
+
+def warmup_prompt(tokenizer, length):
+    bos = tokenizer.get_bos_token_id()
+    text_tokens = tokenizer.encode(WARMUP_TEXT)
+    return [bos] + [text_tokens[i % len(text_tokens)] for i in range(length - 1)]
+
+def warmup(engine, tokenizer, buckets=DEFAULT_BUCKETS, max_tokens=16, max_seq_len=None, **generate_kwargs):
+    """
+    Run a synthetic request per prompt length bucket: a prefill of that length, then max_tokens decode steps.
+    Prompts that would not fit in max_seq_len are shortened. Returns the seconds each bucket took.
+    """
+    timings = {}
+    for length in sorted(buckets):
+        if max_seq_len is not None:
+            length = max(min(length, max_seq_len - max_tokens), 1)
+        tokens = warmup_prompt(tokenizer, length)
+        t0 = time.perf_counter()
+        for _ in engine.generate(tokens, max_tokens=max_tokens, **generate_kwargs):
+            pass
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        timings[length] = time.perf_counter() - t0
+    return timings
@@ -1,5 +1,10 @@
-use std::cmp::Ordering;
+use std::cmp::{Ordering, Reverse};
+use std::collections::BinaryHeap;
 use std::collections::HashMap as StdHashMap;
+use std::hash::BuildHasher;
+use std::sync::atomic::{AtomicUsize, Ordering as AtomicOrdering};
+use std::sync::Mutex;
+use std::time::Instant;
 
 use dary_heap::OctonaryHeap;
 use fancy_regex::Regex;
@@ -9,11 +14,21 @@ use ahash::{AHashMap, AHashSet};
 use compact_str::CompactString;
 use rayon::prelude::*;
 
+mod pretokenizer;
+use pretokenizer::Pretokenizer;
+
 // Default GPT-4 style regex pattern for splitting text
 const GPT4_PATTERN: &str = r"'(?i:[sdmt]|ll|ve|re)|[^\r\n\p{L}\p{N}]?+\p{L}+|\p{N}{1,3}| ?[^\s\p{L}\p{N}]++[\r\n]*|\s*[\r\n]|\s+(?!\S)|\s+";
 
 type Pair = (u32, u32);
 
+// Default number of chunks kept in the encode cache, and the longest chunk (in bytes) worth caching
+const DEFAULT_CACHE_SIZE: usize = 65536;
+const MAX_CACHED_CHUNK_LEN: usize = 64;
+
+// Number of shards of the chunk counts during training
+const NUM_COUNT_SHARDS: usize = 64;
+
 /// A Byte Pair Encoding tokenizer that matches the GPT-4 style implementation
 #[pyclass]
 pub struct Tokenizer {
@@ -23,6 +38,12 @@ pub struct Tokenizer {
     pub pattern: String,
     /// Compiled regex for efficiency
     compiled_pattern: Regex,
+    /// Hand-written scanner used instead of the regex when the pattern is the GPT-4 style split pattern
+    pretokenizer: Option<Pretokenizer>,
+    /// Cache of chunk -> token ids used by encode (batch_encode keeps one per rayon job)
+    cache: Mutex<ChunkCache>,
+    /// Capacity of the chunk caches (0 disables caching)
+    cache_size: usize,
 }
 
 // ------------------------ internal helpers ------------------------
@@ -154,6 +175,172 @@ fn count_pairs_parallel(
         )
 }
 
+type CountShards = Vec<AHashMap<CompactString, i32>>;
+
+/// The chunk counts of training, sharded by the hash of the chunk so that merging the counts of a
+/// buffer and pruning them run in parallel, one shard per rayon task.
+struct ChunkCounts {
+    hasher: ahash::RandomState,
+    shards: CountShards,
+    /// the chunks seen at most this many times were dropped by prune
+    pruned_below: i32,
+}
+
+impl ChunkCounts {
+    fn new() -> Self {
+        Self {
+            hasher: ahash::RandomState::with_seeds(1, 2, 3, 4),
+            shards: (0..NUM_COUNT_SHARDS).map(|_| AHashMap::new()).collect(),
+            pruned_below: 0,
+        }
+    }
+
+    fn len(&self) -> usize {
+        self.shards.iter().map(|shard| shard.len()).sum()
+    }
+
+    /// Split and count the chunks of texts in parallel, then merge them into the shards
+    fn add_texts(&mut self, tokenizer: &Tokenizer, texts: &[String]) {
+        let hasher = &self.hasher;
+        let empty = || -> CountShards { (0..NUM_COUNT_SHARDS).map(|_| AHashMap::new()).collect() };
+        let local = texts
+            .par_iter()
+            .fold(empty, |mut shards, text| {
+                for piece in tokenizer.split_chunks(text) {
+                    let shard = (hasher.hash_one(piece) as usize) % NUM_COUNT_SHARDS;
+                    *shards[shard].entry(CompactString::from(piece)).or_default() += 1;
+                }
+                shards
+            })
+            .reduce(empty, |mut a, b| {
+                for (shard_a, shard_b) in a.iter_mut().zip(b) {
+                    for (k, v) in shard_b {
+                        *shard_a.entry(k).or_default() += v;
+                    }
+                }
+                a
+            });
+        self.shards.par_iter_mut().zip(local.into_par_iter()).for_each(|(shard, local)| {
+            for (k, v) in local {
+                *shard.entry(k).or_default() += v;
+            }
+        });
+    }
+
+    /// Drop the rarest chunks (seen once, then twice, ...) until at most `target` are left.
+    /// A dropped chunk that shows up again is counted from zero: the counts are lossy, but the
+    /// frequent chunks, which are the ones that make the merges, are kept.
+    fn prune(&mut self, target: usize) {
+        let mut threshold = 0;
+        while self.len() > target {
+            threshold += 1;
+            self.shards.par_iter_mut().for_each(|shard| shard.retain(|_, c| *c > threshold));
+        }
+        self.pruned_below = self.pruned_below.max(threshold);
+    }
+
+    fn into_words(self) -> (Vec<Word>, Vec<i32>) {
+        let mut words = Vec::with_capacity(self.len());
+        let mut counts = Vec::with_capacity(self.len());
+        for (chunk, c) in self.shards.into_iter().flatten() {
+            words.push(Word::new(chunk.as_bytes().iter().map(|&b| b as u32).collect()));
+            counts.push(c);
+        }
+        (words, counts)
+    }
+}
+
+/// An approximate LRU cache of chunk -> token ids, in two generations: lookups promote entries
+/// from the old generation to the new one, and when the new generation is full it becomes the old
+/// one (dropping the previous old generation). Frequent chunks survive, everything is O(1).
+struct ChunkCache {
+    capacity: usize,
+    new: AHashMap<CompactString, Vec<u32>>,
+    old: AHashMap<CompactString, Vec<u32>>,
+}
+
+impl ChunkCache {
+    fn new(capacity: usize) -> Self {
+        Self {
+            capacity,
+            new: AHashMap::new(),
+            old: AHashMap::new(),
+        }
+    }
+
+    fn clear(&mut self) {
+        self.new.clear();
+        self.old.clear();
+    }
+
+    fn get(&mut self, chunk: &str) -> Option<&Vec<u32>> {
+        if !self.new.contains_key(chunk) {
+            let (key, ids) = self.old.remove_entry(chunk)?;
+            self.insert(key, ids);
+        }
+        self.new.get(chunk)
+    }
+
+    fn insert(&mut self, chunk: CompactString, ids: Vec<u32>) {
+        // each generation holds up to half of the capacity
+        if self.new.len() >= (self.capacity / 2).max(1) {
+            self.old = std::mem::take(&mut self.new);
+        }
+        self.new.insert(chunk, ids);
+    }
+}
+
+/// Apply the merges to the bytes of one chunk, lowest rank (= merged token id) first, and among
+/// equal ranks leftmost first. The tokens form a linked list over the chunk, and a min-heap holds
+/// the candidate pairs (rank, position of the left token). Entries are validated lazily when
+/// popped, so a merge costs O(log n) instead of a rescan of the whole chunk.
+fn merge_chunk(merges: &StdHashMap<Pair, u32>, chunk: &[u8]) -> Vec<u32> {
+    let mut ids: Vec<u32> = chunk.iter().map(|&b| b as u32).collect();
+    let n = ids.len();
+    if n < 2 {
+        return ids;
+    }
+    const NONE: usize = usize::MAX;
+    let mut prev: Vec<usize> = (0..n).map(|i| if i == 0 { NONE } else { i - 1 }).collect();
+    let mut next: Vec<usize> = (0..n).map(|i| if i + 1 < n { i + 1 } else { NONE }).collect();
+    let mut alive = vec![true; n];
+
+    let mut heap: BinaryHeap<Reverse<(u32, usize)>> = BinaryHeap::with_capacity(n);
+    for i in 0..n - 1 {
+        if let Some(&rank) = merges.get(&(ids[i], ids[i + 1])) {
+            heap.push(Reverse((rank, i)));
+        }
+    }
+
+    while let Some(Reverse((rank, i))) = heap.pop() {
+        // skip the stale entries: the left token was merged away or the pair changed since
+        let j = next[i];
+        if !alive[i] || j == NONE || merges.get(&(ids[i], ids[j])) != Some(&rank) {
+            continue;
+        }
+        // merge j into i
+        ids[i] = rank;
+        alive[j] = false;
+        next[i] = next[j];
+        if next[j] != NONE {
+            prev[next[j]] = i;
+        }
+        // the pairs that the merged token forms with its neighbours
+        if prev[i] != NONE {
+            if let Some(&r) = merges.get(&(ids[prev[i]], ids[i])) {
+                heap.push(Reverse((r, prev[i])));
+            }
+        }
+        if next[i] != NONE {
+            if let Some(&r) = merges.get(&(ids[i], ids[next[i]])) {
+                heap.push(Reverse((r, i)));
+            }
+        }
+    }
+
+    (0..n).filter(|&i| alive[i]).map(|i| ids[i]).collect()
+}
+
 // ------------------------ END helpers ------------------------
 
 impl Tokenizer {
@@ -254,26 +441,64 @@ impl Tokenizer {
 
         log::info!("Finished training: {} merges completed", merges_done);
     }
+
+    /// Split text into the chunks that are encoded independently
+    fn split_chunks<'a>(&'a self, text: &'a str) -> Box<dyn Iterator<Item = &'a str> + 'a> {
+        match &self.pretokenizer {
+            Some(pretokenizer) => Box::new(pretokenizer.split(text)),
+            None => Box::new(
+                self.compiled_pattern
+                    .find_iter(text)
+                    .map(|m| m.expect("regex match failed").as_str()),
+            ),
+        }
+    }
+
+    /// Encode a string, looking up and filling the given chunk cache
+    fn encode_with_cache(&self, text: &str, cache: &mut ChunkCache) -> Vec<u32> {
+        let mut all_ids = Vec::new();
+        for chunk in self.split_chunks(text) {
+            if self.cache_size == 0 || chunk.len() > MAX_CACHED_CHUNK_LEN {
+                all_ids.extend(merge_chunk(&self.merges, chunk.as_bytes()));
+                continue;
+            }
+            if let Some(ids) = cache.get(chunk) {
+                all_ids.extend_from_slice(ids);
+                continue;
+            }
+            let ids = merge_chunk(&self.merges, chunk.as_bytes());
+            all_ids.extend_from_slice(&ids);
+            cache.insert(CompactString::from(chunk), ids);
+        }
+        all_ids
+    }
 }
 
 /// Public methods for the Tokenizer class that will be exposed to Python.
 #[pymethods]
 impl Tokenizer {
-    /// Create a new Tokenizer
+    /// Create a new Tokenizer, `cache_size` is the number of chunks kept in the encode cache
     #[new]
-    pub fn new() -> Self {
+    #[pyo3(signature = (cache_size=DEFAULT_CACHE_SIZE))]
+    pub fn new(cache_size: usize) -> Self {
         Self {
             merges: StdHashMap::new(),
             pattern: String::new(),
             compiled_pattern: Regex::new("").expect("Empty regex should be valid"),
+            pretokenizer: None,
+            cache: Mutex::new(ChunkCache::new(cache_size)),
+            cache_size,
         }
     }
 
-    /// Train from a streaming iterator (parallel ingestion).
-    /// We refill a Rust Vec<String> buffer under the GIL, then release the GIL
-    /// to do the heavy splitting and counting **in parallel** with rayon.
-    #[pyo3(signature = (iterator, vocab_size, buffer_size=8192, pattern=None))]
-    #[pyo3(text_signature = "(self, iterator, vocab_size, buffer_size=8192, pattern=None)")]
+    /// Train from a streaming iterator of texts, or of lists of texts (e.g. the row groups of a parquet file).
+    /// Ingestion is pipelined: this thread refills a Vec<String> buffer under the GIL, while a counting
+    /// thread splits and counts the previous buffer **in parallel** with rayon, without the GIL.
+    /// - doc_cap: crop every text to this many characters
+    /// - max_chars: stop after this many characters (after cropping)
+    /// - max_unique_chunks: bound the memory of the chunk counts, the rarest chunks are dropped beyond it
+    #[pyo3(signature = (iterator, vocab_size, buffer_size=8192, pattern=None, doc_cap=None, max_chars=None, max_unique_chunks=None))]
+    #[pyo3(text_signature = "(self, iterator, vocab_size, buffer_size=8192, pattern=None, doc_cap=None, max_chars=None, max_unique_chunks=None)")]
     pub fn train_from_iterator(
         &mut self,
         py: pyo3::Python<'_>,
@@ -281,6 +506,9 @@ impl Tokenizer {
         vocab_size: u32,
         buffer_size: usize,
         pattern: Option<String>,
+        doc_cap: Option<usize>,
+        max_chars: Option<u64>,
+        max_unique_chunks: Option<usize>,
     ) -> PyResult<()> {
         // Use provided pattern or default to GPT-4 pattern
         let pattern_str = pattern.unwrap_or_else(|| GPT4_PATTERN.to_string());
@@ -289,102 +517,119 @@ impl Tokenizer {
         self.pattern = pattern_str.clone();
         self.compiled_pattern = Regex::new(&pattern_str)
             .map_err(|e| pyo3::exceptions::PyValueError::new_err(format!("Invalid regex pattern: {}", e)))?;
+        self.pretokenizer = Pretokenizer::for_pattern(&pattern_str);
+        // The cached encodings are for the previous merges
+        self.cache.lock().unwrap().clear();
 
         // Prepare a true Python iterator object
         let py_iter: pyo3::Py<pyo3::PyAny> = unsafe {
             pyo3::Py::from_owned_ptr_or_err(py, pyo3::ffi::PyObject_GetIter(iterator.as_ptr()))?
         };
 
-        // Global chunk counts
-        let mut counts: AHashMap<CompactString, i32> = AHashMap::new();
-
-        // Temporary buffer we refill under the GIL
-        let mut buf: Vec<String> = Vec::with_capacity(buffer_size);
-
         log::info!("Processing sequences from iterator (buffer_size: {})", buffer_size);
         let mut total_sequences = 0u64;
-
-        // Helper: refill `buf` with up to `buffer_size` strings from the Python iterator.
-        // Returns Ok(true) if the iterator is exhausted, Ok(false) otherwise.
-        let refill = |buf: &mut Vec<String>| -> PyResult<bool> {
-            pyo3::Python::with_gil(|py| {
-                buf.clear();
-                let it = py_iter.bind(py);
-                loop {
-                    if buf.len() >= buffer_size {
-                        return Ok(false);
+        let mut total_chars = 0u64;
+
+        // Helper: refill `buf` with up to `buffer_size` strings from the Python iterator (we hold the GIL).
+        // Returns Ok(true) if the iterator is exhausted or max_chars is reached, Ok(false) otherwise.
+        let refill = |buf: &mut Vec<String>, total_chars: &mut u64| -> PyResult<bool> {
+            let it = py_iter.bind(py);
+            let mut push = |mut s: String| -> bool {
+                if let Some((end, _)) = doc_cap.and_then(|cap| s.char_indices().nth(cap)) {
+                    s.truncate(end);
+                }
+                *total_chars += s.chars().count() as u64;
+                buf.push(s);
+                max_chars.is_some_and(|max_chars| *total_chars > max_chars)
+            };
+            let mut len = 0;
+            while len < buffer_size {
+                // next(it)
+                let next_obj = unsafe {
+                    pyo3::Bound::from_owned_ptr_or_opt(py, pyo3::ffi::PyIter_Next(it.as_ptr()))
+                };
+                let Some(obj) = next_obj else {
+                    if pyo3::PyErr::occurred(py) {
+                        return Err(pyo3::PyErr::fetch(py));
                     }
-                    // next(it)
-                    let next_obj = unsafe {
-                        pyo3::Bound::from_owned_ptr_or_opt(py, pyo3::ffi::PyIter_Next(it.as_ptr()))
-                    };
-                    match next_obj {
-                        Some(obj) => {
-                            let s: String = obj.extract()?;
-                            buf.push(s);
-                        }
-                        None => {
-                            if pyo3::PyErr::occurred(py) {
-                                return Err(pyo3::PyErr::fetch(py));
-                            } else {
-                                return Ok(true); // exhausted
-                            }
+                    return Ok(true); // exhausted
+                };
+                if let Ok(s) = obj.extract::<String>() {
+                    len += 1;
+                    if push(s) {
+                        return Ok(true);
+                    }
+                } else {
+                    let batch: Vec<String> = obj.extract()?;
+                    for s in batch {
+                        len += 1;
+                        if push(s) {
+                            return Ok(true);
                         }
                     }
                 }
-            })
-        };
-
-        // Stream ingestion loop: refill under GIL, process without GIL (parallel)
-        loop {
-            let exhausted = refill(&mut buf)?;
-            if buf.is_empty() && exhausted {
-                break;
             }
+            Ok(false)
+        };
 
-            total_sequences += buf.len() as u64;
-
-            let pattern = self.compiled_pattern.clone();
-            let local: AHashMap<CompactString, i32> = py.allow_threads(|| {
-                buf.par_iter()
-                    .map(|s| {
-                        let mut m: AHashMap<CompactString, i32> = AHashMap::new();
-                        for mat in pattern.find_iter(s) {
-                            let piece = mat.expect("regex match failed").as_str();
-                            *m.entry(CompactString::from(piece)).or_default() += 1;
+        // The channel holds one buffer: at most three buffers are in memory (filling, queued, counting)
+        let (tx, rx) = std::sync::mpsc::sync_channel::<Vec<String>>(1);
+        let unique_chunks = AtomicUsize::new(0);
+        let this = &*self;
+        let (ingested, counts) = std::thread::scope(|scope| {
+            let unique_chunks = &unique_chunks;
+            let counter = scope.spawn(move || {
+                let mut counts = ChunkCounts::new();
+                for buf in rx {
+                    counts.add_texts(this, &buf);
+                    if let Some(max_unique) = max_unique_chunks {
+                        if counts.len() > max_unique {
+                            counts.prune(max_unique * 3 / 4);
                         }
-                        m
-                    })
-                    .reduce(
-                        || AHashMap::new(),
-                        |mut a, b| {
-                            for (k, v) in b {
-                                *a.entry(k).or_default() += v;
-                            }
-                            a
-                        },
-                    )
+                    }
+                    unique_chunks.store(counts.len(), AtomicOrdering::Relaxed);
+                }
+                counts
             });
 
-            // Merge local into global (single-threaded)
-            for (k, v) in local {
-                *counts.entry(k).or_default() += v;
-            }
-
-            if exhausted {
-                break;
-            }
+            let start = Instant::now();
+            let mut last_log = start;
+            let mut ingest = || -> PyResult<()> {
+                loop {
+                    let mut buf = Vec::with_capacity(buffer_size);
+                    let exhausted = refill(&mut buf, &mut total_chars)?;
+                    total_sequences += buf.len() as u64;
+                    if !buf.is_empty() {
+                        // blocks while the counting thread is busy with the previous buffer
+                        py.allow_threads(|| tx.send(buf)).expect("counting thread exited");
+                    }
+                    if last_log.elapsed().as_secs_f64() >= 10.0 || exhausted {
+                        last_log = Instant::now();
+                        let elapsed = start.elapsed().as_secs_f64();
+                        log::info!(
+                            "Ingested {} sequences, {:.1}M chars ({:.1}M chars/s), {} unique chunks",
+                            total_sequences, total_chars as f64 / 1e6, total_chars as f64 / 1e6 / elapsed.max(1e-9),
+                            unique_chunks.load(AtomicOrdering::Relaxed)
+                        );
+                    }
+                    if exhausted {
+                        return Ok(());
+                    }
+                }
+            };
+            let ingested = ingest();
+            drop(tx);
+            let counts = py.allow_threads(|| counter.join().expect("counting thread panicked"));
+            (ingested, counts)
+        });
+        ingested?;
+        if counts.pruned_below > 0 {
+            log::info!("Dropped the chunks seen up to {} times to stay under {} unique chunks", counts.pruned_below, max_unique_chunks.unwrap_or(0));
         }
         log::info!("Processed {} sequences total, {} unique", total_sequences, counts.len());
 
         // Materialize words & counts
-        let mut words = Vec::with_capacity(counts.len());
-        let mut cvec = Vec::with_capacity(counts.len());
-        for (chunk, c) in counts.into_iter() {
-            words.push(Word::new(chunk.as_bytes().iter().map(|&b| b as u32).collect()));
-            cvec.push(c);
-        }
-
+        let (words, cvec) = counts.into_words();
         self.train_core_incremental(words, cvec, vocab_size);
         Ok(())
     }
@@ -425,45 +670,34 @@ impl Tokenizer {
         mergeable_ranks
     }
 
-    /// Encode a string into token IDs
-    pub fn encode(&self, text: &str) -> Vec<u32> {
-        let mut all_ids = Vec::new();
-
-        // Split text using the regex pattern
-        for m in self.compiled_pattern.find_iter(text) {
-            let chunk = m.expect("regex match failed").as_str();
-
-            // Convert chunk to bytes then to u32 IDs
-            let mut ids: Vec<u32> = chunk.bytes().map(|b| b as u32).collect();
-
-            // Apply merges iteratively
-            while ids.len() >= 2 {
-                // Find the best pair to merge
-                let mut best_pair: Option<(usize, Pair, u32)> = None;
-
-                for i in 0..ids.len() - 1 {
-                    let pair: Pair = (ids[i], ids[i + 1]);
-                    if let Some(&new_id) = self.merges.get(&pair) {
-                        if best_pair.is_none() || new_id < best_pair.unwrap().2 {
-                            best_pair = Some((i, pair, new_id));
-                        }
-                    }
-                }
+    /// Split a string into the chunks of the pattern (with the hand-written scanner when it applies)
+    pub fn split(&self, text: &str) -> Vec<String> {
+        self.split_chunks(text).map(|chunk| chunk.to_string()).collect()
+    }
 
-                // If we found a pair to merge, apply it
-                if let Some((idx, _pair, new_id)) = best_pair {
-                    ids[idx] = new_id;
-                    ids.remove(idx + 1);
-                } else {
-                    // No more merges possible
-                    break;
-                }
-            }
+    /// Whether the hand-written scanner is used instead of the regex
+    pub fn uses_fast_split(&self) -> bool {
+        self.pretokenizer.is_some()
+    }
 
-            all_ids.extend(ids);
-        }
+    /// Encode a string into token IDs
+    pub fn encode(&self, text: &str) -> Vec<u32> {
+        let mut cache = self.cache.lock().unwrap();
+        self.encode_with_cache(text, &mut cache)
+    }
 
-        all_ids
+    /// Encode a list of strings into lists of token IDs, in parallel with rayon and without the GIL.
+    /// Each rayon job has its own chunk cache, so the workers never contend on a lock.
+    pub fn batch_encode(&self, py: pyo3::Python<'_>, texts: Vec<String>) -> Vec<Vec<u32>> {
+        py.allow_threads(|| {
+            texts
+                .par_iter()
+                .map_init(
+                    || ChunkCache::new(self.cache_size),
+                    |cache, text| self.encode_with_cache(text, cache),
+                )
+                .collect()
+        })
     }
 }
 
@@ -0,0 +1,211 @@
+//! A hand-written scanner for the GPT-4 style split pattern, which is where most of the encode time
+//! goes with fancy_regex (possessive quantifiers and the lookahead run on its backtracking VM):
+//!
+//! '(?i:[sdmt]|ll|ve|re)|[^\r\n\p{L}\p{N}]?+\p{L}+|\p{N}{1,K}| ?[^\s\p{L}\p{N}]++[\r\n]*|\s*[\r\n]|\s+(?!\S)|\s+
+//!
+//! It produces exactly the same chunks as the regex, for any K (GPT-4 uses 3, nanochat 2), in a
+//! single forward pass without allocating. The Unicode classes \p{L}, \p{N} and \s come from the
+//! tables of regex-syntax, the same ones the regex uses.
+
+use regex_syntax::hir::{Class, HirKind};
+
+const LETTER: u8 = 1;
+const NUMBER: u8 = 2;
+const SPACE: u8 = 4;
+
+/// The split pattern with at most `max_digits` digits per number chunk
+pub fn split_pattern(max_digits: usize) -> String {
+    format!(
+        r"'(?i:[sdmt]|ll|ve|re)|[^\r\n\p{{L}}\p{{N}}]?+\p{{L}}+|\p{{N}}{{1,{}}}| ?[^\s\p{{L}}\p{{N}}]++[\r\n]*|\s*[\r\n]|\s+(?!\S)|\s+",
+        max_digits
+    )
+}
+
+/// The ranges of a Unicode character class, e.g. r"\p{L}"
+fn class_ranges(class: &str) -> Vec<(char, char)> {
+    let hir = regex_syntax::parse(class).expect("invalid character class");
+    match hir.kind() {
+        HirKind::Class(Class::Unicode(cls)) => cls.ranges().iter().map(|r| (r.start(), r.end())).collect(),
+        _ => panic!("not a Unicode character class: {}", class),
+    }
+}
+
+#[inline]
+fn in_ranges(ranges: &[(char, char)], c: char) -> bool {
+    ranges
+        .binary_search_by(|&(lo, hi)| {
+            if hi < c {
+                std::cmp::Ordering::Less
+            } else if lo > c {
+                std::cmp::Ordering::Greater
+            } else {
+                std::cmp::Ordering::Equal
+            }
+        })
+        .is_ok()
+}
+
+#[inline]
+fn char_at(text: &str, pos: usize) -> Option<char> {
+    text[pos..].chars().next()
+}
+
+#[derive(Clone, Debug)]
+pub struct Pretokenizer {
+    max_digits: usize,
+    ascii: [u8; 128],
+    letters: Vec<(char, char)>,
+    numbers: Vec<(char, char)>,
+    spaces: Vec<(char, char)>,
+}
+
+impl Pretokenizer {
+    pub fn new(max_digits: usize) -> Self {
+        assert!(max_digits >= 1, "max_digits must be at least 1");
+        let letters = class_ranges(r"\p{L}");
+        let numbers = class_ranges(r"\p{N}");
+        let spaces = class_ranges(r"\s");
+        let mut pretokenizer = Self { max_digits, ascii: [0; 128], letters, numbers, spaces };
+        for b in 0..128u8 {
+            pretokenizer.ascii[b as usize] = pretokenizer.lookup(b as char);
+        }
+        pretokenizer
+    }
+
+    /// The scanner for `pattern`, if it is one of the split patterns it implements
+    pub fn for_pattern(pattern: &str) -> Option<Self> {
+        (1..=9).find(|&k| pattern == split_pattern(k)).map(Self::new)
+    }
+
+    fn lookup(&self, c: char) -> u8 {
+        let mut flags = 0;
+        if in_ranges(&self.letters, c) {
+            flags |= LETTER;
+        }
+        if in_ranges(&self.numbers, c) {
+            flags |= NUMBER;
+        }
+        if in_ranges(&self.spaces, c) {
+            flags |= SPACE;
+        }
+        flags
+    }
+
+    #[inline]
+    fn flags(&self, c: char) -> u8 {
+        if c.is_ascii() { self.ascii[c as usize] } else { self.lookup(c) }
+    }
+
+    /// The end of the run of characters, starting at `pos`, whose flags intersect `mask`
+    /// (or are empty when `mask` is 0)
+    #[inline]
+    fn skip(&self, text: &str, mut pos: usize, mask: u8) -> usize {
+        while let Some(c) = char_at(text, pos) {
+            let flags = self.flags(c);
+            if (mask == 0 && flags != 0) || (mask != 0 && flags & mask == 0) {
+                break;
+            }
+            pos += c.len_utf8();
+        }
+        pos
+    }
+
+    /// The end of the chunk that starts at `start` (< text.len()). The alternatives of the pattern
+    /// are tried in order, as the regex does.
+    fn chunk_end(&self, text: &str, start: usize) -> usize {
+        let c = char_at(text, start).unwrap();
+        let next = start + c.len_utf8();
+
+        // '(?i:[sdmt]|ll|ve|re), the long s (U+017F) case-folds to s
+        if c == '\'' {
+            if let Some(d) = char_at(text, next) {
+                if matches!(d, 's' | 'S' | '\u{17F}' | 'd' | 'D' | 'm' | 'M' | 't' | 'T') {
+                    return next + d.len_utf8();
+                }
+                if let Some(e) = char_at(text, next + d.len_utf8()) {
+                    let (d, e) = (d.to_ascii_lowercase(), e.to_ascii_lowercase());
+                    if matches!((d, e), ('l', 'l') | ('v', 'e') | ('r', 'e')) {
+                        return next + 2;
+                    }
+                }
+            }
+        }
+
+        // [^\r\n\p{L}\p{N}]?+\p{L}+
+        let flags = self.flags(c);
+        let letters_start = if flags & LETTER != 0 {
+            Some(start)
+        } else if flags & NUMBER == 0 && c != '\r' && c != '\n' {
+            Some(next) // the optional character is taken possessively
+        } else {
+            None
+        };
+        if let Some(letters_start) = letters_start {
+            let end = self.skip(text, letters_start, LETTER);
+            if end > letters_start {
+                return end;
+            }
+        }
+
+        // \p{N}{1,K}
+        if flags & NUMBER != 0 {
+            let mut end = start;
+            for _ in 0..self.max_digits {
+                match char_at(text, end) {
+                    Some(d) if self.flags(d) & NUMBER != 0 => end += d.len_utf8(),
+                    _ => break,
+                }
+            }
+            return end;
+        }
+
+        //  ?[^\s\p{L}\p{N}]++[\r\n]*
+        let punct_start = if c == ' ' { next } else { start };
+        let end = self.skip(text, punct_start, 0);
+        if end > punct_start {
+            return end + text[end..].bytes().take_while(|&b| b == b'\r' || b == b'\n').count();
+        }
+
+        // c is whitespace from here on: scan its run, noting the last newline and the last character
+        let mut pos = start;
+        let mut after_newline = None;
+        let mut last_start = start;
+        while let Some(d) = char_at(text, pos) {
+            if self.flags(d) & SPACE == 0 {
+                break;
+            }
+            last_start = pos;
+            pos += d.len_utf8();
+            if d == '\r' || d == '\n' {
+                after_newline = Some(pos);
+            }
+        }
+        // \s*[\r\n]
+        if let Some(end) = after_newline {
+            return end;
+        }
+        // \s+(?!\S): the whole run at the end of the text, else all but its last character
+        if pos == text.len() {
+            return pos;
+        }
+        if last_start > start {
+            return last_start;
+        }
+        // \s+
+        pos
+    }
+
+    /// The chunks of `text`, in order; they cover the whole text
+    pub fn split<'a>(&'a self, text: &'a str) -> impl Iterator<Item = &'a str> + 'a {
+        let mut pos = 0;
+        std::iter::from_fn(move || {
+            if pos >= text.len() {
+                return None;
+            }
+            let end = self.chunk_end(text, pos);
+            let chunk = &text[pos..end];
+            pos = end;
+            Some(chunk)
+        })
+    }
+}
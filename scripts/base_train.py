@@ -18,11 +18,14 @@ from contextlib import nullcontext
 
 import wandb
 import torch
+import torch.distributed as dist
 
 from nanochat.gpt import GPT, GPTConfig
 from nanochat.dataloader import tokenizing_distributed_data_loader, tokenizing_distributed_data_loader_with_state
+from nanochat.dataloader import pretokenized_distributed_data_loader, pretokenized_distributed_data_loader_with_state
+from nanochat.token_shards import has_token_shards, read_meta
 from nanochat.common import compute_init, compute_cleanup, print0, DummyWandb, print_banner, get_base_dir, autodetect_device_type
-from nanochat.tokenizer import get_tokenizer, get_token_bytes
+from nanochat.tokenizer import get_tokenizer, get_token_bytes, get_tokenizer_fingerprint
 from nanochat.checkpoint_manager import save_checkpoint, load_checkpoint
 from nanochat.loss_eval import evaluate_bpb
 from nanochat.engine import Engine
@@ -37,12 +40,15 @@ device_type = "" # cuda|cpu|mps (empty => autodetect good device type default, i
 # Model architecture
 depth = 20 # the depth of the Transformer model to train, rest of the kwargs are derived
 max_seq_len = 2048 # max context length
+sliding_window = 0 # attention window of the local layers (0 = full causal attention in every layer)
+window_pattern = "LLLG" # which layers are local (L) or global (G), tiled across the depth
 # Training horizon. Only one of these 3 will be used, in this order of precedence.
 num_iterations = -1 # explicit number of steps of the optimization (-1 = disable)
 target_flops = -1.0 # calculate num_iterations to reach target_flops. Useful for scaling laws experiments (-1 = disable)
 target_param_data_ratio = 20 # calculate num_iterations to maintain fixed data:param ratio (Chinchilla=20) (-1 = disable)
 # Optimization
 device_batch_size = 32 # per-device batch size (set to not OOM)
+dataloader_prefetch = 4 # number of train batches prepared ahead in a background thread (0 = load synchronously)
 total_batch_size = 524288 # total desired batch size, in #tokens
 embedding_lr = 0.2 # learning rate for the embedding parameters (Adam)
 unembedding_lr = 0.004 # learning rate for the unembedding parameters (Adam)
@@ -95,6 +101,8 @@ print0(f"num_layers: {num_layers}")
 print0(f"model_dim: {model_dim}")
 print0(f"num_heads: {num_heads}")
 print0(f"num_kv_heads: {num_kv_heads}")
+if sliding_window > 0:
+    print0(f"sliding_window: {sliding_window} (window_pattern: {window_pattern})")
 
 # Optimizer / data / training length related hyperparameters
 # figure out the needed gradient accumulation to reach the desired total batch size
@@ -110,7 +118,7 @@ print0(f"Total batch size {total_batch_size:,} => gradient accumulation steps: {
 # Initialize the Model
 
 # Create a new model with random weights
-model_config_kwargs = dict(sequence_len=max_seq_len, vocab_size=vocab_size, n_layer=num_layers, n_head=num_heads, n_kv_head=num_kv_heads, n_embd=model_dim)
+model_config_kwargs = dict(sequence_len=max_seq_len, vocab_size=vocab_size, n_layer=num_layers, n_head=num_heads, n_kv_head=num_kv_heads, n_embd=model_dim, sliding_window=sliding_window, window_pattern=window_pattern)
 with torch.device("meta"):
     model_config = GPTConfig(**model_config_kwargs)
     model = GPT(model_config)
@@ -168,9 +176,31 @@ if resuming:
 # -----------------------------------------------------------------------------
 # Initialize the DataLoaders for train/val
 tokens_dir = os.path.join(base_dir, "tokenized_data")
-dataloader_resume_state_dict = None if not resuming else meta_data["dataloader_state_dict"]
-train_loader = tokenizing_distributed_data_loader_with_state(device_batch_size, max_seq_len, split="train", device=device, resume_state_dict=dataloader_resume_state_dict)
-build_val_loader = lambda: tokenizing_distributed_data_loader(device_batch_size, max_seq_len, split="val", device=device)
+dataloader_resume_state_dict = None
+if resuming:
+    # the checkpoint has the dataloader state of every rank; the ranks of the tokenizing loader read different row
+    # groups so each resumes from its own state, the state of the pre-tokenized loader is the same on all ranks.
+    # Checkpoints from before the per-rank states have the state of rank 0 only.
+    dataloader_state_dicts = meta_data.get("dataloader_state_dicts") or [meta_data.get("dataloader_state_dict")]
+    pretokenized = has_token_shards(tokens_dir)
+    state_key = "token_offset" if pretokenized else "doc_index" # tells which loader a state is from
+    if any(state is None or state_key not in state for state in dataloader_state_dicts):
+        print0(f"WARNING: the checkpoint has no dataloader state for the {'pre-tokenized' if pretokenized else 'tokenizing'} dataloader, the data starts over from the beginning")
+    elif pretokenized:
+        dataloader_resume_state_dict = dataloader_state_dicts[0]
+    elif len(dataloader_state_dicts) != ddp_world_size:
+        print0(f"WARNING: the checkpoint has the dataloader state of {len(dataloader_state_dicts)} ranks, not {ddp_world_size}, the data starts over from the beginning")
+    else:
+        dataloader_resume_state_dict = dataloader_state_dicts[ddp_rank]
+if has_token_shards(tokens_dir):
+    # the data was tokenized ahead of time by scripts/tok_data.py, read the batches from the token files
+    print0(f"Reading pre-tokenized data from {tokens_dir}")
+    assert read_meta(tokens_dir).get("tokenizer") == get_tokenizer_fingerprint(), "The pre-tokenized data was made with another tokenizer, re-run scripts/tok_data.py"
+    train_loader = pretokenized_distributed_data_loader_with_state(device_batch_size, max_seq_len, "train", tokens_dir, device=device, resume_state_dict=dataloader_resume_state_dict, prefetch=dataloader_prefetch)
+    build_val_loader = lambda: pretokenized_distributed_data_loader(device_batch_size, max_seq_len, "val", tokens_dir, device=device)
+else:
+    train_loader = tokenizing_distributed_data_loader_with_state(device_batch_size, max_seq_len, split="train", device=device, resume_state_dict=dataloader_resume_state_dict, prefetch=dataloader_prefetch)
+    build_val_loader = lambda: tokenizing_distributed_data_loader(device_batch_size, max_seq_len, split="val", device=device)
 x, y, dataloader_state_dict = next(train_loader) # kick off load of the very first batch of data
 
 # -----------------------------------------------------------------------------
@@ -273,6 +303,10 @@ while True:
 
     # save checkpoint: at the end of the run, or every save_every steps, except at the first step or the resume step
     if last_step or (step > 0 and step != resume_from_step and save_every > 0 and step % save_every == 0):
+        dataloader_state_dicts = [dataloader_state_dict] # the dataloader state of every rank, for an exact resume
+        if ddp:
+            dataloader_state_dicts = [None] * ddp_world_size
+            dist.all_gather_object(dataloader_state_dicts, dataloader_state_dict)
         save_checkpoint(
             checkpoint_dir,
             step,
@@ -285,7 +319,7 @@ while True:
                 "user_config": user_config, # inputs to the training script
                 "device_batch_size": device_batch_size,
                 "max_seq_len": max_seq_len,
-                "dataloader_state_dict": dataloader_state_dict,
+                "dataloader_state_dicts": dataloader_state_dicts,
                 "loop_state": { # all loop state (other than step) so that we can resume training
                     "min_val_bpb": min_val_bpb,
                     "smooth_train_loss": smooth_train_loss,
@@ -344,7 +378,9 @@ while True:
     if step > 10:
         total_training_time += dt # only count the time after the first 10 steps
     print_grad_norm = f" grad norm: {grad_norm:.4f} |" if grad_clip_enabled else ""
-    print0(f"step {step:05d}/{num_iterations:05d} ({pct_done:.2f}%) | loss: {debiased_smooth_loss:.6f} |{print_grad_norm} lrm: {lrm:.2f} | dt: {dt * 1000:.2f}ms | tok/sec: {tok_per_sec:,} | mfu: {mfu:.2f} | total time: {total_training_time/60:.2f}m")
+    loader_stats = train_loader.stats() if dataloader_prefetch > 0 else None # is the dataloader keeping up?
+    print_loader = f" loader queue: {loader_stats['queue_size']}/{loader_stats['queue_depth']} |" if loader_stats else ""
+    print0(f"step {step:05d}/{num_iterations:05d} ({pct_done:.2f}%) | loss: {debiased_smooth_loss:.6f} |{print_grad_norm} lrm: {lrm:.2f} | dt: {dt * 1000:.2f}ms | tok/sec: {tok_per_sec:,} | mfu: {mfu:.2f} |{print_loader} total time: {total_training_time/60:.2f}m")
     if step % 100 == 0:
         log_data = {
             "step": step,
@@ -358,6 +394,10 @@ while True:
         }
         if grad_clip_enabled:
             log_data["train/grad_norm"] = grad_norm
+        if loader_stats:
+            log_data["train/loader_queue"] = loader_stats["queue_size"]
+            log_data["train/loader_wait_fraction"] = loader_stats["wait_fraction"]
+            log_data["train/loader_wait_time"] = loader_stats["wait_time"]
         wandb_run.log(log_data)
 
     # state update
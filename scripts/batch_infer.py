@@ -0,0 +1,82 @@
+"""
+Offline batch inference: generate responses for a JSONL file of conversations on all GPUs.
+See nanochat/batch.py for the input/output format. Rerunning the same command after a crash
+resumes where it left off (the output file is the checkpoint).
+
+python -m scripts.batch_infer -i sft --input prompts.jsonl --output responses.jsonl --num-gpus 8
+"""
+import argparse
+import queue
+import threading
+import time
+import torch
+from contextlib import nullcontext
+from nanochat.common import compute_init, autodetect_device_type
+from nanochat.engine import Engine
+from nanochat.checkpoint_manager import load_model
+from nanochat.batch import BatchJob, generate_batch_results
+
+parser = argparse.ArgumentParser(description='Batch inference over a JSONL file of conversations')
+parser.add_argument('--input', type=str, required=True, help='Input JSONL file, one conversation per line')
+parser.add_argument('--output', type=str, required=True, help='Output JSONL file, appended to (and resumed from)')
+parser.add_argument('-i', '--source', type=str, default="sft", help="Source of the model: sft|mid|rl|exit")
+parser.add_argument('-g', '--model-tag', type=str, default=None, help='Model tag to load')
+parser.add_argument('-s', '--step', type=int, default=None, help='Step to load')
+parser.add_argument('-n', '--num-gpus', type=int, default=1, help='Number of GPUs to use (default: 1)')
+parser.add_argument('-b', '--batch-size', type=int, default=16, help='Conversations generated together per batch')
+parser.add_argument('-t', '--temperature', type=float, default=0.0, help='Default temperature, for lines that do not set one')
+parser.add_argument('-k', '--top-k', type=int, default=50, help='Default top-k, for lines that do not set one')
+parser.add_argument('-m', '--max-tokens', type=int, default=512, help='Default max tokens, for lines that do not set one')
+parser.add_argument('--device-type', type=str, default='', choices=['cuda', 'cpu', 'mps'], help='Device type for evaluation: cuda|cpu|mps. empty => autodetect')
+parser.add_argument('-d', '--dtype', type=str, default='bfloat16', choices=['float32', 'bfloat16'])
+args = parser.parse_args()
+
+device_type = autodetect_device_type() if args.device_type == "" else args.device_type
+ddp, ddp_rank, ddp_local_rank, ddp_world_size, device = compute_init(device_type)
+ptdtype = torch.float32 if args.dtype == 'float32' else torch.bfloat16
+if args.num_gpus > 1:
+    assert device_type == "cuda", "Only CUDA supports multiple workers/GPUs. cpu|mps does not."
+
+# Load a model replica per GPU
+replicas = []
+for gpu_id in range(args.num_gpus):
+    replica_device = torch.device(f"cuda:{gpu_id}") if device_type == "cuda" else device
+    model, tokenizer, _ = load_model(args.source, replica_device, phase="eval", model_tag=args.model_tag, step=args.step)
+    autocast_ctx = torch.amp.autocast(device_type=device_type, dtype=ptdtype) if device_type == "cuda" else nullcontext()
+    replicas.append((Engine(model, tokenizer), autocast_ctx))
+
+# Read the job, skipping what a previous run already finished
+sampling = {"temperature": args.temperature, "top_k": args.top_k, "max_tokens": args.max_tokens}
+job = BatchJob(args.input, args.output, tokenizer, batch_size=args.batch_size, sampling=sampling)
+print(f"{job.num_done}/{job.num_total} conversations already done, {len(job.batches)} batches to go")
+
+# One thread per replica, pulling batches off a shared queue until it is empty
+batches = queue.Queue()
+for batch in job.batches:
+    batches.put(batch)
+errors = []
+
+def run_replica(engine, autocast_ctx):
+    while not errors:
+        try:
+            sampling, items = batches.get_nowait()
+        except queue.Empty:
+            return
+        try:
+            with autocast_ctx:
+                results = generate_batch_results(engine, tokenizer, sampling, items)
+            job.write_results(results)
+        except Exception as e:
+            errors.append(e)
+
+t0 = time.time()
+threads = [threading.Thread(target=run_replica, args=replica, daemon=True) for replica in replicas]
+for thread in threads:
+    thread.start()
+while any(thread.is_alive() for thread in threads):
+    time.sleep(5.0)
+    elapsed = time.time() - t0
+    print(f"{job.num_done}/{job.num_total} done | {job.num_tokens} tokens | {job.num_tokens / elapsed:.1f} tok/s")
+if errors:
+    raise errors[0]
+print(f"Done: {job.num_done}/{job.num_total} conversations in {time.time() - t0:.1f}s, results in {args.output}")
@@ -8,11 +8,11 @@ import argparse
 import torch
 from nanochat.common import compute_init, autodetect_device_type
 from contextlib import nullcontext
-from nanochat.engine import Engine
+from nanochat.engine import Engine, KVCache
 from nanochat.checkpoint_manager import load_model
 
 parser = argparse.ArgumentParser(description='Chat with the model')
-parser.add_argument('-i', '--source', type=str, default="sft", help="Source of the model: sft|mid|rl")
+parser.add_argument('-i', '--source', type=str, default="sft", help="Source of the model: sft|mid|rl|exit")
 parser.add_argument('-g', '--model-tag', type=str, default=None, help='Model tag to load')
 parser.add_argument('-s', '--step', type=int, default=None, help='Step to load')
 parser.add_argument('-p', '--prompt', type=str, default='', help='Prompt the model, get a single response back')
@@ -20,7 +20,11 @@ parser.add_argument('-t', '--temperature', type=float, default=0.6, help='Temper
 parser.add_argument('-k', '--top-k', type=int, default=50, help='Top-k sampling parameter')
 parser.add_argument('--device-type', type=str, default='', choices=['cuda', 'cpu', 'mps'], help='Device type for evaluation: cuda|cpu|mps. empty => autodetect')
 parser.add_argument('-d', '--dtype', type=str, default='bfloat16', choices=['float32', 'bfloat16'])
+parser.add_argument('--draft-layers', type=int, default=0, help='Self-speculative decoding: number of early layers used as the draft model (0 = disabled)')
+parser.add_argument('--num-draft', type=int, default=4, help='Self-speculative decoding: number of tokens drafted per verification')
 args = parser.parse_args()
+if not (1 <= args.num_draft <= KVCache.WINDOW_SLACK):
+    parser.error(f"--num-draft must be between 1 and {KVCache.WINDOW_SLACK}")
 
 # Init the model and tokenizer
 
@@ -84,16 +88,19 @@ while True:
         "max_tokens": 256,
         "temperature": args.temperature,
         "top_k": args.top_k,
+        "draft_layers": args.draft_layers if args.draft_layers > 0 else None,
+        "num_draft": args.num_draft,
     }
     response_tokens = []
+    decoder = tokenizer.decode_stream() # holds back incomplete multi-byte characters
     print("\nAssistant: ", end="", flush=True)
     with autocast_ctx:
         for token_column, token_masks in engine.generate(conversation_tokens, **generate_kwargs):
             token = token_column[0] # pop the batch dimension (num_samples=1)
             response_tokens.append(token)
-            token_text = tokenizer.decode([token])
+            token_text = decoder.step(token)
             print(token_text, end="", flush=True)
-    print()
+    print(decoder.flush())
     # we have to ensure that the assistant end token is the last token
     # so even if generation ends due to max tokens, we have to append it to the end
     if response_tokens[-1] != assistant_end:
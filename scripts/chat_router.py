@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+"""
+Load-balancing router in front of several chat_web instances (e.g. one per box, or one per GPU group).
+
+Every request goes to the backend with the least outstanding tokens, as reported by the /stats of the
+backends (polled every --health-interval seconds) plus what the router sent since. The next turn of a
+conversation goes back to the backend of its previous turn, as long as that one has capacity.
+A backend whose /stats cannot be fetched is out of rotation until it answers again, and a request
+that a backend refuses (connection error, or a full queue: 429/503) is retried on the next best backend.
+The SSE response of the backend is passed through chunk by chunk, without buffering, and a client
+that goes away closes the connection to the backend, which then stops generating.
+See nanochat/router.py for the routing logic.
+
+Launch examples:
+
+- two chat_web instances, and the router in front of them
+python -m scripts.chat_web --port 8001
+python -m scripts.chat_web --port 8002
+python -m scripts.chat_router --backends http://localhost:8001,http://localhost:8002
+
+- try the router locally without a model: stub backends that stream fake tokens
+python -m scripts.chat_router --stub --port 8001
+python -m scripts.chat_router --stub --port 8002
+python -m scripts.chat_router --backends http://localhost:8001,http://localhost:8002
+
+Endpoints:
+  GET  /           - Chat UI (of a healthy backend)
+  POST /chat/completions - Chat API, proxied to a backend
+  GET  /health     - Health check, ready when at least one backend is healthy
+  GET  /stats      - Router statistics: per-backend load and health, affinity hits
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import random
+from contextlib import asynccontextmanager
+import aiohttp
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse, Response
+from nanochat.router import Router, estimate_cost
+
+parser = argparse.ArgumentParser(description='NanoChat Router')
+parser.add_argument('--backends', type=str, default='', help='Comma-separated URLs of the chat_web backends')
+parser.add_argument('-p', '--port', type=int, default=8000, help='Port to run the router on')
+parser.add_argument('--host', type=str, default='0.0.0.0', help='Host to bind the router to')
+parser.add_argument('-m', '--max-tokens', type=int, default=512, help='Max tokens assumed for requests that do not set it (the default of chat_web)')
+parser.add_argument('--health-interval', type=float, default=1.0, help='Seconds between two polls of the /stats of every backend')
+parser.add_argument('--health-timeout', type=float, default=2.0, help='Seconds after which a /stats poll counts as failed')
+parser.add_argument('--connect-timeout', type=float, default=5.0, help='Seconds to connect to a backend before trying another one')
+parser.add_argument('--affinity-ttl', type=float, default=600.0, help='Seconds a conversation sticks to the backend of its previous turn')
+parser.add_argument('--stub', action='store_true', help='Run a stub backend instead of the router: a chat_web look-alike that streams fake tokens')
+parser.add_argument('--stub-slots', type=int, default=2, help='Stub backend: concurrent requests, beyond that requests queue')
+parser.add_argument('--stub-token-delay', type=float, default=0.02, help='Stub backend: seconds per generated token')
+args = parser.parse_args()
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(message)s',
+    datefmt='%Y-%m-%d %H:%M:%S'
+)
+logger = logging.getLogger(__name__)
+
+PROXY_HEADERS = ("Retry-After", "Content-Type") # headers of a refused request passed back to the client
+
+# -----------------------------------------------------------------------------
+# Router
+
+async def poll_backend(session: aiohttp.ClientSession, backend):
+    try:
+        async with session.get(f"{backend.url}/stats", timeout=aiohttp.ClientTimeout(total=args.health_timeout)) as resp:
+            resp.raise_for_status()
+            backend.update(await resp.json())
+    except (aiohttp.ClientError, asyncio.TimeoutError, KeyError, ValueError) as e:
+        if backend.healthy:
+            logger.warning(f"Backend {backend.url} is unhealthy: {type(e).__name__}: {e}")
+        backend.mark_failed()
+
+async def health_loop(router: Router, session: aiohttp.ClientSession):
+    while True:
+        await asyncio.gather(*(poll_backend(session, backend) for backend in router.backends))
+        await asyncio.sleep(args.health_interval)
+
+@asynccontextmanager
+async def router_lifespan(app: FastAPI):
+    backend_urls = [url.strip() for url in args.backends.split(",") if url.strip()]
+    app.state.router = Router(backend_urls, affinity_ttl=args.affinity_ttl)
+    # no total timeout: a response streams for as long as it generates
+    app.state.session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=None, sock_connect=args.connect_timeout))
+    await asyncio.gather(*(poll_backend(app.state.session, backend) for backend in app.state.router.backends))
+    health_task = asyncio.create_task(health_loop(app.state.router, app.state.session))
+    num_healthy = sum(backend.healthy for backend in app.state.router.backends)
+    print(f"Router ready at http://localhost:{args.port}, {num_healthy}/{len(backend_urls)} backends healthy")
+    yield
+    health_task.cancel()
+    await app.state.session.close()
+
+async def proxy_get(path: str):
+    """Pass a GET through to a healthy backend (the UI and its assets are the same on all of them)."""
+    backend = app.state.router.choose([])
+    if backend is None:
+        raise HTTPException(status_code=503, detail="No healthy backend")
+    async with app.state.session.get(f"{backend.url}{path}") as resp:
+        content = await resp.read()
+        return Response(content, status_code=resp.status, media_type=resp.headers.get("Content-Type"))
+
+async def root():
+    return await proxy_get("/")
+
+async def logo():
+    return await proxy_get("/logo.svg")
+
+async def chat_completions(request: Request):
+    body = await request.body()
+    try:
+        payload = json.loads(body)
+        messages = payload["messages"]
+        cost = estimate_cost(messages, payload.get("max_tokens") or args.max_tokens)
+    except (ValueError, KeyError, TypeError, AttributeError):
+        raise HTTPException(status_code=400, detail="Invalid chat request")
+    router, session = app.state.router, app.state.session
+
+    # Send the request to the best backend, or to the next best one if it cannot take it
+    tried = []
+    refused = None # (status, headers, content) of the last refusal
+    while True:
+        backend = router.choose(messages, exclude=tried)
+        if backend is None:
+            if refused is not None:
+                status, headers, content = refused
+                return Response(content, status_code=status, headers=headers)
+            raise HTTPException(status_code=503, detail="No healthy backend")
+        tried.append(backend)
+        try:
+            resp = await session.post(f"{backend.url}/chat/completions", data=body, headers={"Content-Type": "application/json"})
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.warning(f"Backend {backend.url} failed: {type(e).__name__}: {e}")
+            backend.mark_failed()
+            continue
+        if resp.status == 200:
+            break
+        # refused (e.g. 429 queue full, 503 deadline) or invalid (400): pass it back unless another backend may take it
+        content = await resp.read()
+        headers = {k: resp.headers[k] for k in PROXY_HEADERS if k in resp.headers}
+        resp.release()
+        if resp.status not in (429, 503):
+            return Response(content, status_code=resp.status, headers=headers)
+        refused = (resp.status, headers, content)
+
+    router.dispatched(backend, messages, cost)
+
+    async def passthrough():
+        completed = False
+        try:
+            async for chunk in resp.content.iter_any():
+                yield chunk
+            completed = True
+        finally:
+            router.finished(backend)
+            if completed:
+                resp.release() # back to the connection pool
+            else:
+                resp.close() # the client went away: drop the connection so that the backend stops generating
+
+    return StreamingResponse(passthrough(), media_type="text/event-stream", headers={"X-Backend": backend.url})
+
+async def router_health():
+    router = getattr(app.state, "router", None)
+    num_healthy = sum(backend.healthy for backend in router.backends) if router else 0
+    return {
+        "status": "ok",
+        "ready": num_healthy > 0,
+        "healthy_backends": num_healthy,
+        "free_slots": sum(backend.free_slots for backend in router.backends if backend.healthy) if router else 0,
+    }
+
+async def router_stats():
+    return app.state.router.state()
+
+# -----------------------------------------------------------------------------
+# Stub backend: same /health, /stats and /chat/completions as chat_web, no model
+
+@asynccontextmanager
+async def stub_lifespan(app: FastAPI):
+    app.state.slots = asyncio.Semaphore(args.stub_slots)
+    app.state.active = 0
+    app.state.waiting = 0
+    app.state.outstanding_tokens = 0
+    print(f"Stub backend ready at http://localhost:{args.port}")
+    yield
+
+async def stub_chat_completions(request: Request):
+    payload = await request.json()
+    max_tokens = payload.get("max_tokens") or args.max_tokens
+    num_tokens = random.randint(1, max_tokens)
+    state = app.state
+    state.outstanding_tokens += max_tokens
+    state.waiting += 1
+
+    async def stream():
+        generated = 0
+        started = False
+        try:
+            async with state.slots:
+                state.waiting -= 1
+                state.active += 1
+                started = True
+                try:
+                    for i in range(num_tokens):
+                        await asyncio.sleep(args.stub_token_delay)
+                        generated += 1
+                        state.outstanding_tokens -= 1
+                        yield f"data: {json.dumps({'token': f' tok{i}', 'gpu': 0})}\n\n"
+                    yield f"data: {json.dumps({'done': True})}\n\n"
+                finally:
+                    state.active -= 1
+        finally:
+            if not started:
+                state.waiting -= 1
+            state.outstanding_tokens -= max_tokens - generated
+
+    return StreamingResponse(stream(), media_type="text/event-stream")
+
+async def stub_health():
+    return {"status": "ok", "ready": True, "num_gpus": 1, "free_slots": max(args.stub_slots - app.state.active, 0)}
+
+async def stub_stats():
+    state = app.state
+    return {
+        "total_workers": 1,
+        "busy_workers": int(state.active > 0),
+        "scheduler": {
+            "queue_depth": state.waiting,
+            "max_queue_depth": 64,
+            "slots_per_worker": args.stub_slots,
+            "active_requests": state.active,
+            "free_slots": max(args.stub_slots - state.active, 0),
+            "outstanding_tokens": state.outstanding_tokens,
+        },
+    }
+
+# -----------------------------------------------------------------------------
+
+if args.stub:
+    app = FastAPI(lifespan=stub_lifespan)
+    app.post("/chat/completions")(stub_chat_completions)
+    app.get("/health")(stub_health)
+    app.get("/stats")(stub_stats)
+else:
+    assert args.backends, "--backends is required (or --stub to run a stub backend)"
+    app = FastAPI(lifespan=router_lifespan)
+    app.post("/chat/completions")(chat_completions)
+    app.get("/health")(router_health)
+    app.get("/stats")(router_stats)
+    app.get("/")(root)
+    app.get("/logo.svg")(logo)
+
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["*"],
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
+
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run(app, host=args.host, port=args.port)
@@ -13,6 +13,7 @@ import os
 os.environ["PYTORCH_CUDA_ALLOC_CONF"] = "expandable_segments:True"
 
 import wandb
+import numpy as np
 import torch
 import torch.distributed as dist
 from contextlib import nullcontext
@@ -97,32 +98,29 @@ val_ds = SmolTalk(split="test") # general conversations, 24K rows (though we don
 
 def sft_data_generator(dataset, batch_size):
     pad_token_id = tokenizer.encode_special("<|assistant_end|>") # use <|assistant_end|> as the pad token is ok, these positions are masked in the loss
-    # prepares a list of tokenized conversations into a batch and yields
-    def collate_and_yield(batch):
-        nrows = len(batch)
-        ncols = max(len(ids) for ids, mask in batch) - 1 # seq of n creates inputs/targets of n-1
-        inputs = torch.full((nrows, ncols), pad_token_id, dtype=torch.long)
-        targets = torch.full((nrows, ncols), -1, dtype=torch.long) # -1 is ignore index
-        for i, (ids, mask) in enumerate(batch):
-            n = len(ids)
-            ids_tensor = torch.tensor(ids, dtype=torch.long)
-            inputs[i, :n-1] = ids_tensor[:-1]
+    # prepares a batch of conversations, rendered together into flat arrays, and yields
+    def collate_and_yield(docs):
+        ids, mask, offsets = tokenizer.render_conversations(docs)
+        nrows = len(docs)
+        lengths = np.diff(offsets)
+        ncols = lengths.max() - 1 # seq of n creates inputs/targets of n-1
+        inputs = np.full((nrows, ncols), pad_token_id, dtype=np.int64)
+        targets = np.full((nrows, ncols), -1, dtype=np.int64) # -1 is ignore index
+        for i, (start, n) in enumerate(zip(offsets[:-1].tolist(), lengths.tolist())):
+            row_ids = ids[start:start + n]
+            inputs[i, :n-1] = row_ids[:-1]
             # recall -1 is the ignore index, so mask out targets where mask is 0
-            row_targets = ids_tensor[1:]
             # mask[1:] omits the mask for the BOS token, which is never a target atm so it's ok
-            mask_tensor = torch.tensor(mask[1:], dtype=torch.long)
-            row_targets[mask_tensor == 0] = -1 # mask out targets where mask is 0
-            targets[i, :n-1] = row_targets
-        inputs = inputs.to(device) # move to device
-        targets = targets.to(device)
+            targets[i, :n-1] = row_ids[1:]
+            targets[i, :n-1][mask[start + 1:start + n] == 0] = -1
+        inputs = torch.from_numpy(inputs).to(device) # move to device
+        targets = torch.from_numpy(targets).to(device)
         return inputs, targets
-    # iterates over the dataset in epochs, tokenizes
+    # iterates over the dataset in epochs, tokenizes a batch at a time
     batch = []
     while True:
         for i in range(ddp_rank, len(dataset), ddp_world_size):
-            doc = dataset[i]
-            ids, mask = tokenizer.render_conversation(doc)
-            batch.append((ids, mask))
+            batch.append(dataset[i])
             if len(batch) == batch_size:
                 yield collate_and_yield(batch)
                 batch = []
@@ -4,6 +4,25 @@ Unified web chat server - serves both UI and API from a single FastAPI instance.
 
 Uses data parallelism to distribute requests across multiple GPUs. Each GPU loads
 a full copy of the model, and incoming requests are distributed to available workers.
+Each worker generates on its own dedicated thread and hands tokens to the response
+through a small bounded queue, so the event loop never blocks on a forward pass.
+Requests are admitted by a scheduler (nanochat/scheduler.py): a bounded waiting queue
+(overflow gets a 429), priority classes, optional deadlines, and each request goes to
+the worker with the least outstanding tokens. Clients that go away are dropped from
+the queue, or have their generation stopped if it already started.
+Under load, the tokens of a response are coalesced into fewer SSE events (at most
+--coalesce-tokens tokens or --coalesce-interval seconds per event), at low load
+every token is still sent as soon as it is generated.
+Responses to temperature=0 requests are cached (nanochat/response_cache.py), a repeated
+request is answered from the cache without loading its model or going through the scheduler.
+Several models can be served side by side (--models), a request picks one by name. Models
+are loaded on demand in the background, and the least recently used idle ones are unloaded
+when the next one would not fit in --model-memory-gb (nanochat/model_registry.py).
+Requests can be recorded to a JSONL journal (nanochat/journal.py, --journal): token counts,
+sampling parameters and timings, for offline analysis and replay with scripts/replay.py.
+Every replica is warmed up with synthetic requests before it takes traffic (nanochat/warmup.py),
+/health reports ready once the default model is loaded and warm. With --compile, the compiled
+graphs are cached on disk, so a restarted server does not compile them again.
 
 Launch examples:
 
@@ -13,6 +32,12 @@ python -m scripts.chat_web
 - 4 GPUs
 python -m scripts.chat_web --num-gpus 4
 
+- CPU only, 8 worker processes each pinned to 1/8 of the cores, sharing memory-mapped weights
+python -m scripts.chat_web --device-type cpu --cpu-workers 8
+
+- sft (the default) and rl side by side, plus a bigger model, at most 20GB of weights per GPU
+python -m scripts.chat_web --models sft=sft,rl=rl,big=sft:d32 --model-memory-gb 20
+
 To chat, open the URL printed in the console. (If on cloud box, make sure to use public IP)
 
 Endpoints:
@@ -20,6 +45,10 @@ Endpoints:
   POST /chat/completions - Chat API (streaming only)
   GET  /health     - Health check with worker pool status
   GET  /stats      - Worker pool statistics and GPU utilization
+  GET  /models     - The models that can be served, and which ones are loaded
+  GET  /metrics    - Prometheus metrics: latency histograms, token counters, worker utilization
+  POST /batch/jobs - Submit an offline JSONL batch job (needs --batch-dir, see nanochat/batch.py)
+  GET  /batch/jobs/{job_id} - Progress of a batch job
 
 Abuse Prevention:
   - Maximum 500 messages per request
@@ -28,6 +57,8 @@ Abuse Prevention:
   - Temperature clamped to 0.0-2.0
   - Top-k clamped to 1-200
   - Max tokens clamped to 1-4096
+  - Deadline clamped to 0-600 seconds
+  - At most --max-queue-depth requests wait for a worker, the rest get a 429
 """
 
 import argparse
@@ -37,17 +68,29 @@ import torch
 import asyncio
 import logging
 import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 from contextlib import asynccontextmanager
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse, HTMLResponse, FileResponse
+from fastapi.responses import StreamingResponse, HTMLResponse, FileResponse, PlainTextResponse
 from pydantic import BaseModel
 from typing import List, Optional, AsyncGenerator
 from dataclasses import dataclass
 from contextlib import nullcontext
 from nanochat.common import compute_init, autodetect_device_type
-from nanochat.checkpoint_manager import load_model
-from nanochat.engine import Engine
+from nanochat.checkpoint_manager import load_model, export_fp32_weights, checkpoint_bytes
+from nanochat.tokenizer import get_tokenizer
+from nanochat.cpu_serving import ProcessEngine, cpu_core_sets
+from nanochat.engine import Engine, KVCache
+from nanochat.scheduler import RequestScheduler, QueueFullError, DeadlineExceededError, PRIORITY_CLASSES
+from nanochat.metrics import ServingMetrics
+from nanochat.batch import BatchJob, generate_batch_results
+from nanochat.response_cache import ResponseCache, cacheable
+from nanochat.warmup import warmup, enable_compile_cache
+from nanochat.journal import RequestJournal
+from nanochat.model_registry import ModelRegistry, ModelSpec, UnknownModelError, ModelBudgetError, parse_model_spec
 
 # Abuse prevention limits
 MAX_MESSAGES_PER_REQUEST = 500
@@ -59,20 +102,45 @@ MIN_TOP_K = 1
 MAX_TOP_K = 200
 MIN_MAX_TOKENS = 1
 MAX_MAX_TOKENS = 4096
+MAX_DEADLINE = 600.0 # seconds
+DISCONNECT_POLL_INTERVAL = 0.5 # seconds between client disconnect checks while a request waits
+BATCH_RETRY_INTERVAL = 1.0 # seconds a batch job backs off when the scheduler queue is full
 
 parser = argparse.ArgumentParser(description='NanoChat Web Server')
 parser.add_argument('-n', '--num-gpus', type=int, default=1, help='Number of GPUs to use (default: 1)')
-parser.add_argument('-i', '--source', type=str, default="sft", help="Source of the model: sft|mid|rl")
+parser.add_argument('-i', '--source', type=str, default="sft", help="Source of the model: sft|mid|rl|exit")
 parser.add_argument('-t', '--temperature', type=float, default=0.8, help='Default temperature for generation')
 parser.add_argument('-k', '--top-k', type=int, default=50, help='Default top-k sampling parameter')
 parser.add_argument('-m', '--max-tokens', type=int, default=512, help='Default max tokens for generation')
 parser.add_argument('-g', '--model-tag', type=str, default=None, help='Model tag to load')
 parser.add_argument('-s', '--step', type=int, default=None, help='Step to load')
+parser.add_argument('--models', type=str, default=None, help='Comma-separated models to serve as name=source[:model_tag[:step]], the first one is the default (overrides -i/-g/-s)')
+parser.add_argument('--model-memory-gb', type=float, default=0, help='Budget for the weights of the loaded models on each device in GB, idle models are unloaded beyond it (0 = unlimited)')
 parser.add_argument('-p', '--port', type=int, default=8000, help='Port to run the server on')
 parser.add_argument('-d', '--dtype', type=str, default='bfloat16', choices=['float32', 'bfloat16'])
 parser.add_argument('--device-type', type=str, default='', choices=['cuda', 'cpu', 'mps'], help='Device type for evaluation: cuda|cpu|mps. empty => autodetect')
+parser.add_argument('--cpu-workers', type=int, default=0, help='CPU only: number of worker processes, each pinned to its own cores (0 = one in-process worker)')
 parser.add_argument('--host', type=str, default='0.0.0.0', help='Host to bind the server to')
+parser.add_argument('--max-queue-depth', type=int, default=64, help='Max requests waiting for a worker, beyond that requests are rejected with a 429')
+parser.add_argument('--slots-per-worker', type=int, default=1, help='Max concurrent requests per worker (each gets its own generation thread)')
+parser.add_argument('--stream-queue-size', type=int, default=64, help='Max tokens buffered between a generating worker and its response stream')
+parser.add_argument('--coalesce-requests', type=int, default=4, help='Number of concurrent requests (running or waiting) from which tokens are coalesced into fewer SSE events')
+parser.add_argument('--coalesce-tokens', type=int, default=8, help='Max tokens per SSE event when coalescing (1 = never coalesce)')
+parser.add_argument('--coalesce-interval', type=float, default=0.05, help='Max seconds a token is held back when coalescing')
+parser.add_argument('--cache-mb', type=float, default=64, help='Memory budget of the temperature=0 response cache of each model in MB (0 = disabled)')
+parser.add_argument('--cache-dir', type=str, default=None, help='Directory of the on-disk tier of the response cache (default: memory only)')
+parser.add_argument('--cache-disk-mb', type=float, default=1024, help='Disk budget of the on-disk tier of the response cache in MB')
+parser.add_argument('--batch-dir', type=str, default=None, help='Directory the input/output files of batch jobs live in (default: batch API disabled)')
+parser.add_argument('--draft-layers', type=int, default=0, help='Self-speculative decoding: number of early layers used as the draft model (0 = disabled)')
+parser.add_argument('--num-draft', type=int, default=4, help='Self-speculative decoding: number of tokens drafted per verification')
+parser.add_argument('--journal', type=str, default=None, help='JSONL file to record every request to (token counts, sampling parameters, timings), see scripts/replay.py')
+parser.add_argument('--journal-content', action='store_true', help='Also record the messages and responses in the journal')
+parser.add_argument('--compile', action='store_true', help='torch.compile the model forward, the compiled graphs are cached on disk across restarts (in-process workers only)')
+parser.add_argument('--warmup-buckets', type=str, default='16,128,512', help='Comma-separated prompt lengths of the synthetic warmup requests run before serving (empty = no warmup)')
+parser.add_argument('--warmup-tokens', type=int, default=16, help='Tokens decoded by each warmup request')
 args = parser.parse_args()
+if not (1 <= args.num_draft <= KVCache.WINDOW_SLACK):
+    parser.error(f"--num-draft must be between 1 and {KVCache.WINDOW_SLACK}")
 
 # Configure logging for conversation traffic
 logging.basicConfig(
@@ -91,31 +159,83 @@ class Worker:
     """A worker with a model loaded on a specific GPU."""
     gpu_id: int
     device: torch.device
-    engine: Engine
+    engine: Engine # or a ProcessEngine, the handle of a CPU worker process
     tokenizer: object
     autocast_ctx: torch.amp.autocast
+    executor: ThreadPoolExecutor # dedicated threads for this worker's generation, one per slot
+    metric_key: object = None # the worker label of its metrics
 
 class WorkerPool:
-    """Pool of workers, each with a model replica on a different GPU."""
+    """Pool of workers of one model, each with a replica of it on a different GPU."""
 
-    def __init__(self, num_gpus: Optional[int] = None):
+    def __init__(self, metrics: ServingMetrics, num_gpus: Optional[int] = None, name: Optional[str] = None):
         if num_gpus is None:
             if device_type == "cuda":
                 num_gpus = torch.cuda.device_count()
             else:
                 num_gpus = 1 # e.g. cpu|mps
         self.num_gpus = num_gpus
+        self.name = name # None when the server has a single model
         self.workers: List[Worker] = []
-        self.available_workers: asyncio.Queue = asyncio.Queue()
-
-    async def initialize(self, source: str, model_tag: Optional[str] = None, step: Optional[int] = None):
-        """Load model on each GPU."""
-        print(f"Initializing worker pool with {self.num_gpus} GPUs...")
+        self.scheduler: Optional[RequestScheduler] = None # decides which request runs on which worker
+        self.metrics = metrics # shared by the pools of all models
+        self.response_cache: Optional[ResponseCache] = None # outlives the pool, see load_worker_pool
+        self.cache_namespace = None
+        self.tokenizer = None
+        self.memory_bytes = 0 # weights of one replica, what the model costs each device
+
+    def load(self, spec: ModelSpec):
+        """Load the model on each GPU. Blocking, the model registry runs it off the event loop."""
+        print(f"Initializing worker pool of model {spec.name} with {self.num_gpus} GPUs...")
+        if device_type == "cpu" and args.cpu_workers > 0:
+            meta = self.start_cpu_workers(spec.source, spec.model_tag, spec.step)
+        else:
+            meta = self.load_workers(spec.source, spec.model_tag, spec.step)
+        for worker in self.workers:
+            worker.metric_key = worker.gpu_id if self.name is None else f"{self.name}/{worker.gpu_id}"
+        if args.compile and not isinstance(self.workers[0].engine, ProcessEngine):
+            cache_dir = enable_compile_cache(meta["model_config"], device_type)
+            print(f"Compiling model {spec.name}, compile cache in {cache_dir}")
+            for worker in self.workers:
+                model = worker.engine.model
+                model.forward = torch.compile(model.forward, dynamic=True)
+        if args.warmup_buckets:
+            self.warmup(meta["model_config"]["sequence_len"])
+
+        self.scheduler = RequestScheduler(self.workers, slots_per_worker=args.slots_per_worker, max_queue_depth=args.max_queue_depth)
+        # the namespace of the response cache pins cached responses to this exact model, which matters for a shared disk tier
+        self.cache_namespace = json.dumps([spec.source, spec.model_tag, meta.get("step"), meta.get("model_config")], sort_keys=True)
+        print(f"All {self.num_gpus} workers of model {spec.name} initialized!")
+
+    def start_cpu_workers(self, source: str, model_tag: Optional[str] = None, step: Optional[int] = None):
+        """Start the CPU worker processes, on disjoint core sets and sharing the memory-mapped weights."""
+        assert args.slots_per_worker == 1, "CPU worker processes serve one request at a time"
+        self.num_gpus = args.cpu_workers
+        weights_path, meta = export_fp32_weights(source, model_tag=model_tag, step=step)
+        self.memory_bytes = os.path.getsize(weights_path) # one copy, shared by all the processes
+        self.tokenizer = get_tokenizer()
+        engines = []
+        for worker_id, cores in enumerate(cpu_core_sets(args.cpu_workers)):
+            print(f"Starting CPU worker {worker_id} on cores {cores[0]}-{cores[-1]} ({len(cores)} threads)...")
+            engines.append(ProcessEngine(cores, weights_path, meta))
+        for worker_id, engine in enumerate(engines):
+            engine.wait_ready() # the processes load in parallel
+            self.workers.append(Worker(
+                gpu_id=worker_id,
+                device=torch.device("cpu"),
+                engine=engine,
+                tokenizer=self.tokenizer,
+                autocast_ctx=nullcontext(),
+                executor=ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"worker-{worker_id}"),
+            ))
+        return meta
+
+    def load_workers(self, source: str, model_tag: Optional[str] = None, step: Optional[int] = None):
+        """Load a model replica on each GPU (or the single cpu|mps device) in this process."""
         if self.num_gpus > 1:
-            assert device_type == "cuda", "Only CUDA supports multiple workers/GPUs. cpu|mps does not."
+            assert device_type == "cuda", "Only CUDA supports multiple workers/GPUs. cpu|mps does not. (For cpu, see --cpu-workers)"
 
         for gpu_id in range(self.num_gpus):
-
             if device_type == "cuda":
                 device = torch.device(f"cuda:{gpu_id}")
                 print(f"Loading model on GPU {gpu_id}...")
@@ -123,7 +243,7 @@ class WorkerPool:
                 device = torch.device(device_type) # e.g. cpu|mps
                 print(f"Loading model on {device_type}...")
 
-            model, tokenizer, _ = load_model(source, device, phase="eval", model_tag=model_tag, step=step)
+            model, tokenizer, meta = load_model(source, device, phase="eval", model_tag=model_tag, step=step)
             engine = Engine(model, tokenizer)
             autocast_ctx = torch.amp.autocast(device_type=device_type, dtype=ptdtype) if device_type == "cuda" else nullcontext()
 
@@ -132,20 +252,106 @@ class WorkerPool:
                 device=device,
                 engine=engine,
                 tokenizer=tokenizer,
-                autocast_ctx=autocast_ctx
+                autocast_ctx=autocast_ctx,
+                executor=ThreadPoolExecutor(max_workers=args.slots_per_worker, thread_name_prefix=f"{self.name or 'worker'}-{gpu_id}"),
             )
             self.workers.append(worker)
-            await self.available_workers.put(worker)
-
-        print(f"All {self.num_gpus} workers initialized!")
-
-    async def acquire_worker(self) -> Worker:
-        """Get an available worker from the pool."""
-        return await self.available_workers.get()
-
-    async def release_worker(self, worker: Worker):
-        """Return a worker to the pool."""
-        await self.available_workers.put(worker)
+            self.tokenizer = tokenizer
+            self.memory_bytes = sum(p.numel() * p.element_size() for p in model.parameters())
+        return meta
+
+    def warmup(self, max_seq_len: int):
+        """Run the synthetic warmup requests on all workers at once, each on its own generation thread."""
+        buckets = [int(length) for length in args.warmup_buckets.split(",")]
+        def warmup_worker(worker):
+            with worker.autocast_ctx:
+                return warmup(worker.engine, worker.tokenizer, buckets, max_tokens=args.warmup_tokens, max_seq_len=max_seq_len, **generation_settings())
+        t0 = time.time()
+        futures = [worker.executor.submit(warmup_worker, worker) for worker in self.workers]
+        timings = [future.result() for future in futures]
+        print(f"Warmed up {len(self.workers)} workers in {time.time() - t0:.1f}s, per bucket: {timings[0]}")
+
+    async def acquire_worker(self, ticket, http_request: Request) -> Worker:
+        """
+        Wait until the scheduler hands the ticket a worker. While waiting, check every now and
+        then whether the client is still there, and give up its place in the queue if it is not.
+        """
+        waiter = asyncio.ensure_future(self.scheduler.wait(ticket))
+        try:
+            while True:
+                done, _ = await asyncio.wait([waiter], timeout=DISCONNECT_POLL_INTERVAL)
+                if done:
+                    return waiter.result()
+                if await http_request.is_disconnected():
+                    raise HTTPException(status_code=499, detail="Client closed request")
+        finally:
+            if not waiter.done():
+                waiter.cancel() # the scheduler withdraws the ticket
+
+    def close(self):
+        """Stop the generation threads (and processes) of all workers and free the replicas."""
+        for worker in self.workers:
+            worker.executor.shutdown(wait=False, cancel_futures=True)
+            if isinstance(worker.engine, ProcessEngine):
+                worker.engine.close()
+            if worker.metric_key in self.metrics.meters:
+                self.metrics.remove_worker(worker.metric_key)
+        self.workers.clear()
+        self.scheduler = None
+        if device_type == "cuda":
+            torch.cuda.empty_cache()
+
+async def load_worker_pool(spec: ModelSpec) -> WorkerPool:
+    """Load a model for the model registry: the replicas off the event loop, then its metrics on it."""
+    multi_model = len(app.state.model_registry.specs) > 1
+    worker_pool = WorkerPool(app.state.metrics, num_gpus=args.num_gpus, name=spec.name if multi_model else None)
+    try:
+        await asyncio.to_thread(worker_pool.load, spec)
+    except BaseException:
+        worker_pool.close()
+        raise
+    for worker in worker_pool.workers:
+        app.state.metrics.add_worker(worker.metric_key)
+    if args.cache_mb > 0:
+        # one response cache per model, kept by the registry when the model is unloaded: its responses are still good
+        response_caches = app.state.model_registry.response_caches
+        if spec.name not in response_caches:
+            response_caches[spec.name] = ResponseCache(
+                int(args.cache_mb * 1024 * 1024),
+                namespace=worker_pool.cache_namespace,
+                disk_dir=args.cache_dir,
+                max_disk_bytes=int(args.cache_disk_mb * 1024 * 1024),
+            )
+        worker_pool.response_cache = response_caches[spec.name]
+    return worker_pool
+
+def estimate_model_bytes(spec: ModelSpec) -> int:
+    return checkpoint_bytes(spec.source, model_tag=spec.model_tag, step=spec.step)
+
+def loaded_pools() -> List[WorkerPool]:
+    registry = getattr(app.state, "model_registry", None)
+    return [entry.model for entry in registry.loaded.values()] if registry else []
+
+def register_server_metrics(metrics: ServingMetrics):
+    """Gauges of the scheduler queues and the response caches, summed over the loaded models."""
+    queue_depth = metrics.registry.gauge("nanochat_queue_depth", "Requests waiting for a worker.")
+    active_requests = metrics.registry.gauge("nanochat_active_requests", "Requests running on a worker.")
+    def collect_scheduler():
+        pools = loaded_pools()
+        queue_depth.set(sum(pool.scheduler.num_waiting for pool in pools))
+        active_requests.set(sum(sum(pool.scheduler.active) for pool in pools))
+    metrics.registry.collectors.append(collect_scheduler)
+    if args.cache_mb > 0:
+        cache_lookups = metrics.registry.counter("nanochat_response_cache_lookups_total", "Response cache lookups by result.", labelnames=("result",))
+        cache_bytes = metrics.registry.gauge("nanochat_response_cache_bytes", "Memory used by the response cache.")
+        cache_entries = metrics.registry.gauge("nanochat_response_cache_entries", "Responses in the memory tier of the response cache.")
+        def collect_cache():
+            cache_stats = [cache.stats() for cache in app.state.model_registry.response_caches.values()]
+            for result in ["hit", "disk_hit", "miss"]:
+                cache_lookups.labels(result).set(sum(s[result + "s"] for s in cache_stats))
+            cache_bytes.set(sum(s["bytes"] for s in cache_stats))
+            cache_entries.set(sum(s["entries"] for s in cache_stats))
+        metrics.registry.collectors.append(collect_cache)
 
 class ChatMessage(BaseModel):
     role: str
@@ -156,6 +362,18 @@ class ChatRequest(BaseModel):
     temperature: Optional[float] = None
     max_tokens: Optional[int] = None
     top_k: Optional[int] = None
+    priority: Optional[str] = None # one of PRIORITY_CLASSES, default "default"
+    deadline: Optional[float] = None # seconds, the request is dropped if it cannot finish by then
+    model: Optional[str] = None # name of one of --models, default the first one
+
+class BatchJobRequest(BaseModel):
+    input: str # JSONL file of conversations, relative to --batch-dir
+    output: str # JSONL file of responses, relative to --batch-dir (an existing one is resumed)
+    model: Optional[str] = None
+    batch_size: int = 16
+    temperature: Optional[float] = None # defaults for the lines that do not set their own
+    top_k: Optional[int] = None
+    max_tokens: Optional[int] = None
 
 def validate_chat_request(request: ChatRequest):
     """Validate chat request to prevent abuse."""
@@ -220,14 +438,42 @@ def validate_chat_request(request: ChatRequest):
                 detail=f"max_tokens must be between {MIN_MAX_TOKENS} and {MAX_MAX_TOKENS}"
             )
 
+    # Validate priority
+    if request.priority is not None and request.priority not in PRIORITY_CLASSES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"priority must be one of {', '.join(PRIORITY_CLASSES)}"
+        )
+
+    # Validate deadline
+    if request.deadline is not None:
+        if not (0 < request.deadline <= MAX_DEADLINE):
+            raise HTTPException(
+                status_code=400,
+                detail=f"deadline must be between 0 and {MAX_DEADLINE} seconds"
+            )
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    """Load models on all GPUs on startup."""
+    """Load the default model on all GPUs on startup, the other models load on demand."""
     print("Loading nanochat models across GPUs...")
-    app.state.worker_pool = WorkerPool(num_gpus=args.num_gpus)
-    await app.state.worker_pool.initialize(args.source, model_tag=args.model_tag, step=args.step)
+    if args.models:
+        specs = [parse_model_spec(spec) for spec in args.models.split(",")]
+    else:
+        specs = [ModelSpec(args.source, args.source, args.model_tag, args.step)]
+    app.state.tokenizer = get_tokenizer() # shared by all models, to tokenize requests before they get a worker
+    app.state.metrics = ServingMetrics()
+    register_server_metrics(app.state.metrics)
+    app.state.model_registry = ModelRegistry(specs, load_worker_pool, estimate_model_bytes, memory_budget=int(args.model_memory_gb * 1024**3))
+    worker_pool = await app.state.model_registry.acquire()
+    app.state.model_registry.release(worker_pool)
+    app.state.batch_jobs = {} # job id -> (BatchJob, asyncio.Task)
+    app.state.journal = RequestJournal(args.journal, include_content=args.journal_content) if args.journal else None
     print(f"Server ready at http://localhost:{args.port}")
     yield
+    app.state.model_registry.close()
+    if app.state.journal is not None:
+        app.state.journal.close()
 
 app = FastAPI(lifespan=lifespan)
 
@@ -259,118 +505,356 @@ async def logo():
     logo_path = os.path.join("nanochat", "logo.svg")
     return FileResponse(logo_path, media_type="image/svg+xml")
 
+def build_conversation_tokens(tokenizer, messages) -> List[int]:
+    """Render the conversation so far into tokens, priming the assistant for its reply."""
+    bos = tokenizer.get_bos_token_id()
+    user_start = tokenizer.encode_special("<|user_start|>")
+    user_end = tokenizer.encode_special("<|user_end|>")
+    assistant_start = tokenizer.encode_special("<|assistant_start|>")
+    assistant_end = tokenizer.encode_special("<|assistant_end|>")
+
+    conversation_tokens = [bos]
+    for message in messages:
+        if message.role == "user":
+            conversation_tokens.append(user_start)
+            conversation_tokens.extend(tokenizer.encode(message.content))
+            conversation_tokens.append(user_end)
+        elif message.role == "assistant":
+            conversation_tokens.append(assistant_start)
+            conversation_tokens.extend(tokenizer.encode(message.content))
+            conversation_tokens.append(assistant_end)
+
+    conversation_tokens.append(assistant_start)
+    return conversation_tokens
+
+def generation_settings(temperature=None, top_k=None):
+    """The sampling and decoding settings of a request (also used for warmup, which should take the same code paths)."""
+    return dict(
+        temperature=temperature if temperature is not None else args.temperature,
+        top_k=top_k if top_k is not None else args.top_k,
+        draft_layers=args.draft_layers if args.draft_layers > 0 else None,
+        num_draft=args.num_draft,
+    )
+
+def run_generation(worker: Worker, tokens, generate_kwargs, queue: asyncio.Queue, loop, stop: threading.Event):
+    """
+    Runs on the worker's generation thread: iterates Engine.generate and feeds the tokens to the
+    event loop through the bounded queue. A full queue blocks generation (backpressure) until
+    the response catches up, and setting stop makes the thread give up promptly.
+    None is always the last item, preceded by the exception if generation failed.
+    """
+    def put(item):
+        future = asyncio.run_coroutine_threadsafe(queue.put(item), loop)
+        while True:
+            try:
+                return future.result(timeout=0.1)
+            except FutureTimeoutError:
+                if stop.is_set():
+                    future.cancel()
+                    return
+
+    assistant_end = worker.tokenizer.encode_special("<|assistant_end|>")
+    bos = worker.tokenizer.get_bos_token_id()
+    try:
+        with worker.autocast_ctx:
+            for token_column, token_masks in worker.engine.generate(tokens, num_samples=1, **generate_kwargs):
+                token = token_column[0]
+                # Stopping criteria
+                if stop.is_set() or token == assistant_end or token == bos:
+                    break
+                put(token)
+    except Exception as e:
+        put(e)
+    finally:
+        put(None)
+
 async def generate_stream(
+    worker_pool: WorkerPool,
     worker: Worker,
     tokens,
+    ticket,
+    response_parts: List[str],
     temperature=None,
     max_new_tokens=None,
-    top_k=None
+    top_k=None,
+    cache_key=None,
+    timing: Optional[dict] = None,
+    arrived: Optional[float] = None,
 ) -> AsyncGenerator[str, None]:
-    """Generate assistant response with streaming."""
-    temperature = temperature if temperature is not None else args.temperature
-    max_new_tokens = max_new_tokens if max_new_tokens is not None else args.max_tokens
-    top_k = top_k if top_k is not None else args.top_k
+    """
+    Generate assistant response with streaming. Generation stops early when the ticket's
+    deadline passes, or when the response is closed (Starlette cancels the stream when the
+    client disconnects, which lands in the finally block below).
+    The text of the response is also appended to response_parts, e.g. for logging.
+    If cache_key is given, a response that runs to completion is stored in the response cache.
+    The time to first token and the number of generated tokens are put in timing, e.g. for the journal.
+    The time to first token counts from arrived, the time.monotonic() arrival of the request (default: when
+    the ticket was enqueued).
+    """
+    scheduler = worker_pool.scheduler
+    metrics = worker_pool.metrics
+    generate_kwargs = dict(
+        max_tokens=max_new_tokens,
+        **generation_settings(temperature, top_k),
+        seed=random.randint(0, 2**31 - 1),
+    )
 
-    assistant_end = worker.tokenizer.encode_special("<|assistant_end|>")
-    bos = worker.tokenizer.get_bos_token_id()
+    # Kick off generation on the worker's own thread, tokens come back through a bounded queue
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue(maxsize=args.stream_queue_size)
+    stop = threading.Event()
+    generation = loop.run_in_executor(worker.executor, run_generation, worker, tokens, generate_kwargs, queue, loop, stop)
+
+    # Decode incrementally, multi-byte UTF-8 characters (like emojis) are held back until complete
+    decoder = worker.tokenizer.decode_stream()
+    last_token_time = None
+    # Text not sent yet: under load several tokens go out in one event, which saves per-event overhead
+    pending_text, pending_tokens = [], 0
+    last_event_time = time.monotonic()
+    response_tokens = [] # token ids, for the response cache
+    finished = False # generation ended on its own (not stopped early)
+    coalescing = scheduler.num_requests() >= args.coalesce_requests
+
+    def make_event():
+        text = "".join(pending_text)
+        response_parts.append(text)
+        return f"data: {json.dumps({'token': text, 'gpu': worker.gpu_id}, ensure_ascii=False)}\n\n"
 
-    # Accumulate tokens to properly handle multi-byte UTF-8 characters (like emojis)
-    accumulated_tokens = []
-    # Track the last complete UTF-8 string (without replacement characters)
-    last_clean_text = ""
-
-    with worker.autocast_ctx:
-        for token_column, token_masks in worker.engine.generate(
-            tokens,
-            num_samples=1,
-            max_tokens=max_new_tokens,
-            temperature=temperature,
-            top_k=top_k,
-            seed=random.randint(0, 2**31 - 1)
-        ):
-            token = token_column[0]
-
-            # Stopping criteria
-            if token == assistant_end or token == bos:
+    try:
+        while True:
+            token = await queue.get()
+            if token is None:
+                finished = True
+                break
+            if isinstance(token, Exception):
+                raise token
+            response_tokens.append(token)
+            now = time.monotonic()
+            if last_token_time is None:
+                ttft = metrics.first_token(arrived if arrived is not None else ticket.enqueued_at, now)
+                if timing is not None:
+                    timing["ttft"] = ttft
+            else:
+                metrics.itl.observe(now - last_token_time)
+            last_token_time = now
+            metrics.token(worker.metric_key)
+            scheduler.consume(ticket) # one less outstanding token on this worker
+            if ticket.deadline is not None and now > ticket.deadline:
                 break
 
-            # Append the token to sequence
-            accumulated_tokens.append(token)
-            # Decode all accumulated tokens to get proper UTF-8 handling
-            # Note that decode is a quite efficient operation, basically table lookup and string concat
-            current_text = worker.tokenizer.decode(accumulated_tokens)
-            # Only emit text if it doesn't end with a replacement character
-            # This ensures we don't emit incomplete UTF-8 sequences
-            if not current_text.endswith('�'):
-                # Extract only the new text since last clean decode
-                new_text = current_text[len(last_clean_text):]
-                if new_text:  # Only yield if there's new content
-                    yield f"data: {json.dumps({'token': new_text, 'gpu': worker.gpu_id}, ensure_ascii=False)}\n\n"
-                    last_clean_text = current_text
+            new_text = decoder.step(token)
+            if new_text:
+                pending_text.append(new_text)
+            pending_tokens += 1
+            if pending_text and (not coalescing or pending_tokens >= args.coalesce_tokens or now - last_event_time >= args.coalesce_interval):
+                yield make_event()
+                pending_text, pending_tokens = [], 0
+                last_event_time = now
+                coalescing = scheduler.num_requests() >= args.coalesce_requests # re-evaluated once per event
+        if pending_text:
+            yield make_event()
+    finally:
+        # Stop generating if we left early (e.g. the client went away) and wait for the thread,
+        # so that the worker is only released once it is really idle again
+        stop.set()
+        await asyncio.shield(generation)
+        if timing is not None:
+            timing["completion_tokens"] = len(response_tokens)
+
+    response_cache = worker_pool.response_cache
+    if cache_key is not None and finished:
+        if response_cache.disk_dir is None:
+            response_cache.put(cache_key, response_tokens)
+        else:
+            await asyncio.to_thread(response_cache.put, cache_key, response_tokens)
+    yield f"data: {json.dumps({'done': True})}\n\n"
 
+async def stream_cached(tokenizer, response_tokens, response_parts: List[str]) -> AsyncGenerator[str, None]:
+    """Stream a response out of the response cache, in events of up to --coalesce-tokens tokens."""
+    decoder = tokenizer.decode_stream()
+    step = max(args.coalesce_tokens, 1)
+    for i in range(0, len(response_tokens), step):
+        text = "".join(decoder.step(token) for token in response_tokens[i:i + step])
+        if text:
+            response_parts.append(text)
+            yield f"data: {json.dumps({'token': text, 'cached': True}, ensure_ascii=False)}\n\n"
     yield f"data: {json.dumps({'done': True})}\n\n"
 
+def journal_request(request: ChatRequest, model_name: str, arrived: float, status: str, prompt_tokens: int, response_parts: Optional[List[str]] = None, **fields):
+    """Record a finished request in the journal, if there is one. arrived is its time.monotonic() arrival time."""
+    journal = app.state.journal
+    if journal is None:
+        return
+    now = time.monotonic()
+    record = {
+        "arrival": time.time() - (now - arrived),
+        "model": model_name,
+        "status": status,
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": 0,
+        "temperature": request.temperature if request.temperature is not None else args.temperature,
+        "top_k": request.top_k if request.top_k is not None else args.top_k,
+        "max_tokens": request.max_tokens if request.max_tokens is not None else args.max_tokens,
+        "priority": request.priority or "default",
+        "deadline": request.deadline,
+        **fields,
+        "duration": now - arrived,
+    }
+    if journal.include_content:
+        record["messages"] = [{"role": message.role, "content": message.content} for message in request.messages]
+        record["response"] = "".join(response_parts or [])
+    journal.record(record)
+
 @app.post("/chat/completions")
-async def chat_completions(request: ChatRequest):
+async def chat_completions(request: ChatRequest, http_request: Request):
     """Chat completion endpoint (streaming only) - uses worker pool for multi-GPU."""
+    arrived = time.monotonic()
 
     # Basic validation to prevent abuse
     validate_chat_request(request)
+    model_registry = app.state.model_registry
+    try:
+        model_name = model_registry.resolve(request.model)
+    except UnknownModelError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    # Log incoming conversation to console (in full at debug level only, the journal is the structured record)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("="*20)
+        for i, message in enumerate(request.messages):
+            logger.debug(f"[{message.role.upper()}]: {message.content}")
+        logger.debug("-"*20)
+
+    # Build conversation tokens off the event loop, before waiting for a worker
+    conversation_tokens = await asyncio.to_thread(build_conversation_tokens, app.state.tokenizer, request.messages)
+
+    # Deterministic requests may already have their response in the cache, which is served without the model
+    cache_key, cached_tokens = await lookup_cached_response(model_registry.response_caches.get(model_name), request, conversation_tokens)
+    if cached_tokens is not None:
+        return serve_cached_response(request, model_name, conversation_tokens, cached_tokens, arrived)
+
+    # Get the model, it loads in the background if it is not loaded yet. It cannot be unloaded until released
+    try:
+        worker_pool = await model_registry.acquire(model_name)
+    except ModelBudgetError as e:
+        app.state.metrics.requests.labels("rejected").inc()
+        journal_request(request, model_name, arrived, "rejected", len(conversation_tokens))
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "5"})
+    try:
+        return await serve_chat_completion(worker_pool, model_name, request, http_request, conversation_tokens, arrived, cache_key)
+    except BaseException:
+        model_registry.release(worker_pool)
+        raise
+
+async def lookup_cached_response(response_cache: Optional[ResponseCache], request: ChatRequest, conversation_tokens: List[int]):
+    """The cache key of a deterministic request and its cached response tokens, (None, None) if it cannot be cached."""
+    temperature = request.temperature if request.temperature is not None else args.temperature
+    if response_cache is None or not cacheable(temperature):
+        return None, None
+    top_k = request.top_k if request.top_k is not None else args.top_k
+    max_new_tokens = request.max_tokens if request.max_tokens is not None else args.max_tokens
+    cache_key = response_cache.key(conversation_tokens, temperature, top_k, max_new_tokens)
+    if response_cache.disk_dir is None:
+        return cache_key, response_cache.get(cache_key)
+    return cache_key, await asyncio.to_thread(response_cache.get, cache_key)
+
+def serve_cached_response(request: ChatRequest, model_name: str, conversation_tokens: List[int], cached_tokens: List[int], arrived: float, on_done=None):
+    """Stream a response out of the response cache, on_done() is called when the response ends."""
+    app.state.metrics.requests.labels("cached").inc()
+    response_parts = []
+    async def stream_cached_and_log():
+        try:
+            async for chunk in stream_cached(app.state.tokenizer, cached_tokens, response_parts):
+                yield chunk
+        finally:
+            logger.debug(f"[ASSISTANT] (cached): {''.join(response_parts)}")
+            logger.info(f"Request served from cache: {len(conversation_tokens)} prompt tokens, {len(cached_tokens)} completion tokens")
+            journal_request(request, model_name, arrived, "cached", len(conversation_tokens), response_parts=response_parts, completion_tokens=len(cached_tokens))
+            if on_done is not None:
+                on_done()
+    return StreamingResponse(stream_cached_and_log(), media_type="text/event-stream")
+
+async def serve_chat_completion(worker_pool: WorkerPool, model_name: str, request: ChatRequest, http_request: Request, conversation_tokens: List[int], arrived: float, cache_key: Optional[str] = None):
+    """
+    Serve a chat completion on the worker pool of its model, which is released when the response ends.
+    cache_key is the response cache key of the request, if it was looked up before the model was acquired.
+    """
+    model_registry = app.state.model_registry
+    def journal(status, **fields):
+        journal_request(request, model_name, arrived, status, len(conversation_tokens), **fields)
+
+    # The response cache of a model is created on its first load: if that just happened, look the request up now
+    if cache_key is None:
+        cache_key, cached_tokens = await lookup_cached_response(worker_pool.response_cache, request, conversation_tokens)
+        if cached_tokens is not None:
+            return serve_cached_response(request, model_name, conversation_tokens, cached_tokens, arrived, on_done=lambda: model_registry.release(worker_pool))
+
+    # Admission control: queue up for a worker, or get rejected right away if the queue is full.
+    # The cost of a request is the tokens it can still put on its worker: the prompt and the generation budget
+    max_new_tokens = request.max_tokens if request.max_tokens is not None else args.max_tokens
+    scheduler = worker_pool.scheduler
+    metrics = worker_pool.metrics
+    try:
+        ticket = scheduler.submit(
+            len(conversation_tokens) + max_new_tokens,
+            priority=request.priority or "default",
+            deadline=request.deadline,
+        )
+    except QueueFullError as e:
+        metrics.requests.labels("rejected").inc()
+        journal("rejected")
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": "1"})
 
-    # Log incoming conversation to console
-    logger.info("="*20)
-    for i, message in enumerate(request.messages):
-        logger.info(f"[{message.role.upper()}]: {message.content}")
-    logger.info("-"*20)
-
-    # Acquire a worker from the pool (will wait if all are busy)
-    worker_pool = app.state.worker_pool
-    worker = await worker_pool.acquire_worker()
-
+    # Wait for a worker (the request leaves the queue if the client disconnects meanwhile)
     try:
-        # Build conversation tokens
-        bos = worker.tokenizer.get_bos_token_id()
-        user_start = worker.tokenizer.encode_special("<|user_start|>")
-        user_end = worker.tokenizer.encode_special("<|user_end|>")
-        assistant_start = worker.tokenizer.encode_special("<|assistant_start|>")
-        assistant_end = worker.tokenizer.encode_special("<|assistant_end|>")
-
-        conversation_tokens = [bos]
-        for message in request.messages:
-            if message.role == "user":
-                conversation_tokens.append(user_start)
-                conversation_tokens.extend(worker.tokenizer.encode(message.content))
-                conversation_tokens.append(user_end)
-            elif message.role == "assistant":
-                conversation_tokens.append(assistant_start)
-                conversation_tokens.extend(worker.tokenizer.encode(message.content))
-                conversation_tokens.append(assistant_end)
-
-        conversation_tokens.append(assistant_start)
+        worker = await worker_pool.acquire_worker(ticket, http_request)
+    except QueueFullError as e: # evicted by a higher priority request
+        metrics.requests.labels("rejected").inc()
+        journal("rejected", queue_wait=time.monotonic() - ticket.enqueued_at)
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": "1"})
+    except DeadlineExceededError as e:
+        metrics.requests.labels("expired").inc()
+        journal("expired", queue_wait=time.monotonic() - ticket.enqueued_at)
+        raise HTTPException(status_code=503, detail=str(e))
+    except HTTPException:
+        metrics.requests.labels("cancelled").inc()
+        journal("cancelled", queue_wait=time.monotonic() - ticket.enqueued_at)
+        raise
+    queue_wait = time.monotonic() - ticket.enqueued_at
+    metrics.request_started(worker.metric_key, queue_wait, len(conversation_tokens))
 
+    try:
         # Streaming response with worker release after completion
-        response_tokens = []
+        response_parts = []
+        timing = {}
         async def stream_and_release():
+            completed = False
             try:
                 async for chunk in generate_stream(
+                    worker_pool,
                     worker,
                     conversation_tokens,
+                    ticket,
+                    response_parts,
                     temperature=request.temperature,
-                    max_new_tokens=request.max_tokens,
-                    top_k=request.top_k
+                    max_new_tokens=max_new_tokens,
+                    top_k=request.top_k,
+                    cache_key=cache_key,
+                    timing=timing,
+                    arrived=arrived,
                 ):
-                    # Accumulate response for logging
-                    chunk_data = json.loads(chunk.replace("data: ", "").strip())
-                    if "token" in chunk_data:
-                        response_tokens.append(chunk_data["token"])
                     yield chunk
+                completed = True
             finally:
                 # Log the assistant response to console
-                full_response = "".join(response_tokens)
-                logger.info(f"[ASSISTANT] (GPU {worker.gpu_id}): {full_response}")
-                logger.info("="*20)
-                # Release worker back to pool after streaming is done
-                await worker_pool.release_worker(worker)
+                status = "ok" if completed else "aborted"
+                logger.debug(f"[ASSISTANT] (GPU {worker.gpu_id}): {''.join(response_parts)}")
+                logger.info(f"Request {status} on worker {worker.metric_key}: {len(conversation_tokens)} prompt tokens, {timing.get('completion_tokens', 0)} completion tokens")
+                # Release the worker slot to the scheduler after streaming is done, and the model to the registry
+                metrics.request_finished(worker.metric_key, arrived, status)
+                scheduler.release(ticket)
+                model_registry.release(worker_pool)
+                journal(status, response_parts=response_parts, queue_wait=queue_wait, worker=worker.metric_key, **timing)
 
         return StreamingResponse(
             stream_and_release(),
@@ -378,36 +862,159 @@ async def chat_completions(request: ChatRequest):
         )
     except Exception as e:
         # Make sure to release worker even on error
-        await worker_pool.release_worker(worker)
+        metrics.request_finished(worker.metric_key, arrived, "aborted")
+        scheduler.release(ticket)
         raise e
 
 @app.get("/health")
 async def health():
     """Health check endpoint."""
-    worker_pool = getattr(app.state, 'worker_pool', None)
+    model_registry = getattr(app.state, 'model_registry', None)
+    worker_pools = loaded_pools()
     return {
         "status": "ok",
-        "ready": worker_pool is not None and len(worker_pool.workers) > 0,
-        "num_gpus": worker_pool.num_gpus if worker_pool else 0,
-        "available_workers": worker_pool.available_workers.qsize() if worker_pool else 0
+        "ready": model_registry is not None and model_registry.default in model_registry.loaded,
+        "num_gpus": worker_pools[0].num_gpus if worker_pools else 0,
+        "free_slots": sum(pool.scheduler.stats()["free_slots"] for pool in worker_pools),
     }
 
+def scheduler_totals(worker_pools: List[WorkerPool]):
+    """The scheduler stats summed over the loaded models (as a single model server reports them, e.g. for chat_router)."""
+    totals = {"queue_depth": 0, "max_queue_depth": 0, "slots_per_worker": args.slots_per_worker, "active_requests": 0,
+              "free_slots": 0, "outstanding_tokens": 0, "num_shed": 0, "num_expired": 0}
+    for pool in worker_pools:
+        for key, value in pool.scheduler.stats().items():
+            if key != "slots_per_worker":
+                totals[key] += value
+    return totals
+
 @app.get("/stats")
 async def stats():
     """Get worker pool statistics."""
-    worker_pool = app.state.worker_pool
+    model_registry = app.state.model_registry
+    worker_pools = {name: entry.model for name, entry in model_registry.loaded.items()}
     return {
-        "total_workers": len(worker_pool.workers),
-        "available_workers": worker_pool.available_workers.qsize(),
-        "busy_workers": len(worker_pool.workers) - worker_pool.available_workers.qsize(),
+        "total_workers": sum(len(pool.workers) for pool in worker_pools.values()),
+        "busy_workers": sum(1 for pool in worker_pools.values() for i in range(len(pool.workers)) if pool.scheduler.active[i] > 0),
+        "scheduler": scheduler_totals(list(worker_pools.values())),
+        "response_cache": {name: cache.stats() for name, cache in app.state.model_registry.response_caches.items()} if args.cache_mb > 0 else None,
+        "models": model_registry.state(),
         "workers": [
             {
+                "model": name,
                 "gpu_id": w.gpu_id,
-                "device": str(w.device)
-            } for w in worker_pool.workers
+                "device": str(w.device),
+                **pool.scheduler.worker_stats(i),
+            } for name, pool in worker_pools.items() for i, w in enumerate(pool.workers)
         ]
     }
 
+@app.get("/models")
+async def models():
+    """The models that can be served, and which ones are loaded."""
+    return app.state.model_registry.state()
+
+async def run_batch_job(job: BatchJob, model_name: str):
+    """
+    Run a batch job in the background. Its batches go through the scheduler like any request, with the
+    lowest priority, so they soak up the capacity the interactive traffic leaves idle. At most one batch
+    per worker slot is in flight, and a batch that gets shed from a full queue simply tries again later.
+    The model is held for the whole job, so it is not unloaded in between batches.
+    """
+    loop = asyncio.get_running_loop()
+
+    def generate(worker, sampling, items):
+        with worker.autocast_ctx:
+            results = generate_batch_results(worker.engine, worker.tokenizer, sampling, items)
+        job.write_results(results)
+
+    async def run_one(worker_pool, slots, sampling, items):
+        scheduler = worker_pool.scheduler
+        async with slots:
+            cost = sum(len(tokens) for _, _, tokens in items) + sampling["max_tokens"] * len(items)
+            while True:
+                try:
+                    ticket = scheduler.submit(cost, priority="batch")
+                    worker = await scheduler.wait(ticket)
+                    break
+                except QueueFullError:
+                    await asyncio.sleep(BATCH_RETRY_INTERVAL)
+            try:
+                await loop.run_in_executor(worker.executor, generate, worker, sampling, items)
+            finally:
+                scheduler.release(ticket)
+
+    job.status = "running"
+    try:
+        worker_pool = await app.state.model_registry.acquire(model_name)
+        try:
+            slots = asyncio.Semaphore(len(worker_pool.workers) * args.slots_per_worker)
+            await asyncio.gather(*(run_one(worker_pool, slots, sampling, items) for sampling, items in job.batches))
+        finally:
+            app.state.model_registry.release(worker_pool)
+        job.status = "done"
+    except Exception as e:
+        logger.exception(f"Batch job {job.id} failed")
+        job.status, job.error = "failed", str(e)
+    job.finished_at = time.time()
+
+def resolve_batch_path(path: str) -> str:
+    """Batch jobs may only read and write files inside --batch-dir."""
+    batch_dir = os.path.realpath(args.batch_dir)
+    full_path = os.path.realpath(os.path.join(batch_dir, path))
+    if not full_path.startswith(batch_dir + os.sep):
+        raise HTTPException(status_code=400, detail=f"Path must be inside the batch directory: {path}")
+    return full_path
+
+@app.post("/batch/jobs")
+async def submit_batch_job(request: BatchJobRequest):
+    """Submit a batch job, it runs in the background."""
+    if args.batch_dir is None:
+        raise HTTPException(status_code=404, detail="Batch jobs are disabled, start the server with --batch-dir")
+    input_path, output_path = resolve_batch_path(request.input), resolve_batch_path(request.output)
+    if not os.path.isfile(input_path):
+        raise HTTPException(status_code=400, detail=f"Input file not found: {request.input}")
+    if not (1 <= request.batch_size <= 256):
+        raise HTTPException(status_code=400, detail="batch_size must be between 1 and 256")
+    try:
+        model_name = app.state.model_registry.resolve(request.model)
+    except UnknownModelError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    for job, _ in app.state.batch_jobs.values():
+        if job.output_path == output_path and job.status in ("pending", "running"):
+            raise HTTPException(status_code=409, detail=f"Job {job.id} is already writing to {request.output}")
+    sampling = {k: v for k, v in [("temperature", request.temperature), ("top_k", request.top_k), ("max_tokens", request.max_tokens)] if v is not None}
+    try:
+        # reading and tokenizing the input can take a while, keep it off the event loop
+        limits = {"temperature": (MIN_TEMPERATURE, MAX_TEMPERATURE), "top_k": (MIN_TOP_K, MAX_TOP_K), "max_tokens": (MIN_MAX_TOKENS, MAX_MAX_TOKENS)}
+        job = await asyncio.to_thread(BatchJob, input_path, output_path, app.state.tokenizer, request.batch_size, sampling, sampling_limits=limits)
+    except (ValueError, KeyError) as e:
+        raise HTTPException(status_code=400, detail=f"Invalid input file: {e}")
+    task = asyncio.create_task(run_batch_job(job, model_name))
+    app.state.batch_jobs[job.id] = (job, task)
+    logger.info(f"Batch job {job.id}: {job.num_total - job.num_done} conversations from {request.input} to {request.output} with model {model_name}")
+    return job.state()
+
+@app.get("/batch/jobs")
+async def list_batch_jobs():
+    """All batch jobs since the server started."""
+    return [job.state() for job, _ in app.state.batch_jobs.values()]
+
+@app.get("/batch/jobs/{job_id}")
+async def batch_job_status(job_id: str):
+    """Progress of a batch job."""
+    if job_id not in app.state.batch_jobs:
+        raise HTTPException(status_code=404, detail=f"Unknown batch job: {job_id}")
+    job, _ = app.state.batch_jobs[job_id]
+    return job.state()
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus metrics."""
+    serving_metrics = getattr(app.state, 'metrics', None)
+    content = serving_metrics.render() if serving_metrics else ""
+    return PlainTextResponse(content, media_type="text/plain; version=0.0.4")
+
 if __name__ == "__main__":
     import uvicorn
     print(f"Starting NanoChat Web Server")
@@ -0,0 +1,238 @@
+"""
+Light finetuning that calibrates the early exit used as the draft model of self-speculative decoding.
+The loss is the usual full-depth loss plus a weighted loss on the logits of the first exit_layer blocks,
+so the full model stays as it is while the early exit learns to agree with it more often.
+Run on one GPU e.g. for debugging:
+
+python -m scripts.exit_train -- --exit_layer=10
+
+Or torchrun for training:
+
+torchrun --standalone --nproc_per_node=8 -m scripts.exit_train -- --exit_layer=10
+
+Then chat with it using the drafted decoding:
+
+python -m scripts.chat_cli -i exit --draft-layers=10
+"""
+
+import os
+os.environ["PYTORCH_CUDA_ALLOC_CONF"] = "expandable_segments:True"
+
+import wandb
+import numpy as np
+import torch
+import torch.distributed as dist
+from contextlib import nullcontext
+
+from nanochat.common import compute_init, compute_cleanup, get_base_dir, print0, DummyWandb, autodetect_device_type
+from nanochat.checkpoint_manager import load_model
+from nanochat.checkpoint_manager import save_checkpoint
+
+from tasks.common import TaskMixture
+from tasks.gsm8k import GSM8K
+from tasks.smoltalk import SmolTalk
+
+# -----------------------------------------------------------------------------
+# Hyperparameters
+run = "dummy" # wandb run name default ("dummy" is special - we won't log to wandb)
+# input model options
+source = "sft" # mid|sft|rl, which checkpoint to load the model from
+model_tag = None # model tag to load the model from
+step = None # step to load the model from
+# early exit
+exit_layer = -1 # number of blocks of the draft model (-1 = half of the layers)
+exit_loss_weight = 1.0 # weight of the early exit loss relative to the full-depth loss
+# compute/precision
+device_type = "" # cuda|cpu|mps (empty => autodetect)
+dtype = "bfloat16"
+device_batch_size = 4 # max to avoid OOM
+# optimization
+num_iterations = 200 # this is meant to be a light finetune
+target_examples_per_step = 32
+unembedding_lr = 0.004
+embedding_lr = 0.2
+matrix_lr = 0.02
+weight_decay = 0.0
+init_lr_frac = 0.02
+# evaluation
+eval_every = 50
+eval_steps = 50
+# now allow CLI to override the settings via the configurator lol
+config_keys = [k for k,v in globals().items() if not k.startswith('_') and isinstance(v, (int, float, bool, str))]
+exec(open(os.path.join('nanochat', 'configurator.py')).read()) # overrides from command line or config file
+user_config = {k: globals()[k] for k in config_keys} # possibly useful for logging
+# -----------------------------------------------------------------------------
+
+# Compute init
+device_type = autodetect_device_type() if device_type == "" else device_type
+ddp, ddp_rank, ddp_local_rank, ddp_world_size, device = compute_init(device_type)
+master_process = ddp_rank == 0
+ptdtype = torch.float32 if dtype == 'float32' else torch.bfloat16
+autocast_ctx = torch.amp.autocast(device_type=device_type, dtype=ptdtype) if device_type == "cuda" else nullcontext()
+
+# wandb logging init
+use_dummy_wandb = run == "dummy" or not master_process
+wandb_run = DummyWandb() if use_dummy_wandb else wandb.init(project="nanochat-exit", name=run, config=user_config, save_code=True)
+
+# Load the model and tokenizer
+model, tokenizer, meta = load_model(source, device, phase="train", model_tag=model_tag, step=step)
+n_layer = model.config.n_layer
+exit_layer = n_layer // 2 if exit_layer == -1 else exit_layer
+assert 0 < exit_layer < n_layer, f"exit_layer must be in (0, {n_layer}), got {exit_layer}"
+print0(f"Calibrating the early exit after {exit_layer}/{n_layer} layers")
+
+# -----------------------------------------------------------------------------
+# Task data mixture, a small slice of general conversations and some tool use
+train_ds = TaskMixture([
+    SmolTalk(split="train", stop=10_000), # 10K rows of smoltalk
+    GSM8K(subset="main", split="train"), # 8K rows, keeps the calculator tool use in the draft
+])
+val_ds = SmolTalk(split="test") # general conversations, we only use a small part of it
+
+# -----------------------------------------------------------------------------
+# DataLoader
+
+def exit_data_generator(dataset, batch_size):
+    pad_token_id = tokenizer.encode_special("<|assistant_end|>") # padded positions are masked in the loss
+    batch = []
+    while True:
+        for i in range(ddp_rank, len(dataset), ddp_world_size):
+            batch.append(dataset[i])
+            if len(batch) < batch_size:
+                continue
+            # render the whole batch at once into flat arrays
+            ids, mask, offsets = tokenizer.render_conversations(batch)
+            lengths = np.diff(offsets)
+            ncols = lengths.max() - 1 # seq of n creates inputs/targets of n-1
+            inputs = np.full((batch_size, ncols), pad_token_id, dtype=np.int64)
+            targets = np.full((batch_size, ncols), -1, dtype=np.int64) # -1 is ignore index
+            for row, (start, n) in enumerate(zip(offsets[:-1].tolist(), lengths.tolist())):
+                row_ids = ids[start:start + n]
+                inputs[row, :n-1] = row_ids[:-1]
+                targets[row, :n-1] = row_ids[1:]
+                targets[row, :n-1][mask[start + 1:start + n] == 0] = -1
+            yield torch.from_numpy(inputs).to(device), torch.from_numpy(targets).to(device)
+            batch = []
+
+examples_per_step = device_batch_size * ddp_world_size
+assert target_examples_per_step % examples_per_step == 0, "Target examples per step must be divisible by examples per step"
+grad_accum_steps = target_examples_per_step // examples_per_step
+print0(f"=> Setting grad accum steps: {grad_accum_steps}")
+train_loader = exit_data_generator(train_ds, batch_size=device_batch_size)
+build_val_loader = lambda: exit_data_generator(val_ds, batch_size=device_batch_size)
+
+# -----------------------------------------------------------------------------
+# Initialize the Optimizer
+
+optimizers = model.setup_optimizers(
+    unembedding_lr=unembedding_lr,
+    embedding_lr=embedding_lr,
+    matrix_lr=matrix_lr,
+    weight_decay=weight_decay,
+)
+for opt in optimizers:
+    for group in opt.param_groups:
+        group["lr"] = group["lr"] * init_lr_frac
+        group["initial_lr"] = group["lr"] # save the initial learning so we can decay easily later
+
+def get_lr_multiplier(it):
+    return 1.0 - it / num_iterations
+
+# -----------------------------------------------------------------------------
+# Training loop
+
+for step in range(num_iterations + 1):
+    last_step = step == num_iterations
+
+    # evaluate the full-depth and early exit validation losses
+    if last_step or step % eval_every == 0:
+        model.eval()
+        val_loader = build_val_loader()
+        full_losses, exit_losses = [], []
+        for _ in range(eval_steps):
+            val_inputs, val_targets = next(val_loader)
+            with torch.no_grad(), autocast_ctx:
+                full_losses.append(model(val_inputs, val_targets))
+                exit_losses.append(model(val_inputs, val_targets, exit_layer=exit_layer))
+        val_losses = torch.stack([torch.stack(full_losses).mean(), torch.stack(exit_losses).mean()])
+        if ddp:
+            dist.all_reduce(val_losses, op=dist.ReduceOp.AVG) # average over ranks
+        val_loss, val_exit_loss = val_losses.tolist()
+        print0(f"Step {step:05d} | Validation loss: {val_loss:.6f} | Early exit loss: {val_exit_loss:.6f}")
+        wandb_run.log({
+            "step": step,
+            "val_loss": val_loss,
+            "val_exit_loss": val_exit_loss,
+        })
+        model.train()
+
+    if last_step:
+        break
+
+    # evaluate the gradient of the joint loss
+    for micro_step in range(grad_accum_steps):
+        train_inputs, train_targets = next(train_loader)
+        with autocast_ctx:
+            full_loss = model(train_inputs, train_targets)
+            exit_loss = model(train_inputs, train_targets, exit_layer=exit_layer)
+        loss = full_loss + exit_loss_weight * exit_loss
+        train_loss, train_exit_loss = full_loss.detach(), exit_loss.detach() # for logging
+        loss = loss / grad_accum_steps # each .backward() is a grad sum => normalize loss here
+        loss.backward()
+
+    # learning rate scheduler
+    lrm = get_lr_multiplier(step)
+    for opt in optimizers:
+        for group in opt.param_groups:
+            group["lr"] = group["initial_lr"] * lrm
+
+    # step the optimizers
+    for opt in optimizers:
+        opt.step()
+    model.zero_grad(set_to_none=True)
+
+    # logging
+    train_loss_item, train_exit_loss_item = train_loss.item(), train_exit_loss.item()
+    print0(f"Step {step:05d}/{num_iterations:05d} | Training loss: {train_loss_item:.6f} | Early exit loss: {train_exit_loss_item:.6f} | lrm: {lrm:.6f}")
+    wandb_run.log({
+        "step": step,
+        "lrm": lrm,
+        "train_loss": train_loss_item,
+        "train_exit_loss": train_exit_loss_item,
+    })
+
+# Save the model at the end of the run
+if master_process:
+    base_dir = get_base_dir()
+    model_tag = f"d{n_layer}" # base the model tag on the depth of the base model
+    checkpoint_dir = os.path.join(base_dir, "chatexit_checkpoints", model_tag)
+    model_config_kwargs = model.config.__dict__ # slightly naughty, abusing the simplicity of GPTConfig, TODO nicer
+    save_checkpoint(
+        checkpoint_dir,
+        step,
+        model.state_dict(),
+        None, # note: we don't bother to save the optimizer state
+        {
+            "step": step,
+            "val_loss": val_loss,
+            "val_exit_loss": val_exit_loss,
+            "exit_layer": exit_layer,
+            "model_config": model_config_kwargs,
+        }
+    )
+    print(f"✅ Saved model checkpoint to {checkpoint_dir}")
+
+# Log to report
+from nanochat.report import get_report
+get_report().log(section="Early exit finetuning", data=[
+    user_config, # CLI args
+    {
+        "Exit layer": exit_layer,
+        "Validation loss": val_loss,
+        "Early exit validation loss": val_exit_loss,
+    },
+])
+
+# Cleanup
+wandb_run.finish()
+compute_cleanup()
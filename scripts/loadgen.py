@@ -0,0 +1,166 @@
+"""
+Load generator for the chat API of chat_web: how many requests, at what latency, can a server take?
+
+Two ways to drive the server:
+- closed loop (--concurrency N): N simulated users, each sends its next request as soon as the
+  previous response ends. Measures the latency at a given level of concurrency.
+- open loop (--rate R): requests arrive as a Poisson process of R requests/s, whether or not the
+  server keeps up. Measures the latency at a given throughput, and where the server saturates.
+Prompt and response lengths are drawn from distributions (--prompt-tokens, --output-tokens), e.g.
+fixed:64, uniform:16:256 or exp:100 (exponential with that mean). Prompts are made of random words,
+about one token each, so that no two requests hit the response cache. The report has the TTFT,
+inter-token latency and duration percentiles, the throughput and the errors, as markdown and JSON.
+
+Against a running server:
+python -m scripts.loadgen --url http://localhost:8000 --concurrency 8 --num-requests 200
+
+Against a tiny randomly initialized model on CPU, started just for the run (no checkpoint or GPU needed):
+python -m scripts.loadgen --tiny --rate 5 --num-requests 50 --output loadgen.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from nanochat.loadtest import stream_chat, summarize, format_markdown
+
+parser = argparse.ArgumentParser(description='Load generator for the chat API')
+parser.add_argument('--url', type=str, default='http://localhost:8000', help='URL of the chat_web server')
+parser.add_argument('--tiny', action='store_true', help='Start a chat_web server with a tiny random model on CPU for the run, and load test that')
+parser.add_argument('--tiny-port', type=int, default=8765, help='Port of the --tiny server')
+parser.add_argument('--concurrency', type=int, default=4, help='Closed loop: number of concurrent simulated users')
+parser.add_argument('--rate', type=float, default=0.0, help='Open loop: Poisson arrival rate in requests/s (> 0 overrides --concurrency)')
+parser.add_argument('--num-requests', type=int, default=100, help='Total number of requests')
+parser.add_argument('--prompt-tokens', type=str, default='uniform:16:256', help='Distribution of the prompt lengths: fixed:N | uniform:A:B | exp:MEAN')
+parser.add_argument('--output-tokens', type=str, default='uniform:16:128', help='Distribution of the response lengths (max_tokens), same format')
+parser.add_argument('--temperature', type=float, default=0.8, help='Sampling temperature of the requests')
+parser.add_argument('--model', type=str, default=None, help='Model to request (default: the default model of the server)')
+parser.add_argument('--seed', type=int, default=0, help='Random seed of the arrivals and lengths')
+parser.add_argument('--output', type=str, default=None, help='Write the JSON summary to this file')
+parser.add_argument('--markdown', type=str, default=None, help='Write the markdown report to this file (it always goes to stdout)')
+args = parser.parse_args()
+
+WORDS = "the of and to in is was for on that with as by at from his her it an were are which this be or had not but".split()
+
+def parse_distribution(spec):
+    """A sampler of positive ints from fixed:N, uniform:A:B or exp:MEAN."""
+    kind, *params = spec.split(":")
+    params = [float(p) for p in params]
+    if kind == "fixed":
+        return lambda rng: int(params[0])
+    if kind == "uniform":
+        return lambda rng: rng.randint(int(params[0]), int(params[1]))
+    if kind == "exp":
+        return lambda rng: max(int(rng.expovariate(1.0 / params[0])), 1)
+    raise ValueError(f"Unknown distribution: {spec}")
+
+def make_payloads():
+    rng = random.Random(args.seed)
+    prompt_tokens, output_tokens = parse_distribution(args.prompt_tokens), parse_distribution(args.output_tokens)
+    payloads = []
+    for _ in range(args.num_requests):
+        content = " ".join(rng.choice(WORDS) for _ in range(prompt_tokens(rng)))
+        payload = {"messages": [{"role": "user", "content": content}], "max_tokens": output_tokens(rng), "temperature": args.temperature}
+        if args.model is not None:
+            payload["model"] = args.model
+        payloads.append(payload)
+    return payloads
+
+async def run_load(url, payloads):
+    import aiohttp
+    results = []
+    connector = aiohttp.TCPConnector(limit=0) # no client-side cap on concurrent connections
+    async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=None)) as session:
+        t0 = time.perf_counter()
+        if args.rate > 0:
+            # open loop: send at Poisson arrival times, regardless of the responses
+            rng = random.Random(args.seed + 1)
+            tasks, arrival = [], 0.0
+            for payload in payloads:
+                await asyncio.sleep(max(t0 + arrival - time.perf_counter(), 0.0))
+                tasks.append(asyncio.create_task(stream_chat(session, url, payload)))
+                arrival += rng.expovariate(args.rate)
+            results = await asyncio.gather(*tasks)
+        else:
+            # closed loop: each user sends its next request when the previous one is done
+            pending = list(reversed(payloads))
+            async def user():
+                while pending:
+                    results.append(await stream_chat(session, url, pending.pop()))
+            await asyncio.gather(*(user() for _ in range(args.concurrency)))
+        return results, time.perf_counter() - t0
+
+# -----------------------------------------------------------------------------
+# A tiny random model, served by chat_web on CPU
+
+def make_tiny_base_dir(base_dir):
+    """Write a byte-level tokenizer and a tiny randomly initialized sft checkpoint (model tag "tiny") into base_dir."""
+    import tiktoken
+    import torch
+    from nanochat.tokenizer import RustBPETokenizer, SPECIAL_TOKENS, SPLIT_PATTERN
+    from nanochat.gpt import GPT, GPTConfig
+    from nanochat.checkpoint_manager import save_checkpoint
+    enc = tiktoken.Encoding(
+        name="bytes",
+        pat_str=SPLIT_PATTERN,
+        mergeable_ranks={bytes([i]): i for i in range(256)}, # no merges: one token per byte
+        special_tokens={name: 256 + i for i, name in enumerate(SPECIAL_TOKENS)},
+    )
+    RustBPETokenizer(enc, "<|bos|>").save(os.path.join(base_dir, "tokenizer"))
+    model_config = dict(sequence_len=2048, vocab_size=enc.n_vocab, n_layer=2, n_head=2, n_kv_head=2, n_embd=64)
+    torch.manual_seed(0)
+    model = GPT(GPTConfig(**model_config))
+    model.init_weights()
+    checkpoint_dir = os.path.join(base_dir, "chatsft_checkpoints", "tiny")
+    save_checkpoint(checkpoint_dir, 0, model.state_dict(), None, {"step": 0, "model_config": model_config})
+
+def start_tiny_server(base_dir, port, timeout=120.0):
+    make_tiny_base_dir(base_dir)
+    env = {**os.environ, "NANOCHAT_BASE_DIR": base_dir}
+    cmd = [sys.executable, "-m", "scripts.chat_web", "--device-type", "cpu", "-i", "sft", "-g", "tiny",
+           "--port", str(port), "--host", "127.0.0.1", "--cache-mb", "0", "--dtype", "float32"]
+    process = subprocess.Popen(cmd, env=env)
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        assert process.poll() is None, "The tiny chat_web server exited during startup"
+        try:
+            with urllib.request.urlopen(f"{url}/health", timeout=1.0) as resp:
+                if json.load(resp).get("ready"):
+                    return process, url
+        except OSError:
+            pass
+        time.sleep(0.5)
+    process.terminate()
+    raise TimeoutError("The tiny chat_web server did not get ready in time")
+
+if __name__ == "__main__":
+    server, base_dir = None, None
+    url = args.url
+    if args.tiny:
+        base_dir = tempfile.mkdtemp(prefix="nanochat_loadgen_")
+        server, url = start_tiny_server(base_dir, args.tiny_port)
+    try:
+        results, wall_time = asyncio.run(run_load(url, make_payloads()))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+            shutil.rmtree(base_dir, ignore_errors=True)
+    summary = summarize(results, wall_time)
+    summary["config"] = {k: v for k, v in vars(args).items() if k not in ("output", "markdown")}
+    mode = f"open loop, {args.rate} requests/s" if args.rate > 0 else f"closed loop, concurrency {args.concurrency}"
+    report = format_markdown(summary, title=f"Load test of {'a tiny CPU model' if args.tiny else url} ({mode})")
+    print(report)
+    if args.markdown:
+        with open(args.markdown, "w", encoding="utf-8") as f:
+            f.write(report)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(summary, f, indent=2)
@@ -9,7 +9,6 @@ Or torchrun for training:
 torchrun --standalone --nproc_per_node=8 -m scripts.mid_train -- --device_batch_size=16
 """
 
-from collections import deque
 import os
 os.environ["PYTORCH_CUDA_ALLOC_CONF"] = "expandable_segments:True"
 import time
@@ -20,6 +19,7 @@ from nanochat.common import compute_init, compute_cleanup, print0, DummyWandb, g
 from nanochat.tokenizer import get_token_bytes
 from nanochat.checkpoint_manager import save_checkpoint
 from nanochat.loss_eval import evaluate_bpb
+from nanochat.dataloader import TokenBuffer, ScratchBuffers
 from nanochat.checkpoint_manager import load_model
 import torch.distributed as dist
 
@@ -121,17 +121,22 @@ def mid_data_generator(split):
     dataset_size = len(dataset)
     assert dataset_size > 0
     needed_tokens = device_batch_size * max_seq_len + 1 # to form one training batch of inputs,targets
-    token_buffer = deque()
-    # CUDA supports memory pinning for faster transfers between CPU and GPU:
-    scratch = torch.empty(needed_tokens, dtype=torch.int64, pin_memory=(device_type == "cuda"))
+    token_buffer = TokenBuffer()
+    # reused (pinned on CUDA) buffers of the batch tokens, for asynchronous transfers between CPU and GPU:
+    scratch = ScratchBuffers(device_batch_size, max_seq_len, device)
     cursor = ddp_rank # increments by ddp_world_size each time, so each rank processes unique documents
     it = 0 # iteration counter
+    render_block = 64 # conversations rendered together in one batched call, ahead of the cursor
+    ids, offsets, k = None, None, render_block # the rendered block, and the index in it of the conversation at the cursor
     while True:
         # Accumulate enough tokens for one iteration before yielding
         while len(token_buffer) < needed_tokens:
-            conversation = dataset[cursor]
-            ids, _ = tokenizer.render_conversation(conversation)
-            token_buffer.extend(ids)
+            if k == render_block:
+                block = [dataset[(cursor + j * ddp_world_size) % dataset_size] for j in range(render_block)]
+                ids, _, offsets = tokenizer.render_conversations(block)
+                k = 0
+            token_buffer.append(ids[offsets[k]:offsets[k + 1]])
+            k += 1
             cursor += ddp_world_size
             if cursor >= dataset_size:
                 cursor -= dataset_size # wrap around for another epoch
@@ -142,12 +147,10 @@ def mid_data_generator(split):
         if 0 < num_iterations <= it and split == "train":
             last_step = True # toggle last_step to True, which will terminate the training loop
         # Build up inputs/targets and yield
-        for i in range(needed_tokens):
-            scratch[i] = token_buffer.popleft()
-        inputs_cpu = scratch[:-1].to(dtype=torch.int32)
-        targets_cpu = scratch[1:]
-        inputs = inputs_cpu.view(device_batch_size, max_seq_len).to(device=device, dtype=torch.int32, non_blocking=True)
-        targets = targets_cpu.view(device_batch_size, max_seq_len).to(device=device, dtype=torch.int64, non_blocking=True)
+        tokens = scratch.next()
+        token_buffer.take(needed_tokens, out=tokens.numpy())
+        inputs, targets = scratch.to_device(tokens)
+        inputs = inputs.to(dtype=torch.int32)
         if split == "train":
             if num_iterations > 0:
                 approx_progress = it / num_iterations # calculate progress from the max number of iterations
@@ -0,0 +1,126 @@
+"""
+Replay a request journal recorded by chat_web (--journal) and report latency and throughput.
+The requests go out with the arrival pattern of the recording (optionally accelerated), with the
+same sampling parameters and token counts, so a journal of real traffic makes a regression test.
+Requests recorded without content (no --journal-content) are replayed with synthetic prompts of
+the recorded length, and each request generates as many tokens as it did in the recording.
+
+Against a running server:
+python -m scripts.replay --journal journal.jsonl --url http://localhost:8000 --speed 2
+
+Directly against an Engine (one request at a time, waiting requests queue up as they would on one worker):
+python -m scripts.replay --journal journal.jsonl -i sft --speed 0
+"""
+import argparse
+import asyncio
+import json
+import queue
+import threading
+import time
+from nanochat.journal import read_journal
+from nanochat.loadtest import RequestTimer, stream_chat, summarize, format_markdown
+
+parser = argparse.ArgumentParser(description='Replay a chat_web request journal')
+parser.add_argument('--journal', type=str, required=True, help='Request journal (JSONL) recorded by chat_web --journal')
+parser.add_argument('--url', type=str, default=None, help='URL of the server to replay against (default: replay against a local Engine)')
+parser.add_argument('--speed', type=float, default=1.0, help='Time acceleration of the arrivals, e.g. 2 = twice as fast (0 = all at once)')
+parser.add_argument('--limit', type=int, default=None, help='Replay only the first N requests')
+parser.add_argument('--model', type=str, default=None, help='Model name to send with every request (default: the recorded one)')
+parser.add_argument('--output', type=str, default=None, help='Write the JSON summary to this file (the markdown report goes to stdout)')
+parser.add_argument('-i', '--source', type=str, default="sft", help="Engine mode: source of the model: sft|mid|rl|exit")
+parser.add_argument('-g', '--model-tag', type=str, default=None, help='Engine mode: model tag to load')
+parser.add_argument('-s', '--step', type=int, default=None, help='Engine mode: step to load')
+parser.add_argument('--device-type', type=str, default='', choices=['cuda', 'cpu', 'mps'], help='Engine mode: device type: cuda|cpu|mps. empty => autodetect')
+args = parser.parse_args()
+
+records = read_journal(args.journal)[:args.limit]
+assert records, f"No requests in {args.journal}"
+start = records[0]["arrival"]
+offsets = [(record["arrival"] - start) / args.speed if args.speed > 0 else 0.0 for record in records]
+print(f"Replaying {len(records)} requests recorded over {records[-1]['arrival'] - start:.1f}s, at {args.speed}x")
+
+def synthetic_message(num_tokens):
+    # about one token per word, minus the tokens of the chat template around the message
+    return " ".join(["hello"] * max(num_tokens - 4, 1))
+
+def request_payload(record):
+    messages = record.get("messages") or [{"role": "user", "content": synthetic_message(record["prompt_tokens"])}]
+    payload = {
+        "messages": messages,
+        "temperature": record["temperature"],
+        "top_k": record["top_k"],
+        "max_tokens": record["completion_tokens"] or record["max_tokens"],
+        "priority": record.get("priority"),
+        "deadline": record.get("deadline"),
+    }
+    model = args.model or record.get("model")
+    if model is not None:
+        payload["model"] = model
+    return payload
+
+async def replay_server():
+    import aiohttp
+    async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=None)) as session:
+        t0 = time.perf_counter()
+        async def replay_one(record, offset):
+            await asyncio.sleep(max(t0 + offset - time.perf_counter(), 0.0))
+            return await stream_chat(session, args.url, request_payload(record))
+        results = await asyncio.gather(*(replay_one(record, offset) for record, offset in zip(records, offsets)))
+        return results, time.perf_counter() - t0
+
+def replay_engine():
+    import torch
+    from contextlib import nullcontext
+    from nanochat.common import compute_init, autodetect_device_type
+    from nanochat.checkpoint_manager import load_model
+    from nanochat.engine import Engine
+    from nanochat.batch import render_prompt
+    from nanochat.warmup import warmup_prompt
+    device_type = autodetect_device_type() if args.device_type == "" else args.device_type
+    _, _, _, _, device = compute_init(device_type)
+    model, tokenizer, _ = load_model(args.source, device, phase="eval", model_tag=args.model_tag, step=args.step)
+    engine = Engine(model, tokenizer)
+    autocast_ctx = torch.amp.autocast(device_type=device_type, dtype=torch.bfloat16) if device_type == "cuda" else nullcontext()
+    assistant_end = tokenizer.encode_special("<|assistant_end|>")
+    bos = tokenizer.get_bos_token_id()
+
+    # The arrivals are scheduled on this thread, one worker thread generates them in order
+    arrivals = queue.Queue()
+    results = [None] * len(records)
+    def worker():
+        while True:
+            item = arrivals.get()
+            if item is None:
+                return
+            i, scheduled = item
+            record = records[i]
+            tokens = render_prompt(tokenizer, record["messages"], max_tokens=None) if record.get("messages") else warmup_prompt(tokenizer, record["prompt_tokens"])
+            timer = RequestTimer(t0=scheduled) # the time spent waiting for the worker counts
+            with autocast_ctx:
+                for token_column, _ in engine.generate(tokens, max_tokens=record["completion_tokens"] or record["max_tokens"], temperature=record["temperature"], top_k=record["top_k"], seed=i):
+                    if token_column[0] in (assistant_end, bos):
+                        break
+                    timer.token()
+            results[i] = timer.finish()
+    thread = threading.Thread(target=worker, daemon=True)
+    t0 = time.perf_counter()
+    thread.start()
+    for i, offset in enumerate(offsets):
+        time.sleep(max(t0 + offset - time.perf_counter(), 0.0))
+        arrivals.put((i, t0 + offset))
+    arrivals.put(None)
+    thread.join()
+    return results, time.perf_counter() - t0
+
+if args.url:
+    results, wall_time = asyncio.run(replay_server())
+else:
+    results, wall_time = replay_engine()
+summary = summarize(results, wall_time)
+summary["journal"] = args.journal
+summary["speed"] = args.speed
+summary["target"] = args.url or f"engine:{args.source}"
+print(format_markdown(summary, title=f"Replay of {args.journal} against {summary['target']}"))
+if args.output:
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(summary, f, indent=2)
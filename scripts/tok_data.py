@@ -0,0 +1,82 @@
+"""
+Tokenize the pretraining data once, into the memory-mapped token shards of the dataloader (see
+nanochat/token_shards.py). base_train then reads its batches straight from the token files instead of
+tokenizing the parquet text again in every epoch of every run. The shards are tokenized in parallel,
+one per worker process, and the shards already tokenized (with the same tokenizer) are skipped, so the script can be re-run
+after downloading more data.
+
+python -m scripts.tok_data
+python -m scripts.tok_data --num-workers 16 --tokenizer-threads 4
+"""
+import os
+import time
+import argparse
+import numpy as np
+import pyarrow.parquet as pq
+from multiprocessing import Pool
+
+from nanochat.common import get_base_dir
+from nanochat.dataset import list_parquet_files, record_manifest_tokens
+from nanochat.tokenizer import get_tokenizer, get_tokenizer_fingerprint
+from nanochat.token_shards import shard_name, shard_paths, write_shard, read_offsets, write_meta, prepare_tokens_dir
+
+parser = argparse.ArgumentParser(description='Tokenize the pretraining parquet shards into memory-mapped token shards')
+parser.add_argument('--tokens-dir', type=str, default=None, help='Output directory (default: <base_dir>/tokenized_data, where base_train looks)')
+parser.add_argument('--num-workers', type=int, default=max((os.cpu_count() or 1) // 4, 1), help='Number of shards tokenized in parallel')
+parser.add_argument('--tokenizer-threads', type=int, default=4, help='Tokenizer threads per worker')
+args = parser.parse_args()
+
+tokenizer = None # one per worker process
+
+def init_worker():
+    global tokenizer
+    tokenizer = get_tokenizer()
+
+def tokenize_shard(parquet_path, tokens_dir):
+    """Tokenize one parquet shard, one row group at a time, return its name and counts."""
+    name = shard_name(parquet_path)
+    if os.path.exists(shard_paths(tokens_dir, name)[0]):
+        offsets = read_offsets(tokens_dir, name)
+        return name, int(offsets[-1]), len(offsets) - 1, True
+    bos = tokenizer.get_bos_token_id()
+    pf = pq.ParquetFile(parquet_path)
+    token_arrays, offset_arrays, num_tokens = [], [], 0
+    for rg_idx in range(pf.num_row_groups):
+        texts = pf.read_row_group(rg_idx, columns=["text"]).column("text").to_pylist()
+        tokens, offsets = tokenizer.encode_batch_to_array(texts, prepend=bos, num_threads=args.tokenizer_threads)
+        token_arrays.append(tokens)
+        offset_arrays.append(offsets[:-1] + num_tokens)
+        num_tokens += len(tokens)
+    offset_arrays.append(np.array([num_tokens], dtype=np.int64))
+    offsets = np.concatenate(offset_arrays)
+    write_shard(tokens_dir, name, np.concatenate(token_arrays), offsets)
+    return name, num_tokens, len(offsets) - 1, False
+
+def tokenize_shard_star(job):
+    return tokenize_shard(*job)
+
+if __name__ == "__main__":
+    tokens_dir = args.tokens_dir or os.path.join(get_base_dir(), "tokenized_data")
+    fingerprint = get_tokenizer_fingerprint()
+    if prepare_tokens_dir(tokens_dir, fingerprint): # only the shards made with this tokenizer are kept
+        print(f"The tokenizer has changed since {tokens_dir} was tokenized, deleted the old shards to tokenize them again")
+    parquet_paths = list_parquet_files()
+    init_worker()
+    vocab_size, bos = tokenizer.get_vocab_size(), tokenizer.get_bos_token_id()
+    print(f"Tokenizing {len(parquet_paths)} shards into {tokens_dir} with {args.num_workers} workers")
+
+    t0 = time.time()
+    shards, new_tokens = {}, 0
+    with Pool(processes=args.num_workers, initializer=init_worker) as pool:
+        jobs = [(path, tokens_dir) for path in parquet_paths]
+        for name, num_tokens, num_docs, skipped in pool.imap_unordered(tokenize_shard_star, jobs):
+            shards[name] = {"num_tokens": num_tokens, "num_docs": num_docs}
+            if not skipped:
+                new_tokens += num_tokens
+            elapsed = time.time() - t0
+            print(f"{len(shards)}/{len(jobs)} {name}: {num_tokens:,} tokens, {num_docs:,} documents{' (already done)' if skipped else ''} | {new_tokens / elapsed / 1e6:.2f}M tokens/s")
+    write_meta(tokens_dir, vocab_size, bos, shards, tokenizer_fingerprint=fingerprint)
+    # the token counts also go into the manifest of the parquet files
+    record_manifest_tokens({os.path.basename(path): shards[shard_name(path)]["num_tokens"] for path in parquet_paths})
+    total_tokens = sum(shard["num_tokens"] for shard in shards.values())
+    print(f"Done: {total_tokens:,} tokens in {len(shards)} shards, {time.time() - t0:.1f}s")
@@ -17,36 +17,25 @@ parser = argparse.ArgumentParser(description='Train a BPE tokenizer')
 parser.add_argument('--max_chars', type=int, default=10_000_000_000, help='Maximum characters to train on (default: 10B)')
 parser.add_argument('--doc_cap', type=int, default=10_000, help='Maximum characters per document (default: 10,000)')
 parser.add_argument('--vocab_size', type=int, default=65536, help='Vocabulary size (default: 65536 = 2^16)')
+parser.add_argument('--max_unique_chunks', type=int, default=0, help='Bound the memory of training by keeping at most this many unique chunks, dropping the rarest (default: 0 = no bound)')
 args = parser.parse_args()
 print(f"max_chars: {args.max_chars:,}")
 print(f"doc_cap: {args.doc_cap:,}")
 print(f"vocab_size: {args.vocab_size:,}")
-
-# -----------------------------------------------------------------------------
-# Text iterator
-
-def text_iterator():
-    """
-    1) Flatten the batches into a single iterator
-    2) Crop every document to args.doc_cap characters
-    3) Break when we've seen args.max_chars characters
-    """
-    nchars = 0
-    for batch in parquets_iter_batched(split="train"):
-        for doc in batch:
-            doc_text = doc
-            if len(doc_text) > args.doc_cap:
-                doc_text = doc_text[:args.doc_cap]
-            nchars += len(doc_text)
-            yield doc_text
-            if nchars > args.max_chars:
-                return
-text_iter = text_iterator()
+print(f"max_unique_chunks: {args.max_unique_chunks:,}")
 
 # -----------------------------------------------------------------------------
 # Train the tokenizer
+# The row groups of the parquet files go to rustbpe as they are: it crops the documents to doc_cap
+# characters and stops after max_chars, splitting and counting in parallel without holding the GIL
 t0 = time.time()
-tokenizer = RustBPETokenizer.train_from_iterator(text_iter, args.vocab_size)
+tokenizer = RustBPETokenizer.train_from_iterator(
+    parquets_iter_batched(split="train"),
+    args.vocab_size,
+    doc_cap=args.doc_cap,
+    max_chars=args.max_chars,
+    max_unique_chunks=args.max_unique_chunks or None,
+)
 t1 = time.time()
 train_time = t1 - t0
 print(f"Training time: {train_time:.2f}s")
@@ -0,0 +1,66 @@
+"""
+Test the validation of the batch inference jobs. Example run:
+
+python -m pytest tests/test_batch.py -v
+"""
+
+import json
+import pytest
+import tiktoken
+
+from nanochat.tokenizer import RustBPETokenizer, SPECIAL_TOKENS, SPLIT_PATTERN
+from nanochat.batch import BatchJob, render_prompt
+
+LIMITS = {"temperature": (0.0, 2.0), "top_k": (1, 200), "max_tokens": (1, 4096)}
+
+def byte_tokenizer():
+    """A tokenizer with no merges: one token per byte, plus the special tokens."""
+    special_tokens = {name: 256 + i for i, name in enumerate(SPECIAL_TOKENS)}
+    enc = tiktoken.Encoding(name="bytes", pat_str=SPLIT_PATTERN, mergeable_ranks={bytes([i]): i for i in range(256)}, special_tokens=special_tokens)
+    return RustBPETokenizer(enc, "<|bos|>")
+
+def make_job(tmp_path, records, **kwargs):
+    input_path = tmp_path / "input.jsonl"
+    input_path.write_text("".join(json.dumps(record) + "\n" for record in records))
+    return BatchJob(str(input_path), str(tmp_path / "output.jsonl"), byte_tokenizer(), sampling_limits=LIMITS, **kwargs)
+
+def test_valid_job(tmp_path):
+    records = [
+        {"messages": [{"role": "user", "content": "hi"}]},
+        {"messages": [{"role": "system", "content": "be brief"}, {"role": "user", "content": "hi"}], "temperature": 1.0},
+        {"messages": [{"role": "user", "content": "hi"}, {"role": "assistant", "content": "hello"}, {"role": "user", "content": "bye"}]},
+    ]
+    job = make_job(tmp_path, records)
+    assert job.num_total == 3 and len(job.batches) == 2
+
+@pytest.mark.parametrize("record, error", [
+    ({"messages": [{"role": "user", "content": "hi"}], "max_tokens": 10**9}, "max_tokens"),
+    ({"messages": [{"role": "user", "content": "hi"}], "temperature": -1}, "temperature"),
+    ({"messages": [{"role": "user", "content": "hi"}], "top_k": "50"}, "top_k"),
+    ({"messages": [{"role": "assistant", "content": "hi"}]}, "should be from user"),
+    ({"messages": [{"role": "user", "content": "hi"}, {"role": "system", "content": "no"}]}, "system"),
+    ({"messages": [{"role": "user", "content": "hi"}, {"role": "assistant", "content": "hello"}]}, "last message"),
+    ({"messages": [{"role": "user", "content": "x" * 5000}]}, "longer than"),
+    ({"prompt": "hi"}, "messages"),
+])
+def test_invalid_lines_are_rejected(tmp_path, record, error):
+    records = [{"messages": [{"role": "user", "content": "fine"}]}, record]
+    with pytest.raises(ValueError, match=error) as e:
+        make_job(tmp_path, records)
+    assert "line 2" in str(e.value)
+
+def test_invalid_json_is_rejected(tmp_path):
+    input_path = tmp_path / "input.jsonl"
+    input_path.write_text(json.dumps({"messages": [{"role": "user", "content": "fine"}]}) + "\n{\"messages\": [\n")
+    with pytest.raises(ValueError, match="line 2: invalid JSON"):
+        BatchJob(str(input_path), str(tmp_path / "output.jsonl"), byte_tokenizer(), sampling_limits=LIMITS)
+
+def test_invalid_request_sampling_is_rejected(tmp_path):
+    with pytest.raises(ValueError, match="max_tokens"):
+        make_job(tmp_path, [{"messages": [{"role": "user", "content": "hi"}]}], sampling={"max_tokens": 100000})
+
+def test_render_prompt_matches_completion_rendering():
+    tokenizer = byte_tokenizer()
+    messages = [{"role": "user", "content": "hi"}, {"role": "assistant", "content": "hello"}, {"role": "user", "content": "bye"}]
+    expected = tokenizer.render_for_completion({"messages": messages + [{"role": "assistant", "content": ""}]})
+    assert render_prompt(tokenizer, messages) == expected
@@ -0,0 +1,25 @@
+"""
+Test the checkpoint directory helpers. Example run:
+
+python -m pytest tests/test_checkpoint_manager.py -v
+"""
+
+import json
+import torch
+
+from nanochat import checkpoint_manager
+from nanochat.checkpoint_manager import export_fp32_weights, find_last_step, resolve_checkpoint
+
+def test_fp32_export_does_not_break_last_step(tmp_path, monkeypatch):
+    monkeypatch.setattr(checkpoint_manager, "get_base_dir", lambda: str(tmp_path))
+    checkpoint_dir = tmp_path / "base_checkpoints" / "d2"
+    checkpoint_dir.mkdir(parents=True)
+    for step in [5, 10]:
+        torch.save({"_orig_mod.w": torch.ones(2, dtype=torch.bfloat16)}, checkpoint_dir / f"model_{step:06d}.pt")
+        (checkpoint_dir / f"meta_{step:06d}.json").write_text(json.dumps({"step": step}))
+    weights_path, meta_data = export_fp32_weights("base", model_tag="d2")
+    assert meta_data["step"] == 10
+    assert torch.load(weights_path)["w"].dtype == torch.float32
+    # the export is not mistaken for a checkpoint
+    assert find_last_step(str(checkpoint_dir)) == 10
+    assert resolve_checkpoint(str(tmp_path / "base_checkpoints"), "d2") == (str(checkpoint_dir), 10)
@@ -0,0 +1,23 @@
+"""
+Test the core assignment of multi-process CPU serving. Example run:
+
+python -m pytest tests/test_cpu_serving.py -v
+"""
+
+import os
+from nanochat import cpu_serving
+from nanochat.cpu_serving import parse_cpulist, cpu_core_sets
+
+def test_parse_cpulist():
+    assert parse_cpulist("0-3,8-11\n") == [0, 1, 2, 3, 8, 9, 10, 11]
+    assert parse_cpulist("5") == [5]
+
+def test_core_sets_follow_numa_nodes(monkeypatch):
+    """Two nodes with interleaved core ids: each worker gets cores of a single node."""
+    monkeypatch.setattr(os, "sched_getaffinity", lambda pid: set(range(8)))
+    monkeypatch.setattr(cpu_serving, "numa_nodes", lambda: [[0, 2, 4, 6], [1, 3, 5, 7]])
+    assert cpu_core_sets(2) == [[0, 2, 4, 6], [1, 3, 5, 7]]
+    assert cpu_core_sets(4) == [[0, 2], [4, 6], [1, 3], [5, 7]]
+    monkeypatch.setattr(cpu_serving, "numa_nodes", lambda: None)
+    sets = cpu_core_sets(3)
+    assert sets == [[0, 1], [2, 3], [4, 5]]
@@ -0,0 +1,71 @@
+"""
+Test the token packing of the data loaders. Example run:
+
+python -m pytest tests/test_dataloader.py -v
+"""
+
+import numpy as np
+
+from nanochat.dataloader import TokenBuffer, ScratchBuffers
+
+def test_token_buffer_wraps_and_grows():
+    rng = np.random.default_rng(0)
+    buffer = TokenBuffer(capacity=7) # tiny, so that it wraps around and grows a lot
+    expected = []
+    for _ in range(1000):
+        if rng.random() < 0.5:
+            tokens = rng.integers(0, 65536, size=rng.integers(0, 20)).astype(np.uint16)
+            buffer.append(tokens)
+            expected.extend(tokens.tolist())
+        elif len(buffer) > 0:
+            n = int(rng.integers(0, len(buffer) + 1))
+            out = np.empty(n, dtype=np.int64)
+            buffer.take(n, out=out)
+            assert out.tolist() == expected[:n]
+            expected = expected[n:]
+        assert len(buffer) == len(expected)
+
+def test_scratch_buffers_are_reused():
+    B, T = 2, 3
+    scratch = ScratchBuffers(B, T, "cpu", num_buffers=2)
+    first = scratch.next()
+    first.numpy()[:] = np.arange(B * T + 1)
+    inputs, targets = scratch.to_device(first)
+    assert inputs.tolist() == [[0, 1, 2], [3, 4, 5]] and targets.tolist() == [[1, 2, 3], [4, 5, 6]]
+    scratch.next()
+    assert scratch.next() is first # round robin, no new allocation
+    first.zero_()
+    assert inputs.tolist() == [[0, 1, 2], [3, 4, 5]] # the batch handed out does not change
+
+class CharTokenizer:
+    """One token per byte, enough to test the packing and the resume of the tokenizing loader."""
+    def get_bos_token_id(self):
+        return 256
+    def encode_batch_to_array(self, texts, prepend=None, num_threads=1):
+        from nanochat.tokenizer import pack_token_lists
+        return pack_token_lists([list(text.encode("utf-8")) for text in texts], 257, prepend)
+
+def test_tokenizing_loader_exact_resume(tmp_path, monkeypatch):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    from nanochat import dataloader, dataset
+    rng = np.random.default_rng(0)
+    paths = []
+    for i in range(3): # the last file is the val split
+        texts = ["x" * int(rng.integers(1, 40)) + str(k) for k in range(int(rng.integers(5, 30)))]
+        paths.append(str(tmp_path / f"shard_{i:05d}.parquet"))
+        pq.write_table(pa.table({"text": texts}), paths[-1], row_group_size=7)
+    monkeypatch.setattr(dataset, "DATA_DIR", str(tmp_path))
+    monkeypatch.setattr(dataloader, "get_tokenizer", CharTokenizer)
+    B, T = 2, 16
+    loader = dataloader.tokenizing_distributed_data_loader_with_state(B, T, "train", tokenizer_batch_size=3, device="cpu")
+    batches = [next(loader) for _ in range(60)] # a few epochs
+    assert batches[0][2] == {"epoch": 0, "doc_index": 0, "token_idx": 0}
+    assert batches[-1][2]["epoch"] > 0
+    # resuming from the state of any batch, even in the middle of a document, yields the same batches
+    for k in [1, 5, 17, 42]:
+        resumed = dataloader.tokenizing_distributed_data_loader_with_state(B, T, "train", tokenizer_batch_size=3, device="cpu", resume_state_dict=batches[k][2])
+        for inputs, targets, state in batches[k:k + 10]:
+            resumed_inputs, resumed_targets, resumed_state = next(resumed)
+            assert resumed_inputs.tolist() == inputs.tolist() and resumed_targets.tolist() == targets.tolist()
+            assert resumed_state == state
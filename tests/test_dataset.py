@@ -0,0 +1,65 @@
+"""
+Test the manifest of the parquet files. Example run:
+
+python -m pytest tests/test_dataset.py -v
+"""
+
+import os
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from nanochat.dataset import MANIFEST_FILE, ParquetShards, load_manifest, record_manifest_tokens
+
+def write_parquet(path, num_docs, row_group_size, doc_len=10):
+    pq.write_table(pa.table({"text": ["x" * doc_len] * num_docs}), str(path), row_group_size=row_group_size)
+
+def test_manifest_is_built_once_and_updated(tmp_path):
+    write_parquet(tmp_path / "shard_00000.parquet", 25, 10)
+    write_parquet(tmp_path / "shard_00001.parquet", 5, 10)
+    shards = load_manifest(str(tmp_path))
+    assert os.path.exists(tmp_path / MANIFEST_FILE)
+    assert shards["shard_00000.parquet"]["row_group_docs"] == [10, 10, 5]
+    assert shards["shard_00000.parquet"]["num_docs"] == 25 and shards["shard_00000.parquet"]["num_tokens"] is None
+    # a new file is added to the manifest, the token counts recorded are kept
+    record_manifest_tokens({"shard_00000.parquet": 1234}, str(tmp_path))
+    write_parquet(tmp_path / "shard_00002.parquet", 3, 10)
+    shards = load_manifest(str(tmp_path))
+    assert list(shards) == ["shard_00000.parquet", "shard_00001.parquet", "shard_00002.parquet"]
+    assert shards["shard_00000.parquet"]["num_tokens"] == 1234
+
+def test_locate_documents(tmp_path):
+    write_parquet(tmp_path / "shard_00000.parquet", 25, 10)
+    write_parquet(tmp_path / "shard_00001.parquet", 12, 4)
+    write_parquet(tmp_path / "shard_00002.parquet", 3, 10) # val
+    train = ParquetShards("train", str(tmp_path))
+    assert train.num_docs == 37 and len(train.row_groups) == 6
+    assert train.locate(0) == (0, 0, 0)
+    assert train.locate(24) == (0, 2, 4)
+    assert train.locate(25) == (1, 0, 0)
+    assert train.locate(34) == (1, 2, 1)
+    for doc_index in range(train.num_docs):
+        assert train.doc_index(*train.locate(doc_index)) == doc_index
+    assert ParquetShards("val", str(tmp_path)).num_docs == 3
+
+def test_assign_balances_ranks(tmp_path):
+    # one file of small row groups, one of big ones: striding would give rank 0 all the big ones
+    write_parquet(tmp_path / "shard_00000.parquet", 8, 1, doc_len=10)
+    write_parquet(tmp_path / "shard_00001.parquet", 8, 2, doc_len=100)
+    write_parquet(tmp_path / "shard_00002.parquet", 1, 1) # val
+    train = ParquetShards("train", str(tmp_path))
+    weights = dict(zip(train.row_groups, train.weights))
+    assigned = [train.assign(rank, 3) for rank in range(3)]
+    assert sorted(sum(assigned, [])) == train.row_groups # every row group goes to exactly one rank
+    loads = [sum(weights[row_group] for row_group in rank_groups) for rank_groups in assigned]
+    assert max(loads) - min(loads) <= max(train.weights)
+    assert all(rank_groups == sorted(rank_groups) for rank_groups in assigned) # each rank reads in order
+
+def test_assign_ignores_token_counts(tmp_path):
+    # tok_data may record the token counts in the middle of a run, the ranks must keep their row groups
+    write_parquet(tmp_path / "shard_00000.parquet", 8, 1, doc_len=10)
+    write_parquet(tmp_path / "shard_00001.parquet", 8, 2, doc_len=100)
+    write_parquet(tmp_path / "shard_00002.parquet", 1, 1) # val
+    before = [ParquetShards("train", str(tmp_path)).assign(rank, 2) for rank in range(2)]
+    record_manifest_tokens({"shard_00000.parquet": 10**6, "shard_00001.parquet": 1, "shard_00002.parquet": 1}, str(tmp_path))
+    after = [ParquetShards("train", str(tmp_path)).assign(rank, 2) for rank in range(2)]
+    assert after == before
@@ -4,8 +4,42 @@ Test Engine class. Example run:
 python -m pytest tests/test_engine.py -v
 """
 
+import pytest
 import torch
-from nanochat.engine import KVCache
+from nanochat.engine import KVCache, Engine
+from nanochat.gpt import GPT, GPTConfig
+
+class MockTokenizer:
+    """Minimal tokenizer for Engine: the special tokens live at the top of the vocab."""
+    SPECIALS = ["<|bos|>", "<|user_start|>", "<|user_end|>", "<|assistant_start|>", "<|assistant_end|>",
+                "<|python_start|>", "<|python_end|>", "<|output_start|>", "<|output_end|>"]
+
+    def __init__(self, vocab_size):
+        self.vocab_size = vocab_size
+
+    def encode_special(self, s):
+        return self.vocab_size - len(self.SPECIALS) + self.SPECIALS.index(s)
+
+    def get_bos_token_id(self):
+        return self.encode_special("<|bos|>")
+
+    def encode(self, s):
+        return [ord(c) % 64 for c in s]
+
+    def decode(self, ids):
+        return "".join(chr(48 + i % 64) for i in ids)
+
+def build_tiny_model(n_layer=4, vocab_size=128, seed=0, **config_kwargs):
+    """A small randomly initialized GPT on CPU (init_weights zeros the projections, so re-randomize them)."""
+    torch.manual_seed(seed)
+    config = GPTConfig(sequence_len=128, vocab_size=vocab_size, n_layer=n_layer, n_head=2, n_kv_head=2, n_embd=32, **config_kwargs)
+    model = GPT(config)
+    model.init_weights()
+    for name, p in model.named_parameters():
+        if "c_proj" in name or "lm_head" in name:
+            torch.nn.init.normal_(p, std=0.2)
+    model.eval()
+    return model
 
 def test_kv_cache_resize():
     """
@@ -64,3 +98,84 @@ def test_kv_cache_resize():
             original_v = original_cache[layer_idx, 1, :, :, token_idx, :]
             assert (actual_k == original_k).all(), f"Layer {layer_idx}, token {token_idx}: key doesn't match original"
             assert (actual_v == original_v).all(), f"Layer {layer_idx}, token {token_idx}: value doesn't match original"
+
+
+def test_draft_verify_matches_forward():
+    """Early-exit draft followed by verification from the cached hidden states reproduces the full forward."""
+    model = build_tiny_model()
+    m = model.config
+    tokens = torch.randint(0, 100, (1, 10))
+    kv_kwargs = dict(batch_size=1, num_heads=m.n_kv_head, seq_len=16, head_dim=m.n_embd // m.n_head, num_layers=m.n_layer)
+    with torch.inference_mode():
+        expected = model(tokens)
+        kv_cache = KVCache(**kv_kwargs)
+        model(tokens[:, :4], kv_cache=kv_cache) # full prefill of a prefix
+        _, hidden = model.forward_draft(tokens[:, 4:], kv_cache, exit_layer=2)
+        assert kv_cache.get_pos() == 10
+        kv_cache.set_pos(4)
+        logits = model.forward_verify(hidden, kv_cache, exit_layer=2)
+    assert kv_cache.get_pos() == 10
+    torch.testing.assert_close(logits, expected[:, 4:], rtol=1e-4, atol=1e-4)
+
+
+def test_speculative_greedy_matches_generate():
+    """At temperature=0 self-speculative decoding must produce exactly the tokens of regular decoding."""
+    model = build_tiny_model()
+    engine = Engine(model, MockTokenizer(model.config.vocab_size))
+    prompt = [1, 5, 9, 23, 42]
+    kwargs = dict(num_samples=1, max_tokens=40, temperature=0.0)
+    reference = [column[0] for column, _ in engine.generate(prompt, **kwargs)]
+    for draft_layers in [1, 3]:
+        for num_draft in [1, 3, 5]:
+            speculative = [column[0] for column, _ in engine.generate(prompt, draft_layers=draft_layers, num_draft=num_draft, **kwargs)]
+            assert speculative == reference, f"draft_layers={draft_layers}, num_draft={num_draft}"
+
+
+def test_sliding_window_kv_cache():
+    """Decoding with a KV cache that keeps only the window matches the banded-mask forward over the whole sequence."""
+    model = build_tiny_model(sliding_window=8, window_pattern="LG")
+    m = model.config
+    assert m.get_window_sizes() == [8, 0, 8, 0]
+    tokens = torch.randint(0, 100, (2, 100))
+    kv_cache = KVCache(batch_size=2, num_heads=m.n_kv_head, seq_len=16, head_dim=m.n_embd // m.n_head, num_layers=m.n_layer, window_sizes=m.get_window_sizes())
+    with torch.inference_mode():
+        expected = model(tokens)
+        # prefill a chunk longer than the window, then a second chunk, then decode one token at a time
+        logits = [model(tokens[:, :20], kv_cache=kv_cache), model(tokens[:, 20:30], kv_cache=kv_cache)]
+        for t in range(30, tokens.size(1)):
+            logits.append(model(tokens[:, t:t+1], kv_cache=kv_cache))
+    logits = torch.cat(logits, dim=1)
+    torch.testing.assert_close(logits, expected, rtol=1e-4, atol=1e-4)
+    # the sliding window layers dropped most of the sequence, the full attention layers kept all of it
+    assert all(cache.size(3) < tokens.size(1) for cache in kv_cache.local_cache.values())
+    assert kv_cache.kv_cache.size(0) == 2 and kv_cache.kv_cache.size(4) >= tokens.size(1)
+
+
+def test_sliding_window_speculative():
+    """Self-speculative decoding rewinds the KV cache, which must keep working with sliding window layers."""
+    model = build_tiny_model(sliding_window=6, window_pattern="LLG")
+    engine = Engine(model, MockTokenizer(model.config.vocab_size))
+    prompt = list(range(1, 30))
+    kwargs = dict(num_samples=1, max_tokens=40, temperature=0.0)
+    reference = [column[0] for column, _ in engine.generate(prompt, **kwargs)]
+    speculative = [column[0] for column, _ in engine.generate(prompt, draft_layers=2, num_draft=4, **kwargs)]
+    assert speculative == reference
+    # more drafts than the sliding window layers keep beyond their window is refused up front
+    with pytest.raises(AssertionError, match="num_draft"):
+        next(engine.generate(prompt, draft_layers=2, num_draft=KVCache.WINDOW_SLACK + 1, **kwargs))
+
+
+def test_generate_multi_matches_generate():
+    """Left padded multi-prompt generation produces, row by row, the tokens of generating each prompt on its own."""
+    prompts = [[1, 5, 9, 23, 42], list(range(3, 20)), [7], list(range(30, 40))]
+    kwargs = dict(max_tokens=20, temperature=0.0)
+    for config_kwargs in [{}, dict(sliding_window=6, window_pattern="LG")]:
+        model = build_tiny_model(**config_kwargs)
+        engine = Engine(model, MockTokenizer(model.config.vocab_size))
+        reference = [[column[0] for column, _ in engine.generate(prompt, num_samples=1, **kwargs)] for prompt in prompts]
+        rows = [[] for _ in prompts]
+        for column, _ in engine.generate_multi(prompts, **kwargs):
+            for row, token in zip(rows, column):
+                row.append(token)
+        for row, ref in zip(rows, reference):
+            assert row[:len(ref)] == ref, f"config={config_kwargs}"
@@ -0,0 +1,20 @@
+"""
+Test the request journal of the web server. Example run:
+
+python -m pytest tests/test_journal.py -v
+"""
+
+from nanochat.journal import RequestJournal, read_journal
+
+def test_journal_roundtrip(tmp_path):
+    """Records are written in batches in the background, everything buffered is written on close."""
+    path = str(tmp_path / "journal.jsonl")
+    journal = RequestJournal(path, flush_interval=60.0, max_batch=4)
+    for i in range(10):
+        journal.record({"arrival": 100.0 - i, "status": "ok", "prompt_tokens": i})
+    journal.close()
+    assert journal.num_written == 10
+    with open(path, "a", encoding="utf-8") as f:
+        f.write('{"arrival": 0.0, "sta') # a partially written last line is skipped
+    records = read_journal(path)
+    assert [r["prompt_tokens"] for r in records] == list(reversed(range(10))) # in arrival order
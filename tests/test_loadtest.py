@@ -0,0 +1,29 @@
+"""
+Test the client-side latency statistics of the load tools. Example run:
+
+python -m pytest tests/test_loadtest.py -v
+"""
+
+from nanochat.loadtest import RequestResult, percentiles, summarize, format_markdown
+
+def test_percentiles():
+    values = [float(v) for v in range(1, 101)]
+    summary = percentiles(values, ps=(50, 99))
+    assert summary == {"p50": 50.0, "p99": 99.0, "mean": 50.5}
+    assert percentiles([1.0, 2.0, 3.0], ps=(50, 100)) == {"p50": 2.0, "p100": 3.0, "mean": 2.0}
+    assert percentiles([7.0], ps=(1,))["p1"] == 7.0
+    assert percentiles([])["p50"] is None
+
+def test_summarize():
+    results = [
+        RequestResult(ok=True, ttft=0.1, itls=[0.01, 0.03], duration=0.2, num_tokens=3),
+        RequestResult(ok=True, ttft=0.3, itls=[0.02], duration=0.4, num_tokens=2),
+        RequestResult(ok=False, status=429, error="queue full"),
+    ]
+    summary = summarize(results, wall_time=2.0)
+    assert summary["num_ok"] == 2 and summary["errors"] == {"429": 1}
+    assert summary["tokens_per_second"] == 2.5
+    assert summary["itl"]["p50"] == 0.02
+    report = format_markdown(summary)
+    assert "| ttft | 100.0 | 300.0 |" in report
+    assert "429: 1" in report
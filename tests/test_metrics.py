@@ -0,0 +1,64 @@
+"""
+Test the Prometheus metrics of the web server. Example run:
+
+python -m pytest tests/test_metrics.py -v
+"""
+
+import asyncio
+import time
+from types import SimpleNamespace
+from nanochat.metrics import Registry, ServingMetrics
+from nanochat.model_registry import ModelRegistry, ModelSpec
+
+def test_render_prometheus_text():
+    registry = Registry()
+    requests = registry.counter("requests_total", "Requests.", labelnames=("status",))
+    latency = registry.histogram("latency_seconds", "Latency.", buckets=(0.1, 1.0))
+    requests.labels("ok").inc()
+    requests.labels("ok").inc(2)
+    for value in [0.05, 0.5, 0.5, 3.0]:
+        latency.observe(value)
+    lines = registry.render().splitlines()
+    assert "# TYPE requests_total counter" in lines
+    assert 'requests_total{status="ok"} 3' in lines
+    assert "# TYPE latency_seconds histogram" in lines
+    assert 'latency_seconds_bucket{le="0.1"} 1' in lines
+    assert 'latency_seconds_bucket{le="1"} 3' in lines
+    assert 'latency_seconds_bucket{le="+Inf"} 4' in lines
+    assert "latency_seconds_sum 4.05" in lines
+    assert "latency_seconds_count 4" in lines
+
+def test_serving_metrics_worker_gauges():
+    metrics = ServingMetrics(num_workers=2)
+    metrics.request_started(1, queue_wait=0.01, prompt_tokens=12)
+    for _ in range(5):
+        metrics.token(1)
+    metrics.request_finished(1, arrived=time.monotonic() - 0.2)
+    text = metrics.render()
+    assert "nanochat_prompt_tokens_total 12" in text
+    assert "nanochat_generation_tokens_total 5" in text
+    assert 'nanochat_worker_generation_tokens_total{worker="1"} 5' in text
+    assert 'nanochat_worker_utilization{worker="0"} 0' in text
+    assert 'nanochat_requests_total{status="ok"} 1' in text
+
+def test_ttft_within_request_duration_with_on_demand_load():
+    """Both latencies count from the request arrival, so a model loaded on demand shows up in both."""
+    load_delay = 0.05
+    async def load(spec):
+        await asyncio.sleep(load_delay)
+        return SimpleNamespace(name=spec.name, memory_bytes=1)
+    registry = ModelRegistry([ModelSpec("a", "sft"), ModelSpec("b", "sft")], load, lambda spec: 1, memory_budget=10)
+    metrics = ServingMetrics(num_workers=1)
+    async def main():
+        arrived = time.monotonic()
+        model = await registry.acquire("b") # not loaded yet
+        metrics.request_started(0, queue_wait=0.0, prompt_tokens=3)
+        ttft = metrics.first_token(arrived)
+        await asyncio.sleep(0.01) # the rest of the response
+        metrics.request_finished(0, arrived)
+        registry.release(model)
+        return ttft
+    ttft = asyncio.run(main())
+    assert ttft >= load_delay
+    assert metrics.ttft.default.sum == ttft
+    assert ttft <= metrics.e2e.default.sum
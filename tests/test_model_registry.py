@@ -0,0 +1,72 @@
+"""
+Test the model registry of the web server. Example run:
+
+python -m pytest tests/test_model_registry.py -v
+"""
+
+import asyncio
+import pytest
+from nanochat.model_registry import ModelRegistry, ModelSpec, ModelBudgetError, UnknownModelError, parse_model_spec
+
+class FakeModel:
+    def __init__(self, name, memory_bytes):
+        self.name = name
+        self.memory_bytes = memory_bytes
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+def make_registry(sizes, memory_budget, load_delay=0.0, loads=None):
+    async def load(spec):
+        if loads is not None:
+            loads.append(spec.name)
+        await asyncio.sleep(load_delay)
+        return FakeModel(spec.name, sizes[spec.name])
+    specs = [ModelSpec(name, "sft") for name in sizes]
+    return ModelRegistry(specs, load, lambda spec: sizes[spec.name], memory_budget=memory_budget)
+
+def test_parse_model_spec():
+    assert parse_model_spec("rl") == ModelSpec("rl", "rl")
+    assert parse_model_spec("big=sft:d32:800") == ModelSpec("big", "sft", "d32", 800)
+    assert parse_model_spec("sft::650") == ModelSpec("sft", "sft", None, 650)
+
+def test_lru_eviction_under_budget():
+    """Loading a model evicts the least recently used idle models until it fits, never one in use."""
+    async def main():
+        registry = make_registry({"a": 40, "b": 40, "c": 40}, memory_budget=100)
+        a = await registry.acquire() # the default model
+        assert a.name == "a"
+        registry.release(a)
+        b = await registry.acquire("b")
+        registry.release(b)
+        a = await registry.acquire("a") # a is now the most recently used
+        registry.release(a)
+        c = await registry.acquire("c")
+        assert list(registry.loaded) == ["a", "c"] and b.closed and not a.closed
+        # with c in use and a evicted to make room for b, nothing else can be evicted
+        await registry.acquire("b")
+        assert a.closed and list(registry.loaded) == ["c", "b"]
+        with pytest.raises(ModelBudgetError):
+            await registry.acquire("a")
+        with pytest.raises(UnknownModelError):
+            await registry.acquire("nope")
+        assert registry.num_evictions == 2
+    asyncio.run(main())
+
+def test_background_loading():
+    """Concurrent requests for a model share one load, and a loaded model is served while another one loads."""
+    async def main():
+        loads = []
+        registry = make_registry({"a": 1, "b": 1}, memory_budget=0, load_delay=0.05, loads=loads)
+        a = await registry.acquire("a")
+        registry.release(a)
+        waiters = [asyncio.ensure_future(registry.acquire("b")) for _ in range(3)]
+        await asyncio.sleep(0)
+        assert registry.state()["models"][1]["status"] == "loading"
+        assert await asyncio.wait_for(registry.acquire("a"), timeout=0.01) is a # not blocked by the load of b
+        models = await asyncio.gather(*waiters)
+        assert all(model is models[0] for model in models)
+        assert loads == ["a", "b"]
+        assert registry.loaded["b"].refs == 3
+    asyncio.run(main())
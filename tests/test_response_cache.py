@@ -0,0 +1,37 @@
+"""
+Test the response cache of the web server. Example run:
+
+python -m pytest tests/test_response_cache.py -v
+"""
+
+from nanochat.response_cache import ResponseCache, ENTRY_OVERHEAD
+
+def test_lru_memory_budget():
+    """Beyond the byte budget the least recently used responses are evicted."""
+    entry_bytes = 10 * 4 + ENTRY_OVERHEAD
+    cache = ResponseCache(max_bytes=2 * entry_bytes)
+    keys = [cache.key([1, 2, i], 0.0, 50, 64) for i in range(3)]
+    assert len(set(keys)) == 3
+    assert cache.key([1, 2, 0], 0.0, 10, 64) == keys[0], "top_k does not matter at temperature=0"
+    cache.put(keys[0], list(range(10)))
+    cache.put(keys[1], list(range(10, 20)))
+    assert cache.get(keys[0]) == list(range(10)) # keys[0] is now the most recently used
+    cache.put(keys[2], list(range(20, 30)))
+    assert cache.get(keys[1]) is None
+    assert cache.get(keys[0]) == list(range(10))
+    assert cache.get(keys[2]) == list(range(20, 30))
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["evictions"], stats["entries"]) == (3, 1, 1, 2)
+
+def test_disk_tier(tmp_path):
+    """The disk tier survives a restart, but only serves the model it was written by."""
+    cache = ResponseCache(max_bytes=1 << 20, namespace="model-a", disk_dir=str(tmp_path), max_disk_bytes=1 << 20)
+    key = cache.key([5, 6, 7], 0.0, 50, 64)
+    cache.put(key, [100, 200, 300])
+    restarted = ResponseCache(max_bytes=1 << 20, namespace="model-a", disk_dir=str(tmp_path), max_disk_bytes=1 << 20)
+    assert restarted.disk_bytes == 12
+    assert restarted.get(key) == [100, 200, 300]
+    assert restarted.get(key) == [100, 200, 300]
+    assert (restarted.stats()["disk_hits"], restarted.stats()["hits"]) == (1, 1)
+    other_model = ResponseCache(max_bytes=1 << 20, namespace="model-b", disk_dir=str(tmp_path), max_disk_bytes=1 << 20)
+    assert other_model.get(other_model.key([5, 6, 7], 0.0, 50, 64)) is None
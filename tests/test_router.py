@@ -0,0 +1,69 @@
+"""
+Test the routing logic of the chat router. Example run:
+
+python -m pytest tests/test_router.py -v
+"""
+
+from nanochat.router import Router
+
+def stats(outstanding_tokens, free_slots=1, queue_depth=0, max_queue_depth=64):
+    return {"scheduler": {
+        "outstanding_tokens": outstanding_tokens,
+        "free_slots": free_slots,
+        "queue_depth": queue_depth,
+        "max_queue_depth": max_queue_depth,
+    }}
+
+def conversation(num_turns):
+    messages = []
+    for i in range(num_turns):
+        messages.append({"role": "user", "content": f"question {i}"})
+        messages.append({"role": "assistant", "content": f"answer {i}"})
+    return messages[:-1]
+
+def test_least_outstanding_tokens():
+    """A request goes to the healthy backend with the least outstanding tokens, counting what was sent since the last poll."""
+    router = Router(["http://a", "http://b", "http://c"])
+    a, b, c = router.backends
+    a.update(stats(100))
+    b.update(stats(50))
+    assert router.choose(conversation(1)) is b # c never answered a poll
+    router.dispatched(b, conversation(1), 80)
+    assert router.choose(conversation(1)) is a
+    b.update(stats(60)) # the poll replaces the estimate
+    assert router.choose(conversation(1)) is b
+    # a backend without capacity only gets requests when all of them are full
+    b.update(stats(0, free_slots=0, queue_depth=32))
+    assert router.choose(conversation(1)) is a
+    a.mark_failed()
+    assert router.choose(conversation(1)) is b
+    assert router.choose(conversation(1), exclude=[b]) is None
+
+def test_conversation_affinity():
+    """The next turn of a conversation goes to the backend of the previous turn, while it has capacity."""
+    router = Router(["http://a", "http://b"])
+    a, b = router.backends
+    a.update(stats(0))
+    b.update(stats(10))
+    first_turn = conversation(1)
+    assert router.choose(first_turn) is a
+    router.dispatched(a, first_turn, 500) # a now looks busier than b
+    second_turn = conversation(2)
+    assert second_turn[:1] == first_turn
+    assert router.choose(second_turn) is a
+    assert router.num_affinity_hits == 1
+    # another conversation is balanced as usual
+    other = [{"role": "user", "content": "hi"}, {"role": "assistant", "content": "hello"}, {"role": "user", "content": "bye"}]
+    assert router.choose(other) is b
+    # a full backend gives up its conversations
+    a.update(stats(1000, free_slots=0, queue_depth=40))
+    assert router.choose(second_turn) is b
+
+def test_affinity_is_bounded():
+    router = Router(["http://a"], max_affinity_entries=2)
+    a = router.backends[0]
+    for i in range(3):
+        router.dispatched(a, [{"role": "user", "content": str(i)}], 10)
+    assert len(router.affinity) == 2
+    router.finished(a)
+    assert a.in_flight == 2
@@ -540,6 +540,9 @@ def test_correctness(enwik8_small):
     print(rustbpe_ids[:20])
 
     assert rustbpe_ids == fast_reference_ids, "RustBPE should match fast reference"
+    assert rustbpe_tokenizer.encode(encode_text) == rustbpe_ids, "RustBPE should match itself with a warm chunk cache"
+    lines = encode_text.splitlines(keepends=True)
+    assert sum(rustbpe_tokenizer.batch_encode(lines), []) == [i for line in lines for i in rustbpe_tokenizer.encode(line)], "Batch encode should match encode"
     print("✅ RustBPE == Fast")
 
     # Now export rustbpe to tiktoken for more efficient inference
@@ -594,6 +597,76 @@ def test_training_performance(enwik8_large):
     print(f"   HuggingFace: {hf_train_time:.4f}s")
     print(f"   Speedup: {hf_train_time/rustbpe_train_time:.2f}x")
 
+@pytest.mark.slow
+def test_encode_performance(enwik8_large):
+    """Compare the encoding speed of rustbpe (single string and parallel batch) against tiktoken."""
+    text = enwik8_large
+    vocab_size = 2048
+    rustbpe_tokenizer = rustbpe.Tokenizer()
+    rustbpe_tokenizer.train_from_iterator([text[:10**6]], vocab_size)
+    enc = tiktoken.Encoding(
+        name="rustbpe",
+        pat_str=rustbpe_tokenizer.get_pattern(),
+        mergeable_ranks={bytes(k): v for k, v in rustbpe_tokenizer.get_mergeable_ranks()},
+        special_tokens={},
+    )
+    docs = text.splitlines(keepends=True)
+    print(f"\nText length: {len(text)}, {len(docs)} documents")
+
+    tiktoken_ids, tiktoken_time = time_function(enc.encode_ordinary, text)
+    rustbpe_ids, rustbpe_time = time_function(rustbpe_tokenizer.encode, text)
+    assert rustbpe_ids == tiktoken_ids, "RustBPE should match tiktoken"
+    tiktoken_batch, tiktoken_batch_time = time_function(enc.encode_ordinary_batch, docs)
+    rustbpe_batch, rustbpe_batch_time = time_function(rustbpe_tokenizer.batch_encode, docs)
+    assert rustbpe_batch == tiktoken_batch, "RustBPE batch encode should match tiktoken"
+
+    print(f"\n📊 Encode performance ({len(text) / 1e6:.1f}M chars):")
+    print(f"   tiktoken encode:        {tiktoken_time:.4f}s")
+    print(f"   RustBPE encode:         {rustbpe_time:.4f}s")
+    print(f"   tiktoken encode batch:  {tiktoken_batch_time:.4f}s")
+    print(f"   RustBPE batch_encode:   {rustbpe_batch_time:.4f}s")
+
+def test_fast_split_matches_regex(enwik8_small):
+    """The hand-written pretokenizer should split exactly like the regex, on real and random text."""
+    import random
+    from nanochat.tokenizer import SPLIT_PATTERN
+    GPT4_SPLIT_PATTERN = SPLIT_PATTERN.replace(r"\p{N}{1,2}", r"\p{N}{1,3}")
+    alphabet = list("aZé 'sStTdDmMlLvVeErR\n\r\t!?.,;:-_0123456789٣²ſ\u00a0\u3000漢字😀\x0b\x0c\u0085") + ["  ", "\r\n", "'ll", "'VE"]
+    rng = random.Random(0)
+    texts = [enwik8_small[:20_000]] + ["".join(rng.choice(alphabet) for _ in range(rng.randint(0, 40))) for _ in range(5000)]
+    for pattern in [SPLIT_PATTERN, GPT4_SPLIT_PATTERN]:
+        fast, slow = rustbpe.Tokenizer(), rustbpe.Tokenizer()
+        fast.train_from_iterator([], 256, pattern=pattern)
+        slow.train_from_iterator([], 256, pattern=f"(?:{pattern})") # same pattern, not recognized: uses the regex
+        assert fast.uses_fast_split() and not slow.uses_fast_split()
+        for text in texts:
+            assert fast.split(text) == slow.split(text), f"Split mismatch on {text!r}"
+    print("✅ Fast split == regex split")
+
+def test_streaming_ingestion(enwik8_small):
+    """Batches of texts, doc_cap and max_chars in rustbpe train like the same cropping done in Python."""
+    docs = enwik8_small.splitlines(keepends=True)
+    doc_cap, max_chars, vocab_size = 50, 60_000, 300
+    cropped, nchars = [], 0
+    for doc in docs:
+        cropped.append(doc[:doc_cap])
+        nchars += len(cropped[-1])
+        if nchars > max_chars:
+            break
+    reference = rustbpe.Tokenizer()
+    reference.train_from_iterator(cropped, vocab_size, buffer_size=100)
+    batches = [docs[i:i + 37] for i in range(0, len(docs), 37)] # e.g. parquet row groups
+    streamed = rustbpe.Tokenizer()
+    streamed.train_from_iterator(iter(batches), vocab_size, buffer_size=100, doc_cap=doc_cap, max_chars=max_chars)
+    assert streamed.get_mergeable_ranks() == reference.get_mergeable_ranks()
+
+    # With a bound on the unique chunks, the rare chunks are dropped but the frequent merges remain
+    bounded = rustbpe.Tokenizer()
+    bounded.train_from_iterator(iter(batches), vocab_size, buffer_size=100, max_unique_chunks=500)
+    assert len(bounded.get_mergeable_ranks()) == vocab_size
+    assert bounded.get_mergeable_ranks()[256] == reference.get_mergeable_ranks()[256]
+    print("✅ Streaming ingestion OK")
+
 def test_interface(enwik8_small):
     """Test the RustBPETokenizer interface for training, encoding, decoding, and serialization."""
     import tempfile
@@ -615,6 +688,14 @@ def test_interface(enwik8_small):
     assert decoded == encode_text, f"Decoded text doesn't match: {decoded} != {encode_text}"
     print("✅ Encode/decode test passed")
 
+    # Streaming decode: the emoji is split over several byte tokens and is only emitted once complete
+    decoder = tok.decode_stream()
+    pieces = [decoder.step(id) for id in ids]
+    assert "".join(pieces) + decoder.flush() == encode_text
+    assert all("�" not in piece for piece in pieces), "Streaming decode emitted a partial character"
+    assert pieces[-1].endswith("🙃")
+    print("✅ Streaming decode OK")
+
     # Encode batch test
     ids_new = tok.encode([encode_text, encode_text])
     assert all(x == ids for x in ids_new), "Batch encoding should produce identical results"
@@ -626,6 +707,60 @@ def test_interface(enwik8_small):
     assert ids_special == [bos_token_id] + ids + [bos_token_id], "Special tokens not correctly added"
     print("✅ append/prepend OK")
 
+    # Batch encode into a flat array with offsets
+    texts = [encode_text, "", "Hello"]
+    tokens, offsets = tok.encode_batch_to_array(texts, prepend="<|bos|>")
+    assert tokens.dtype.name == "uint16" and offsets.tolist()[0] == 0 and len(offsets) == len(texts) + 1
+    rows = [tokens[offsets[i]:offsets[i + 1]].tolist() for i in range(len(texts))]
+    assert rows == tok.encode(texts, prepend="<|bos|>"), "Array batch encoding should match encode"
+    print("✅ Encode batch to array OK")
+
+    # Batched conversation rendering matches the per-message rendering, built here token by token
+    def render_reference(conversation, max_tokens):
+        messages = conversation["messages"]
+        if messages[0]["role"] == "system":
+            messages = [{"role": "user", "content": messages[0]["content"] + "\n\n" + messages[1]["content"]}] + messages[2:]
+        ids, mask = [tok.get_bos_token_id()], [0]
+        def add(tokens, mask_val):
+            tokens = [tokens] if isinstance(tokens, int) else tokens
+            ids.extend(tokens)
+            mask.extend([mask_val] * len(tokens))
+        for message in messages:
+            content = message["content"]
+            if message["role"] == "user":
+                add(tok.encode_special("<|user_start|>"), 0)
+                add(tok.encode(content), 0)
+                add(tok.encode_special("<|user_end|>"), 0)
+                continue
+            add(tok.encode_special("<|assistant_start|>"), 0)
+            for part in ([{"type": "text", "text": content}] if isinstance(content, str) else content):
+                if part["type"] == "text":
+                    add(tok.encode(part["text"]), 1)
+                elif part["type"] == "python":
+                    add(tok.encode_special("<|python_start|>"), 1)
+                    add(tok.encode(part["text"]), 1)
+                    add(tok.encode_special("<|python_end|>"), 1)
+                elif part["type"] == "python_output":
+                    add(tok.encode_special("<|output_start|>"), 0)
+                    add(tok.encode(part["text"]), 0)
+                    add(tok.encode_special("<|output_end|>"), 0)
+            add(tok.encode_special("<|assistant_end|>"), 1)
+        return ids[:max_tokens], mask[:max_tokens]
+    conversations = [
+        {"messages": [{"role": "system", "content": "Be brief."}, {"role": "user", "content": encode_text}, {"role": "assistant", "content": "Fine!"}]},
+        {"messages": [{"role": "user", "content": "2+2?"}, {"role": "assistant", "content": [
+            {"type": "python", "text": "2+2"}, {"type": "python_output", "text": "4"}, {"type": "text", "text": "It is 4."}]}]},
+    ]
+    for max_tokens in (2048, 12):
+        expected = [render_reference(c, max_tokens) for c in conversations]
+        ids, mask, offsets = tok.render_conversations(conversations, max_tokens=max_tokens)
+        rows = [(ids[offsets[i]:offsets[i + 1]].tolist(), mask[offsets[i]:offsets[i + 1]].tolist()) for i in range(len(conversations))]
+        assert rows == expected
+        assert [tok.render_conversation(c, max_tokens=max_tokens) for c in conversations] == expected
+    assert all(len(ids) == 12 for ids, _ in expected), "Both conversations should be cut at max_tokens"
+    assert conversations[0]["messages"][1]["content"] == encode_text, "Rendering should not mutate the conversation"
+    print("✅ Batched conversation rendering OK")
+
     # Save/load test through a temporary directory
     with tempfile.TemporaryDirectory() as tmp_dir:
         tok.save(tmp_dir)
@@ -0,0 +1,65 @@
+"""
+Test the request scheduler of the web server. Example run:
+
+python -m pytest tests/test_scheduler.py -v
+"""
+
+import asyncio
+import pytest
+from nanochat.scheduler import RequestScheduler, QueueFullError, DeadlineExceededError
+
+def run(coro):
+    return asyncio.run(coro)
+
+def test_least_outstanding_tokens():
+    """A request goes to the worker with a free slot and the least outstanding tokens."""
+    async def main():
+        scheduler = RequestScheduler(["w0", "w1"], slots_per_worker=2, max_queue_depth=4)
+        a = scheduler.submit(100)
+        b = scheduler.submit(10)
+        c = scheduler.submit(10)
+        assert [a.worker_idx, b.worker_idx, c.worker_idx] == [0, 1, 1]
+        scheduler.consume(a, 95) # w0 now has 5 outstanding tokens, w1 has 20
+        scheduler.release(b)
+        d = scheduler.submit(10)
+        assert await scheduler.wait(d) == "w0"
+        assert scheduler.outstanding == [15, 10]
+    run(main())
+
+def test_admission_control_and_priorities():
+    """A full queue sheds new requests, unless they can evict a lower priority one, and serves by priority."""
+    async def main():
+        scheduler = RequestScheduler(["w0"], max_queue_depth=2)
+        running = scheduler.submit(1)
+        low = scheduler.submit(1, priority="batch")
+        mid = scheduler.submit(1)
+        with pytest.raises(QueueFullError):
+            scheduler.submit(1, priority="batch")
+        high = scheduler.submit(1, priority="interactive") # evicts the batch request
+        with pytest.raises(QueueFullError):
+            await scheduler.wait(low)
+        scheduler.release(running)
+        assert high.state == "running" and mid.state == "waiting"
+        scheduler.release(high)
+        assert mid.state == "running"
+        assert scheduler.stats()["num_shed"] == 2
+    run(main())
+
+def test_deadline_and_cancel():
+    """Waiting requests expire at their deadline, and cancelled ones give up their place in the queue."""
+    async def main():
+        scheduler = RequestScheduler(["w0"], max_queue_depth=4)
+        running = scheduler.submit(1)
+        expiring = scheduler.submit(1, deadline=0.01)
+        cancelled = scheduler.submit(1)
+        last = scheduler.submit(1)
+        with pytest.raises(DeadlineExceededError):
+            await scheduler.wait(expiring)
+        waiter = asyncio.ensure_future(scheduler.wait(cancelled))
+        await asyncio.sleep(0)
+        waiter.cancel()
+        await asyncio.sleep(0)
+        assert scheduler.stats()["queue_depth"] == 1
+        scheduler.release(running)
+        assert await scheduler.wait(last) == "w0"
+    run(main())
@@ -0,0 +1,77 @@
+"""
+Test the pre-tokenized token shards and their data loader. Example run:
+
+python -m pytest tests/test_token_shards.py -v
+"""
+
+import os
+import numpy as np
+
+from nanochat.token_shards import TokenShards, write_shard, write_meta, read_offsets, prepare_tokens_dir, has_token_shards, shard_paths
+
+def make_tokens_dir(tmp_path, shard_lengths, vocab_size=1000):
+    """Shards of consecutive tokens (token i of the split is i % vocab_size), one document per 10 tokens."""
+    shards, start = {}, 0
+    for i, length in enumerate(shard_lengths):
+        tokens = (np.arange(start, start + length) % vocab_size).astype(np.uint16)
+        offsets = np.append(np.arange(0, length, 10), length)
+        write_shard(str(tmp_path), f"shard_{i:05d}", tokens, offsets)
+        shards[f"shard_{i:05d}"] = {"num_tokens": length, "num_docs": len(offsets) - 1}
+        start += length
+    write_meta(str(tmp_path), vocab_size, 0, shards)
+    return str(tmp_path)
+
+def test_read_across_shards(tmp_path):
+    tokens_dir = make_tokens_dir(tmp_path, [30, 25, 40, 7])
+    train, val = TokenShards(tokens_dir, "train"), TokenShards(tokens_dir, "val")
+    assert train.num_tokens == 95 and val.num_tokens == 7
+    assert train.read(5, 10).tolist() == list(range(5, 15)) # inside one shard
+    assert train.read(28, 30).tolist() == list(range(28, 58)) # across three shards
+    assert train.read(0, 95).tolist() == list(range(95))
+    assert val.read(0, 7).tolist() == list(range(95, 102))
+    assert read_offsets(tokens_dir, "shard_00001").tolist() == [0, 10, 20, 25]
+
+def test_loader_exact_resume(tmp_path):
+    from nanochat.dataloader import pretokenized_distributed_data_loader_with_state
+    tokens_dir = make_tokens_dir(tmp_path, [50, 50, 10])
+    B, T = 2, 8
+    loader = pretokenized_distributed_data_loader_with_state(B, T, "train", tokens_dir, device="cpu")
+    batches = [next(loader) for _ in range(10)]
+    inputs, targets, state = batches[0]
+    assert inputs.flatten().tolist() == list(range(16)) and targets.flatten().tolist() == list(range(1, 17))
+    # 100 tokens hold 6 steps of 16 tokens (+1 target), then the next epoch starts over
+    assert [state["epoch"] for _, _, state in batches] == [0] * 6 + [1] * 4
+    assert batches[6][0].flatten().tolist() == list(range(16))
+    # resuming from the state of a batch yields that batch again, and the same data after it
+    resumed = pretokenized_distributed_data_loader_with_state(B, T, "train", tokens_dir, device="cpu", resume_state_dict=batches[4][2])
+    for inputs, targets, state in batches[4:]:
+        resumed_inputs, resumed_targets, resumed_state = next(resumed)
+        assert resumed_inputs.tolist() == inputs.tolist() and resumed_targets.tolist() == targets.tolist()
+        assert resumed_state == state
+
+def test_loader_prefetch(tmp_path):
+    from nanochat.dataloader import pretokenized_distributed_data_loader_with_state
+    tokens_dir = make_tokens_dir(tmp_path, [50, 50, 10])
+    B, T = 2, 8
+    loader = pretokenized_distributed_data_loader_with_state(B, T, "train", tokens_dir, device="cpu")
+    prefetched = pretokenized_distributed_data_loader_with_state(B, T, "train", tokens_dir, device="cpu", prefetch=3)
+    # the background thread runs ahead, but every batch comes out with its own state
+    for _ in range(10):
+        inputs, targets, state = next(loader)
+        prefetched_inputs, prefetched_targets, prefetched_state = next(prefetched)
+        assert prefetched_inputs.tolist() == inputs.tolist() and prefetched_targets.tolist() == targets.tolist()
+        assert prefetched_state == state
+    stats = prefetched.stats()
+    assert stats["queue_depth"] == 3 and 0 <= stats["queue_size"] <= 3
+    prefetched.close()
+
+def test_shards_of_another_tokenizer_are_deleted(tmp_path):
+    tokens_dir = make_tokens_dir(tmp_path, [30, 7])
+    # shards from before the fingerprint, or from another tokenizer, can't be trusted
+    assert prepare_tokens_dir(tokens_dir, "abc") is True
+    assert not has_token_shards(tokens_dir) and not os.path.exists(shard_paths(tokens_dir, "shard_00000")[0])
+    # with the same tokenizer, the shards tokenized so far are kept
+    write_shard(tokens_dir, "shard_00000", np.arange(5, dtype=np.uint16), np.array([0, 5]))
+    assert prepare_tokens_dir(tokens_dir, "abc") is False
+    assert os.path.exists(shard_paths(tokens_dir, "shard_00000")[0])
+    assert prepare_tokens_dir(tokens_dir, "def") is True
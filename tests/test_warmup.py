@@ -0,0 +1,37 @@
+"""
+Test the warmup of inference engines. Example run:
+
+python -m pytest tests/test_warmup.py -v
+"""
+
+from nanochat.warmup import warmup, compile_cache_dir
+
+class FakeTokenizer:
+    def get_bos_token_id(self):
+        return 0
+
+    def encode(self, text):
+        return [1, 2, 3]
+
+class FakeEngine:
+    def __init__(self):
+        self.requests = []
+
+    def generate(self, tokens, max_tokens=None, **kwargs):
+        self.requests.append((tokens, max_tokens, kwargs))
+        for _ in range(max_tokens):
+            yield [4], [1]
+
+def test_warmup_buckets():
+    """One synthetic request per bucket, shortened to fit in the sequence length, with the serving settings."""
+    engine = FakeEngine()
+    timings = warmup(engine, FakeTokenizer(), buckets=(128, 8), max_tokens=4, max_seq_len=64, temperature=0.0)
+    assert list(timings) == [8, 60]
+    (prompt, max_tokens, kwargs), (long_prompt, _, _) = engine.requests
+    assert prompt == [0, 1, 2, 3, 1, 2, 3, 1] and max_tokens == 4 and kwargs == {"temperature": 0.0}
+    assert len(long_prompt) == 60
+
+def test_compile_cache_dir_key():
+    config = {"n_layer": 2, "n_embd": 64}
+    assert compile_cache_dir(config, "cpu") == compile_cache_dir(dict(config), "cpu")
+    assert compile_cache_dir(config, "cpu") != compile_cache_dir({**config, "n_layer": 4}, "cpu")